@@ -0,0 +1,63 @@
+from time import monotonic
+
+
+def usable(value):
+    # error replies are never cached
+    return bool(value) and 'Err' not in value and 'error' not in value
+
+
+class AttributeCache:
+    # Per-device store for values that rarely change: unit, configuration,
+    # model, firmware, calibration constants. Each name has its own TTL in
+    # seconds (None = until invalidated); names without an entry in ttls are
+    # never cached. A device's own setters invalidate what they change, so
+    # steady-state polling only pays for the measurement itself.
+    def __init__(self, ttls):
+        self.TTLs = dict(ttls)
+        self.Entries = {}
+        self.Hits = 0
+        self.Misses = 0
+
+    def get(self, name):
+        entry = self.Entries.get(name)
+        if entry is None or (entry[1] is not None and monotonic() >= entry[1]):
+            return None
+        return entry[0]
+
+    def put(self, name, value, valid=usable):
+        if name not in self.TTLs or not valid(value):
+            return
+        ttl = self.TTLs[name]
+        self.Entries[name] = (value, None if ttl is None else monotonic() + ttl)
+
+    def invalidate(self, *names):
+        # no names = everything
+        if not names:
+            self.Entries.clear()
+        for name in names:
+            self.Entries.pop(name, None)
+
+    def fetch(self, name, read, valid=usable):
+        value = self.get(name)
+        if value is not None:
+            self.Hits += 1
+            return value
+        self.Misses += 1
+        value = read()
+        self.put(name, value, valid)
+        return value
+
+    async def fetch_async(self, name, read, valid=usable):
+        value = self.get(name)
+        if value is not None:
+            self.Hits += 1
+            return value
+        self.Misses += 1
+        value = await read()
+        self.put(name, value, valid)
+        return value
+
+    def stats(self):
+        return {'hits': self.Hits,
+                'misses': self.Misses,
+                'entries': len(self.Entries)}
@@ -0,0 +1,271 @@
+import json
+import multiprocessing
+import platform
+import sys
+import threading
+from time import monotonic, process_time, sleep, time
+
+import Discovery
+from CordisDevice import CordisDevice, find_boards, find_boards_concurrent
+from ExternalSensor import ExternalSensor
+from Fluke2700 import Fluke2700
+from Fluke8846 import Fluke8846
+from Hotplug import close_device
+from Pace1000 import Pace1000
+from Simulators import start_bench, stop_bench
+from SureFlow import SureFlow
+from Transport import register_port, unregister_port
+
+# the query each class is timed with: (call, argument)
+QUERIES = {CordisDevice: ('get_resp', 'PIDP'),
+           ExternalSensor: ('get_resp', 'SN'),
+           Fluke2700: ('read_command', b'val?'),
+           Fluke8846: ('read_command', b'FETCH3?'),
+           Pace1000: ('read_command', b':SENS:PRES?'),
+           SureFlow: ('read_command', b'A')}
+
+
+def serve_bench(counts, faults, conn):
+    # child process: owns the simulators so their CPU is not billed to
+    # the code being measured
+    sims = start_bench(counts, **faults)
+    conn.send([(type(s).__name__, s.Port, s.SerialNumber) for s in sims])
+    conn.recv()
+    stop_bench(sims)
+
+
+class Bench:
+    # Simulated instruments in a separate process, registered as ports here.
+    # counts: {device class name: how many}, in port order.
+    def __init__(self, counts, **faults):
+        self.Counts = counts
+        self.Faults = faults
+        self.Conn = None
+        self.Process = None
+        self.Ports = []
+        self.Serials = []
+
+    def start(self):
+        self.Conn, child = multiprocessing.Pipe()
+        self.Process = multiprocessing.Process(
+            target=serve_bench, args=(self.Counts, self.Faults, child), daemon=True)
+        self.Process.start()
+        for name, port, sn in self.Conn.recv():
+            register_port(port, 'Simulated ' + name)
+            self.Ports.append(port)
+            self.Serials.append(sn)
+        return self
+
+    def stop(self):
+        for port in self.Ports:
+            unregister_port(port)
+        self.Ports = []
+        self.Serials = []
+        self.Conn.send(None)
+        self.Process.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def percentiles(samples):
+    # latency summary in milliseconds
+    s = sorted(samples)
+    if not s:
+        return {}
+
+    def at(q):
+        return 1000 * s[min(len(s) - 1, int(q * len(s)))]
+    return {'n': len(s), 'mean': 1000 * sum(s) / len(s), 'p50': at(.5),
+            'p90': at(.9), 'p99': at(.99), 'max': 1000 * s[-1]}
+
+
+def timed(call):
+    # (wall seconds, process CPU seconds, result)
+    cpu = process_time()
+    start = monotonic()
+    result = call()
+    return monotonic() - start, process_time() - cpu, result
+
+
+def scan(port_counts=(1, 4, 16, 64), find_device_ports=16, **faults):
+    # find_boards / find_boards_concurrent over n Cordis boards, and
+    # Fluke2700.find_device with the gauge behind n - 1 boards (every other
+    # port costs one probe timeout, so only up to find_device_ports)
+    results = {}
+    for n in port_counts:
+        r = {}
+        with Bench({'CordisDevice': n}, **faults):
+            wall, cpu, found = timed(lambda: list(find_boards()))
+            r['find_boards'] = {'seconds': wall, 'cpu': cpu, 'found': len(found)}
+            wall, cpu, found = timed(lambda: list(find_boards_concurrent(deadline=60)))
+            r['find_boards_concurrent'] = {'seconds': wall, 'cpu': cpu,
+                                           'found': len(found)}
+        if n <= find_device_ports:
+            with Bench({'CordisDevice': n - 1, 'Fluke2700': 1}, **faults):
+                gauge = Fluke2700(None)
+                wall, cpu, found = timed(gauge.find_device)
+                close_device(gauge)
+                r['find_device'] = {'seconds': wall, 'cpu': cpu, 'found': bool(found)}
+        results[str(n)] = r
+    return results
+
+
+def latency(queries=1000, **faults):
+    # get_resp / read_command round trip on one instrument of each kind.
+    # Percentiles cover answered calls only; failures are counted in errors
+    results = {}
+    counts = dict((cls.__name__, 1) for cls in QUERIES)
+    with Bench(counts, **faults) as bench:
+        for cls, port, sn in zip(QUERIES, bench.Ports, bench.Serials):
+            device = Discovery.open_device(cls, port, sn)
+            name, arg = QUERIES[cls]
+            call = getattr(device, name)
+            times = []
+            errors = 0
+            cpu = process_time()
+            for i in range(queries):
+                start = monotonic()
+                r = call(arg)
+                elapsed = monotonic() - start
+                if r in ('', 'Err', 'Err,Err') or r.startswith('error'):
+                    errors += 1
+                else:
+                    times.append(elapsed)
+            cpu = process_time() - cpu
+            close_device(device)
+            r = percentiles(times)
+            r['errors'] = errors
+            r['cpu_per_query_ms'] = 1000 * cpu / queries
+            results[cls.__name__ + '.' + name] = r
+    return results
+
+
+def connect(repeats=20, **faults):
+    # CordisDevice(port): open, lock and get_all_values; and get_all_values
+    # alone on an open device
+    with Bench({'CordisDevice': 1}, **faults) as bench:
+        opens = []
+        for i in range(repeats):
+            wall, cpu, device = timed(lambda: CordisDevice(bench.Ports[0]))
+            opens.append(wall)
+            close_device(device)
+        device = CordisDevice(bench.Ports[0])
+        refresh = []
+        cpu = process_time()
+        for i in range(repeats):
+            refresh.append(timed(device.get_all_values)[0])
+        cpu = process_time() - cpu
+        close_device(device)
+    return {'open': percentiles(opens),
+            'get_all_values': percentiles(refresh),
+            'get_all_values_cpu_ms': 1000 * cpu / repeats}
+
+
+def throughput(devices=(1, 8, 32), seconds=5.0, **faults):
+    # sustained update_values() across N boards, one thread per port as a
+    # station runs them
+    results = {}
+    for n in devices:
+        with Bench({'CordisDevice': n}, **faults) as bench:
+            boards = [CordisDevice(port) for port in bench.Ports]
+            counts = [0] * n
+            errors = [0] * n
+            stop = threading.Event()
+
+            def poll(i):
+                board = boards[i]
+                while not stop.is_set():
+                    board.update_values()
+                    if board.reading('Monitor').Status:
+                        errors[i] += 1
+                    counts[i] += 1
+            threads = [threading.Thread(target=poll, args=(i,)) for i in range(n)]
+            cpu = process_time()
+            start = monotonic()
+            for t in threads:
+                t.start()
+            sleep(seconds)
+            stop.set()
+            for t in threads:
+                t.join()
+            elapsed = monotonic() - start
+            cpu = process_time() - cpu
+            for board in boards:
+                close_device(board)
+        total = sum(counts)
+        results[str(n)] = {'updates_per_s': total / elapsed,
+                           'per_device_per_s': total / elapsed / n,
+                           'errors': sum(errors),
+                           'cpu_per_update_ms': 1000 * cpu / total if total else None}
+    return results
+
+
+def run(quick=False, **faults):
+    if quick:
+        suites = {'scan': lambda: scan((1, 4), 4, **faults),
+                  'latency': lambda: latency(200, **faults),
+                  'connect': lambda: connect(5, **faults),
+                  'throughput': lambda: throughput((1, 4), 1.0, **faults)}
+    else:
+        suites = {'scan': lambda: scan(**faults),
+                  'latency': lambda: latency(**faults),
+                  'connect': lambda: connect(**faults),
+                  'throughput': lambda: throughput(**faults)}
+    results = {'time': time(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'faults': faults}
+    for name, suite in suites.items():
+        results[name] = suite()
+    return results
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(baseline, current, tolerance=.2):
+    # metrics more than `tolerance` (fraction) worse than the baseline.
+    # Rates (*_per_s) should not drop; times, CPU and errors should not
+    # rise. Returns {metric: (baseline, current)}
+    old = flatten(baseline)
+    new = flatten(current)
+    worse = {}
+    for key in sorted(set(old) & set(new)):
+        if key == 'time' or key.endswith('.n') or key.endswith('.found'):
+            continue
+        a, b = old[key], new[key]
+        if key.endswith('_per_s'):
+            if b < a * (1 - tolerance):
+                worse[key] = (a, b)
+        elif b > a * (1 + tolerance) and b - a > 1e-9:
+            worse[key] = (a, b)
+    return worse
+
+
+if __name__ == '__main__':
+    # python Benchmark.py [--quick] [results.json [baseline.json]]
+    args = [a for a in sys.argv[1:] if a != '--quick']
+    results = run(quick='--quick' in sys.argv)
+    text = json.dumps(results, indent=1, sort_keys=True)
+    if args:
+        with open(args[0], 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if len(args) > 1:
+        with open(args[1], 'r') as f:
+            worse = compare(json.load(f), results)
+        for key, (a, b) in sorted(worse.items()):
+            print('slower: ' + key + ' ' + repr(a) + ' -> ' + repr(b))
+        sys.exit(1 if worse else 0)
@@ -0,0 +1,182 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+
+from Readings import timed_value
+from Settling import SettleChannel, device_read, wait_until_stable
+
+
+def sample_together(reads, samples=10, rate=10.0):
+    # reads all channels at the same instant (one thread per port),
+    # `samples` times, and returns the mean of each; None if nothing came back
+    interval = 1.0 / rate
+    sums = [0.0] * len(reads)
+    counts = [0] * len(reads)
+    with ThreadPoolExecutor(len(reads)) as pool:
+        for i in range(samples):
+            start = monotonic()
+            futures = [pool.submit(read) for read in reads]
+            for k, f in enumerate(futures):
+                s = timed_value(f.result())
+                if s is not None:
+                    sums[k] += s[1]
+                    counts[k] += 1
+            sleep(max(0, start + interval - monotonic()))
+    return [sums[k] / counts[k] if counts[k] else None for k in range(len(reads))]
+
+
+def sweep_many(boards, reference, setpoints, attr='Pressure', band=.01,
+               slope=None, settle_timeout=60.0, samples=10, rate=10.0):
+    # For each setpoint: command every board at once, wait until all the
+    # boards' Monitor channels and the reference have settled, then average
+    # them sampled together. The one reference value at each point is
+    # shared by every board. Returns one list per board of
+    # [(setpoint, monitor, reference, settled), ...]
+    board_reads = [device_read(board, 'Monitor') for board in boards]
+    ref_read = device_read(reference, attr)
+    points = [[] for board in boards]
+    with ThreadPoolExecutor(len(boards)) as pool:
+        for sp in setpoints:
+            list(pool.map(lambda board: board.set_current_command(sp), boards))
+            channels = [SettleChannel(read, band, slope, samples,
+                                      'Monitor ' + str(i))
+                        for i, read in enumerate(board_reads)]
+            channels.append(SettleChannel(ref_read, band, slope, samples, attr))
+            settled = wait_until_stable(channels, settle_timeout, rate,
+                                        len(channels))['stable']
+            means = sample_together([ref_read] + board_reads, samples, rate)
+            if means[0] is None:
+                continue
+            for i, monitor in enumerate(means[1:]):
+                if monitor is not None:
+                    points[i].append((float(sp), monitor, means[0], settled))
+    return points
+
+
+def sweep(board, reference, setpoints, attr='Pressure', band=.01, slope=None,
+          settle_timeout=60.0, samples=10, rate=10.0):
+    return sweep_many([board], reference, setpoints, attr, band, slope,
+                      settle_timeout, samples, rate)[0]
+
+
+def fit_line(x, y):
+    # least-squares y = gain * x + offset, and the largest residual
+    import numpy
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    a = numpy.vstack([x, numpy.ones(len(x))]).T
+    (gain, offset), residuals, rank, sv = numpy.linalg.lstsq(a, y, rcond=None)
+    return float(gain), float(offset), float(numpy.abs(a.dot([gain, offset]) - y).max())
+
+
+def corrected(zero, fullscale, gain, offset, span):
+    # New zero/fullscale constants, assuming the board maps its raw signal
+    # linearly onto 0..span between zero and fullscale. The old constants
+    # gave reference = gain * shown + offset; the new ones put 0 and span
+    # where the reference reads 0 and span.
+    per_unit = (fullscale - zero) / span
+    return (zero + (0 - offset) / gain * per_unit,
+            zero + (span - offset) / gain * per_unit)
+
+
+def constants(board, cmds):
+    r = board.get_resps(cmds)
+    try:
+        return [float(r[cmd]) for cmd in cmds]
+    except Exception as ex:
+        return None
+
+
+def solve(board, points, span, sensor, command, report):
+    # fits one board's sweep into report['written']; False on failure
+    report['points'] = points
+    if len(points) < 2:
+        report['error'] = 'not enough points'
+        return False
+    sp = [p[0] for p in points]
+    mon = [p[1] for p in points]
+    ref = [p[2] for p in points]
+    values = {}
+    if sensor:
+        old = constants(board, ['SZERO', 'SFS'])
+        if old is None:
+            report['error'] = 'could not read SZERO/SFS'
+            return False
+        gain, offset, worst = fit_line(mon, ref)
+        report['sensor'] = {'gain': gain, 'offset': offset, 'residual': worst}
+        values['SZERO'], values['SFS'] = corrected(old[0], old[1], gain, offset, span)
+    if command:
+        old = constants(board, ['CZERO', 'CFS'])
+        if old is None:
+            report['error'] = 'could not read CZERO/CFS'
+            return False
+        gain, offset, worst = fit_line(sp, ref)
+        report['command'] = {'gain': gain, 'offset': offset, 'residual': worst}
+        values['CZERO'], values['CFS'] = corrected(old[0], old[1], gain, offset, span)
+    values = dict((cmd, round(v, 6)) for cmd, v in values.items())
+    report['written'] = values
+    return True
+
+
+def commit(board, values, save, report):
+    result = board.write_parameters(values, save=save)
+    report['result'] = result
+    if any(result.values()):
+        report['error'] = 'write not acknowledged'
+        return False
+    # boards echo constants with limited precision
+    readback = constants(board, list(values))
+    if readback is None or any(abs(r - v) > 1e-4 * max(1.0, abs(v))
+                               for r, v in zip(readback, values.values())):
+        report['error'] = 'read back does not match'
+        return False
+    return True
+
+
+def calibrate_many(boards, reference, setpoints, span, attr='Pressure',
+                   band=.01, slope=None, settle_timeout=60.0, samples=10,
+                   rate=10.0, sensor=True, command=True, tolerance=None,
+                   save=True):
+    # Calibrates every CordisDevice on a bench against one reference gauge
+    # (Pace1000, Fluke2700, ...). The boards are swept together, with one
+    # reference sample per settled point fanned out to all of them; each
+    # board then gets sensor (Monitor vs reference) and command (setpoint vs
+    # reference) fits, its corrected zero/fullscale written in one verified
+    # transaction, and its end points checked again against `tolerance`.
+    # Returns one report dict per board, in order.
+    if tolerance is None:
+        tolerance = 2 * band
+    reports = [{'ok': False, 'points': [], 'written': {}, 'verify': []}
+               for board in boards]
+    points = sweep_many(boards, reference, setpoints, attr, band, slope,
+                        settle_timeout, samples, rate)
+
+    def write(i):
+        return solve(boards[i], points[i], span, sensor, command, reports[i]) and \
+            commit(boards[i], reports[i]['written'], save, reports[i])
+    with ThreadPoolExecutor(len(boards)) as pool:
+        written = list(pool.map(write, range(len(boards))))
+    done = [i for i in range(len(boards)) if written[i]]
+    if not done:
+        return reports
+    # the end points again, with the new constants
+    check = sweep_many([boards[i] for i in done], reference,
+                       [setpoints[0], setpoints[-1]], attr, band, slope,
+                       settle_timeout, samples, rate)
+    for i, verify in zip(done, check):
+        report = reports[i]
+        report['verify'] = verify
+        report['ok'] = len(verify) == 2 and all(
+            (not sensor or abs(m - r) <= tolerance) and
+            (not command or abs(s - r) <= tolerance) for s, m, r, settled in verify)
+        if not report['ok']:
+            report['error'] = 'verification outside tolerance'
+    return reports
+
+
+def calibrate(board, reference, setpoints, span, attr='Pressure', band=.01,
+              slope=None, settle_timeout=60.0, samples=10, rate=10.0,
+              sensor=True, command=True, tolerance=None, save=True):
+    # single-board calibrate_many
+    return calibrate_many([board], reference, setpoints, span, attr, band,
+                          slope, settle_timeout, samples, rate, sensor,
+                          command, tolerance, save)[0]
@@ -1,8 +1,17 @@
 import platform
-from time import sleep, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeout
+from time import monotonic, sleep
 
 import serial
-import serial.tools.list_ports
+
+from AttributeCache import AttributeCache
+from LeakTest import leak_test
+from Metrics import metrics
+from Readings import ReadingAttribute, TypedReadings, parse_reading
+from Timeouts import policy as timeout_policy
+from Transport import CordisProtocol, PortLock, comports
+from Transport import query_batch, write_batch
 
 if platform.system().lower() != 'windows':
     import fcntl
@@ -10,53 +19,124 @@ else:
     from fakefcntl import fcntl
 
 
-def find_first_board():
+def find_first_board(concurrent=True):
     try:
-        boards = find_boards()
+        if concurrent:
+            boards = find_boards_concurrent()
+        else:
+            boards = find_boards()
         b = next(boards)
+        boards.close()
     except:
         b = None
     return b
 
 
 def find_boards():
-    for p in serial.tools.list_ports.comports():
-        try:
-            if p.device == '/dev/ttyAMA0':
-                continue
-            with open(p.device, 'r') as a:
-                if platform.system().lower() != 'windows':
-                    fcntl.flock(a.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except Exception as e:
-            print('No Board: ' + str(e))
-            sleep(.1)
+    for p in comports():
+        if p.device == '/dev/ttyAMA0':
             continue
-        with serial.Serial(p.device, 57600, timeout=.4, write_timeout=.4) as ser:
-            try:
+        if probe_board(p.device, retry_delay=.1):
+            yield p.device
+
+
+def find_boards_concurrent(max_workers=16, deadline=5.0):
+    # probe every port at once and yield each board as soon as it answers.
+    # The deadline runs from the start of the scan and stops the waiting,
+    # not the probes: one already running still ends on its own timeout
+    ports = [p.device for p in comports()
+             if p.device != '/dev/ttyAMA0']
+    if not ports:
+        return
+    pool = ThreadPoolExecutor(max_workers=min(max_workers, len(ports)),
+                              thread_name_prefix='find_boards')
+    try:
+        futures = {pool.submit(probe_board, d): d for d in ports}
+        try:
+            for f in as_completed(futures, timeout=deadline):
+                if f.exception() is None and f.result():
+                    yield futures[f]
+        except FuturesTimeout:
+            print('Board scan deadline reached')
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def probe_board(device, retry_delay=0):
+    try:
+        with open(device, 'r') as a:
+            if platform.system().lower() != 'windows':
+                fcntl.flock(a.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except Exception as e:
+        print('No Board: ' + str(e))
+        sleep(retry_delay)
+        return False
+    try:
+        with serial.Serial(device, 57600, timeout=.4, write_timeout=.4) as ser:
+            ser.reset_input_buffer()
+            ser.reset_output_buffer()
+            timeout_policy.apply(ser, 'CordisDevice', device, 'ID', .4)
+            start = monotonic()
+            ser.write(b'?ID\r')
+            resp = ser.read_until(b'\r')
+            if resp.decode("utf-8")[:2] == 'ID':
+                timeout_policy.observe('CordisDevice', device, 'ID', start, True, .4)
+                timeout_policy.apply(ser, 'CordisDevice', device, 'STAT', .4)
+                if 'CS-5090' in resp.decode("utf-8"):
+                    #print('CS-5090: ' + device)
+                    return True
                 ser.reset_input_buffer()
                 ser.reset_output_buffer()
-                ser.write(b'?ID\r')
+                ser.write(b'?STAT\r')
                 resp = ser.read_until(b'\r')
-                if resp.decode("utf-8")[:2] == 'ID':
-                    if 'CS-5090' in resp.decode("utf-8"):
-                        #print('CS-5090: ' + p.device)
-                        yield p.device
-                    ser.reset_input_buffer()
-                    ser.reset_output_buffer()
-                    ser.write(b'?STAT\r')
-                    resp = ser.read_until(b'\r')
-                    if resp.decode("utf-8")[:4] == 'STAT':
-                        #print('Cordis: ' + p.device)
-                        ser.close()
-                        yield p.device
-            except Exception as e:
-                print('No Board: ' + str(e))
-                continue
-            finally:
-                ser.close()
+                if resp.decode("utf-8")[:4] == 'STAT':
+                    #print('Cordis: ' + device)
+                    return True
+    except Exception as e:
+        print('No Board: ' + str(e))
+    return False
+
+
+# (query, attribute) read by get_all_values after SN and ID
+PARAMETERS = [('CZERO', 'Command_Zero'), ('CFS', 'Command_Fullscale'),
+              ('MZERO', 'Monitor_Zero'), ('MFS', 'Monitor_Fullscale'),
+              ('SZERO', 'Sensor_Zero'), ('SFS', 'Sensor_Fullscale'),
+              ('PIDP', 'PID_P'), ('PIDI', 'PID_I')]
+PARAMETERS_5090 = PARAMETERS + [('CUTOFF', 'Cutoff'), ('BIAS', 'IBIAS')]
+PARAMETERS_STD = PARAMETERS + [('CO', 'Cutoff'), ('IBIAS', 'IBIAS'),
+                               ('MON', 'Monitor'), ('CC', 'Current_Command'),
+                               ('CT', 'Command_Type'), ('VLO', 'VLO'),
+                               ('EBIAS', 'EBIAS'), ('FLOW', 'Flow'),
+                               ('PIDD', 'PID_D'), ('FW', 'Firmware')]
+
+# command written by set_* -> attribute it updates
+WRITABLE = {'CT': 'Command_Type', 'CC': 'Current_Command', 'PIDP': 'PID_P',
+            'PIDI': 'PID_I', 'PIDD': 'PID_D', '53455249414C': 'Serial_Number',
+            '4D4F44454C': 'Model_Number', 'VLO': 'VLO', 'CZERO': 'Command_Zero',
+            'CFS': 'Command_Fullscale', 'MZERO': 'Monitor_Zero',
+            'MFS': 'Monitor_Fullscale', 'SZERO': 'Sensor_Zero',
+            'SFS': 'Sensor_Fullscale', 'EBIAS': 'EBIAS', 'IBIAS': 'IBIAS',
+            'BIAS': 'IBIAS', 'FLOW': 'Flow', 'CO': 'Cutoff', 'CUTOFF': 'Cutoff'}
+
+# values get_* may answer from the cache, by command: seconds, or None for
+# until a set_*, auto_calibrate or get_all_values replaces them
+CACHED = {'ID': None, 'SN': None, 'FW': None, 'CT': None,
+          'CZERO': 300.0, 'CFS': 300.0, 'MZERO': 300.0, 'MFS': 300.0,
+          'SZERO': 300.0, 'SFS': 300.0, 'PIDP': 300.0, 'PIDI': 300.0,
+          'PIDD': 300.0, 'VLO': 300.0, 'EBIAS': 300.0, 'IBIAS': 300.0,
+          'BIAS': 300.0, 'CO': 300.0, 'CUTOFF': 300.0}
+# write command -> the query it changes, where they differ
+READBACK = {'53455249414C': 'SN', '4D4F44454C': 'ID'}
+# commands a CS-5090 names differently
+RENAMED_5090 = {'CO': 'CUTOFF', 'IBIAS': 'BIAS'}
+
+
+class CordisDevice(CordisProtocol, TypedReadings):
+    Kind = 'CordisDevice'
+    Readback = READBACK
+    Command = ReadingAttribute()
+    Monitor = ReadingAttribute()
 
-
-class CordisDevice():
     def __init__(self, device):
         self.SerialPort = None
         self.Serial_Number = '~No Board Found~'
@@ -83,80 +163,142 @@ class CordisDevice():
         self.Firmware = ''
         self.InletEnabled = True
         self.ExhaustEnabled = True
-        self.Waiting = False
+        self.Lock = PortLock()
+        self.AsyncPort = None
+        self.Framer = None
+        self.Worker = None
+        self.Cache = AttributeCache(CACHED)
 
         if device is not None:
             self.SerialPort = serial.Serial(device, 57600, timeout=.4)
             if platform.system().lower() != 'windows':
                 fcntl.flock(self.SerialPort.fileno(),
                             fcntl.LOCK_EX | fcntl.LOCK_NB)
-            self.get_serialnumber()
-            if not 'error' in self.Serial_Number:
-                self.get_all_values()
-                self.Serial_Number = '~No Board Found~'
+            self.get_all_values()
         else:
             self.SerialPort = None
             self.Serial_Number = '~No Board Found~'
             self.Model_Number = '~No Board Found~'
 
+    @property
+    def Waiting(self):
+        return self.Lock.locked()
+
     def reset_serial(self):
-        while self.Waiting:
-            pass
-        self.Waiting = True
-        if self.SerialPort:
-            self.SerialPort.reset_input_buffer()
-            self.SerialPort.reset_output_buffer()
-        self.Waiting = False
+        with self.Lock:
+            if self.SerialPort:
+                self.SerialPort.reset_input_buffer()
+                self.SerialPort.reset_output_buffer()
+
+    def echo(self, cmd):
+        # a CS-5090 answers ?CUTOFF as CO
+        if 'CUTOFF' in cmd and 'CS-5090' in self.Model_Number:
+            return 'CO'
+        return cmd
 
     def get_resp(self, cmd):
         try:
-            while self.Waiting:
-                pass
-            self.reset_serial()
-            self.Waiting = True
             tmpcmd = b'?' + cmd.encode() + b'\r'                        # format command query
-
-            # send command query
-            self.SerialPort.write(tmpcmd)
-            resp = self.SerialPort.read_until(b'\r')
-            self.Waiting = False
-            resp = resp.decode('utf-8')
-            if resp == '' or resp[-1] != '\r':
+            echo = self.echo(cmd)
+            with self.Lock:
+                # send command query, skipping any late reply still in the way
+                port = self.SerialPort.port
+                timeout = timeout_policy.timeout('CordisDevice', port, cmd, .4)
+                start = monotonic()
+                resp = self.framer().query(tmpcmd, echo.encode() + b':', timeout)
+            timeout_policy.observe('CordisDevice', port, cmd, start, resp is not None, .4)
+            if resp is None:
                 raise Exception('Unexpected Return')
-            if 'CUTOFF' in cmd and 'CS-5090' in self.Model_Number:
-                return resp[4:-1]
-            else:
-                return resp[(len(cmd)+2):-1]
+            return resp.decode('utf-8')[(len(echo)+2):]
         except Exception as ex:
+            metrics.error('CordisDevice', getattr(self.SerialPort, 'port', None), cmd, ex)
             # self.SerialPort = None
-            self.Waiting = False
             # print('error: ' + type(ex).__name__)
             return 'error: ' + type(ex).__name__
 
+    def get_cached(self, cmd):
+        # slow-changing values are answered from the cache until they expire
+        # or one of our own writes replaces them
+        return self.Cache.fetch(cmd, lambda: self.get_resp(cmd))
+
+    def get_resps(self, cmds, window=8):
+        # pipelined get_resp: all queries go out back-to-back and replies are
+        # matched by their echoed prefix; anything unanswered is retried
+        # one at a time. Each reply is observed and decoded on its own, as
+        # get_resp would, so one bad reply only costs its own retry
+        results = {}
+        answered = False
+        failed = 'error: Exception'
+        port = getattr(self.SerialPort, 'port', None)
+        echoes = [self.echo(cmd) for cmd in cmds]
+        requests = [(b'?' + cmd.encode() + b'\r', echo.encode() + b':')
+                    for cmd, echo in zip(cmds, echoes)]
+        timings = []
+        try:
+            with self.Lock:
+                port = self.SerialPort.port
+                timeout = max(timeout_policy.timeout('CordisDevice', port, cmd, .4)
+                              for cmd in cmds)
+                replies = query_batch(self.framer(), requests, timeout, window, timings)
+        except Exception as ex:
+            replies = []
+            failed = 'error: ' + type(ex).__name__
+            for cmd in cmds:
+                metrics.error('CordisDevice', port, cmd, ex)
+        for cmd, echo, reply, (sent, replied) in zip(cmds, echoes, replies, timings):
+            timeout_policy.observe('CordisDevice', port, cmd, sent, reply is not None,
+                                   .4, replied)
+            if reply is None:
+                continue
+            answered = True
+            try:
+                results[cmd] = reply.decode('utf-8')[(len(echo)+2):]
+            except Exception as ex:
+                metrics.error('CordisDevice', port, cmd, ex)
+        for cmd in cmds:
+            if cmd not in results:
+                # nothing answered at all: don't wait out every query again
+                results[cmd] = self.get_resp(cmd) if answered else failed
+        return results
+
     def set_value(self, cmd, value):
         try:
-            while self.Waiting:
-                pass
-            self.Waiting = True
-            tmpcmd = b'?' + cmd.encode() + b'\r'                        # format command query
             #  with serial.Serial(self.SerialPort, 57600, timeout=.4) as ser:
             tmpcmd = cmd.encode() + b': ' + str(value).encode() + \
                 b'\r'  # format command query
-            self.SerialPort.write(b'\r')
-            self.SerialPort.read(65535)
-            # send command
-            self.SerialPort.write(tmpcmd)
-            resp = self.SerialPort.read_until(b'\r')
-            self.Waiting = False
-            return resp.decode('utf-8')[(len(cmd)+2):-1]
+            ack = cmd.encode()
+            self.Cache.invalidate(READBACK.get(cmd, cmd))
+            with self.Lock:
+                port = self.SerialPort.port
+                timeout = timeout_policy.timeout('CordisDevice', port, cmd + ':', .4)
+                start = monotonic()
+                # the leading \r still clears a partial line on the board; its
+                # reply, and a stale 'CMD: value' read reply, are skipped by
+                # the framer: only the 'CMD: CMD' echo acknowledges the write
+                resp = self.framer().query(
+                    b'\r' + tmpcmd, lambda f: f[len(ack) + 2:] == ack, timeout)
+            timeout_policy.observe('CordisDevice', port, cmd + ':', start, resp is not None, .4)
+            if resp is None:
+                return ''
+            return resp.decode('utf-8')[(len(cmd)+2):]
         except Exception as ex:
+            metrics.error('CordisDevice', getattr(self.SerialPort, 'port', None), cmd + ':', ex)
             # self.SerialPort = None
-            self.Waiting = False
             return 'error'
 
+    def write_parameters(self, values, retries=2, save=False, window=8):
+        # values: {command: value}, written pipelined and each verified by
+        # its echo; see Transport.write_batch. A CS-5090 takes CUTOFF and
+        # BIAS in place of CO and IBIAS
+        if 'CS-5090' in self.Model_Number:
+            values = dict((RENAMED_5090.get(cmd, cmd), value)
+                          for cmd, value in values.items())
+        return write_batch(self, 'CordisDevice', values, READBACK, WRITABLE,
+                           retries, save, window)
+
     def get_id(self):
         r = ''
-        r = self.get_resp('ID')
+        r = self.get_cached('ID')
         self.Model_Number = r
         return r
 
@@ -165,13 +307,13 @@ class CordisDevice():
         if 'CS-5090' in self.Model_Number:
             r = ''
         else:
-            r = self.get_resp('FW')
+            r = self.get_cached('FW')
         self.Firmware = r
         return r
 
     def get_serialnumber(self):
         r = ''
-        r = self.get_resp('SN')
+        r = self.get_cached('SN')
         self.Serial_Number = r
         return r
 
@@ -186,93 +328,93 @@ class CordisDevice():
 
     def get_valveliftoff(self):
         r = ''
-        r = self.get_resp('VLO')
+        r = self.get_cached('VLO')
         self.VLO = r
         return r
 
     def get_pidp(self):
         r = ''
-        r = self.get_resp('PIDP')
+        r = self.get_cached('PIDP')
         self.PID_P = r
         return r
 
     def get_pidi(self):
         r = ''
-        r = self.get_resp('PIDI')
+        r = self.get_cached('PIDI')
         self.PID_I = r
         return r
 
     def get_pidd(self):
         r = ''
-        r = self.get_resp('PIDD')
+        r = self.get_cached('PIDD')
         self.PID_D = r
         return r
 
     def get_commandzero(self):
         r = ''
-        r = self.get_resp('CZERO')
+        r = self.get_cached('CZERO')
         self.Command_Zero = r
         return r
 
     def get_commandfullscale(self):
         r = ''
-        r = self.get_resp('CFS')
+        r = self.get_cached('CFS')
         self.Command_Fullscale = r
         return r
 
     def get_monitorzero(self):
         r = ''
-        r = self.get_resp('MZERO')
+        r = self.get_cached('MZERO')
         self.Monitor_Zero = r
         return r
 
     def get_monitorfullscale(self):
         r = ''
-        r = self.get_resp('MFS')
+        r = self.get_cached('MFS')
         self.Monitor_Fullscale = r
         return r
 
     def get_sensorzero(self):
         r = ''
-        r = self.get_resp('SZERO')
+        r = self.get_cached('SZERO')
         self.Sensor_Zero = r
         return r
 
     def get_sensorfullscale(self):
         r = ''
-        r = self.get_resp('SFS')
+        r = self.get_cached('SFS')
         self.Sensor_Fullscale = r
         return r
 
     def get_commandtype(self):
         r = ''
-        r = self.get_resp('CT')
+        r = self.get_cached('CT')
         self.Command_Type = r
         return r
 
     def get_ibias(self):
         r = ''
-        r = self.get_resp(
+        r = self.get_cached(
             'IBIAS' if 'CS-5090' not in self.Model_Number else 'BIAS')
         self.IBIAS = r
         return r
 
     def get_ebias(self):
         r = ''
-        r = self.get_resp('EBIAS')
+        r = self.get_cached('EBIAS')
         self.EBIAS = r
         return r
 
     def get_cutoff(self):
         r = ''
-        r = self.get_resp(
+        r = self.get_cached(
             'CO' if 'CS-5090' not in self.Model_Number else 'CUTOFF')
         self.Cutoff = r
         return r
 
     def get_vlo(self):
         r = ''
-        r = self.get_resp('VLO')
+        r = self.get_cached('VLO')
         self.VLO = r
         return r
 
@@ -282,14 +424,26 @@ class CordisDevice():
         self.Flow = r
         return r
 
-    def get_status(self):
+    def get_status(self, typed=False):
+        if 'CS-5090' in self.Model_Number:
+            r = self.parse_status(None)
+        else:
+            r = self.parse_status(self.get_resp('STAT'))
+        return self.readings('Command', 'Monitor') if typed else r
+
+    async def get_status_async(self, typed=False):
         if 'CS-5090' in self.Model_Number:
+            r = self.parse_status(None)
+        else:
+            r = self.parse_status(await self.get_resp_async('STAT'))
+        return self.readings('Command', 'Monitor') if typed else r
+
+    def parse_status(self, r):
+        if r is None:
             c = ''
             s = ''
             e = ''
         else:
-            r = ':  :  :'
-            r = self.get_resp('STAT')
             c = 'Err'
             s = 'Err'
             e = 'Err'
@@ -302,8 +456,8 @@ class CordisDevice():
                 except Exception as ex:
                     pass
 
-        self.Command = str(c)
-        self.Monitor = str(s)
+        self.Command = parse_reading(c, '', self.Serial_Number)
+        self.Monitor = parse_reading(s, '', self.Serial_Number)
         return c, s, e
 
     def get_command_type(self):
@@ -524,29 +678,20 @@ class CordisDevice():
     def save(self):
         try:
             # with serial.Serial(self.SerialPort, 57600, timeout=.5, write_timeout=.5) as ser:
-            while self.Waiting:
-                pass
-            self.Waiting = True
-            self.SerialPort.write(b'SAVE\r')
-            resp = self.SerialPort.read_until(b'\r')
-            self.Waiting = False
-            return resp.decode('utf-8')
+            with self.Lock:
+                resp = self.framer().query(b'SAVE\r', None, .4)
+            return (resp + b'\r').decode('utf-8') if resp is not None else ''
         except:
-            self.Waiting = False
             return 'error'
 
     def auto_calibrate(self):
         try:
             # with serial.Serial(self.SerialPort, 57600, timeout=.5, write_timeout=.5) as ser:
-            while self.Waiting:
-                pass
-            self.Waiting = True
-            self.SerialPort.write(b'AUTOC\r')
-            resp = self.SerialPort.read_until(b'\r')
-            self.Waiting = False
-            return resp.decode('utf-8')
+            self.Cache.invalidate()                 # new calibration constants
+            with self.Lock:
+                resp = self.framer().query(b'AUTOC\r', None, .4)
+            return (resp + b'\r').decode('utf-8') if resp is not None else ''
         except:
-            self.Waiting = False
             return 'error'
 
     def enable_both(self):
@@ -584,19 +729,25 @@ class CordisDevice():
         else:
             return 1
 
-    def leaktest(self, max_allowable=-0.4):
+    def leaktest(self, max_allowable=-0.4, rate=10.0, max_duration=30.0,
+                 confidence=.95, nominal_duration=30.0):
+        # max_allowable: largest monitor drop allowed over nominal_duration,
+        # which sets the pass rate; max_duration only caps how long the test
+        # may run. The monitor is sampled at `rate` Hz and the test ends as
+        # soon as its decay slope is known to be inside or outside that rate
+        # with the given confidence; see LeakTest.leak_test for the result
         instat = self.InletEnabled
         exstat = self.ExhaustEnabled
         self.disable_both()
-        startmon = float(self.get_status()[1])
-        starttime = time()
-        mon = startmon
-        while mon - startmon >= max_allowable:
-            mon = float(self.get_status()[1])
-        if instat:
-            self.enable_inlet()
-        if exstat:
-            self.enable_exhaust()
+        try:
+            return leak_test(lambda: self.get_status(typed=True)['Monitor'],
+                             max_allowable / nominal_duration, rate, max_duration,
+                             confidence=confidence)
+        finally:
+            if instat:
+                self.enable_inlet()
+            if exstat:
+                self.enable_exhaust()
 
     def is_connected(self):
         # r = self.get_resp('ID')
@@ -607,30 +758,30 @@ class CordisDevice():
 
     def get_all_values(self):
         self.empty_values()
-        self.get_serialnumber()
+        r = self.get_resps(['SN', 'ID'])
+        self.Cache.invalidate()
+        for cmd in r:
+            self.Cache.put(cmd, r[cmd])
+        self.Serial_Number = r['SN']
         if not 'error' in self.Serial_Number:
-            self.get_id()
-            self.get_commandzero()
-            self.get_commandfullscale()
-            self.get_monitorzero()
-            self.get_monitorfullscale()
-            self.get_sensorzero()
-            self.get_sensorfullscale()
-            self.get_pidp()
-            self.get_pidi()
-            self.get_cutoff()
-            self.get_ibias()
-            self.get_monitor()
-            self.get_current_command()
+            self.Model_Number = r['ID']
+            if 'CS-5090' in self.Model_Number:
+                params = PARAMETERS_5090
+            else:
+                params = PARAMETERS_STD
+            cmds = [cmd for cmd, attr in params]
             if 'CS-5090' not in self.Model_Number:
-                self.get_command_type()
-                self.get_current_command()
-                self.get_vlo()
-                self.get_ebias()
-                self.get_flow()
-                self.get_status()
-                self.get_pidd()
-                self.get_firmware()
+                cmds.append('STAT')
+            r = self.get_resps(cmds)
+            for cmd in cmds:
+                self.Cache.put(cmd, r[cmd])
+            for cmd, attr in params:
+                setattr(self, attr, r[cmd])
+            if 'CS-5090' in self.Model_Number:
+                self.Monitor = ''
+                self.Current_Command = '0'
+            else:
+                self.parse_status(r['STAT'])
         else:
             self.Serial_Number = '~No Board Found~'
 
@@ -659,9 +810,17 @@ class CordisDevice():
         self.InletEnabled = True
         self.ExhaustEnabled = True
 
-    def update_values(self):
+    def update_values(self, typed=False):
         if 'CS-5090' not in self.Model_Number:
             self.get_status()
+        if typed:
+            return self.readings('Command', 'Monitor')
+
+    async def update_values_async(self, typed=False):
+        if 'CS-5090' not in self.Model_Number:
+            await self.get_status_async()
+        if typed:
+            return self.readings('Command', 'Monitor')
 
 
 if __name__ == '__main__':
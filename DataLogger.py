@@ -0,0 +1,168 @@
+import os
+import threading
+from collections import deque
+from time import monotonic
+
+POLICIES = ('block', 'drop-oldest', 'downsample')
+HEADER = 'monotonic,device,id,channel,value,unit,status\n'
+
+
+class DataLogger:
+    # Takes readings from the polling threads through a bounded deque
+    # (append/popleft need no lock) and writes them as CSV in batches from
+    # a background thread, with an fsync every fsync_interval seconds.
+    # When the writer falls behind and the queue reaches capacity:
+    #   drop-oldest  the oldest queued record makes room for the new one
+    #   downsample   from half full, each channel keeps only every 2nd, 4th,
+    #                ... up to max_factor-th reading; when full, drop-oldest
+    #   block        the caller waits up to block_timeout for room, then the
+    #                record is dropped
+    # Only 'block' can make an acquisition thread wait.
+    def __init__(self, path, capacity=100000, batch=1000, flush_interval=.5,
+                 fsync_interval=5.0, policy='drop-oldest', max_factor=16,
+                 block_timeout=.1):
+        if policy not in POLICIES:
+            raise ValueError('policy must be one of ' + ', '.join(POLICIES))
+        self.Path = path
+        self.Capacity = capacity
+        self.Batch = batch
+        self.FlushInterval = flush_interval
+        self.FsyncInterval = fsync_interval
+        self.Policy = policy
+        self.MaxFactor = max_factor
+        self.BlockTimeout = block_timeout
+        self.Queue = deque()
+        self.Sequence = {}
+        self.Wake = threading.Event()
+        self.Space = threading.Event()
+        self.Space.set()
+        self.Stop = threading.Event()
+        self.Thread = None
+        self.File = None
+        self.Logged = 0
+        self.Written = 0
+        self.Dropped = 0
+        self.Decimated = 0
+        self.Batches = 0
+        self.Fsyncs = 0
+        self.Errors = 0
+
+    def start(self):
+        new = not os.path.exists(self.Path) or os.path.getsize(self.Path) == 0
+        self.File = open(self.Path, 'a')
+        if new:
+            self.File.write(HEADER)
+        self.Stop.clear()
+        self.Thread = threading.Thread(target=self.run, name='data logger',
+                                       daemon=True)
+        self.Thread.start()
+        return self
+
+    def stop(self):
+        self.Stop.set()
+        self.Wake.set()
+        if self.Thread:
+            self.Thread.join()
+            self.Thread = None
+        if self.File:
+            self.File.close()
+            self.File = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def log(self, device, channel, reading):
+        # queue one Reading; False if it was dropped or decimated
+        record = (reading.Timestamp, type(device).__name__, reading.DeviceId,
+                  channel, reading.Value, reading.Unit, reading.Status)
+        n = len(self.Queue)
+        if self.Policy == 'downsample' and n >= self.Capacity // 2:
+            key = (id(device), channel)
+            seq = self.Sequence.get(key, 0)
+            self.Sequence[key] = seq + 1
+            half = max(self.Capacity // 2, 1)
+            factor = min(self.MaxFactor, 2 ** (1 + 4 * (n - half) // half))
+            if seq % factor:
+                self.Decimated += 1
+                return False
+        if n >= self.Capacity:
+            if self.Policy == 'block':
+                self.Space.clear()
+                self.Wake.set()
+                if len(self.Queue) >= self.Capacity and \
+                        not self.Space.wait(self.BlockTimeout):
+                    self.Dropped += 1
+                    return False
+            else:
+                try:
+                    self.Queue.popleft()
+                    self.Dropped += 1
+                except IndexError:
+                    pass
+        self.Queue.append(record)
+        self.Logged += 1
+        if n + 1 >= self.Batch:
+            self.Wake.set()
+        return True
+
+    def log_device(self, device, names=None):
+        # queue the current reading of every channel of a device
+        for name in names or device.channels():
+            self.log(device, name, device.reading(name))
+
+    def callback(self, channel, result):
+        # PollScheduler callback: log the polled device after each run
+        self.log_device(channel.Device)
+
+    def run(self):
+        last_sync = monotonic()
+        while True:
+            self.Wake.wait(self.FlushInterval)
+            self.Wake.clear()
+            stopping = self.Stop.is_set()
+            while self.Queue:
+                self.write_batch()
+            if monotonic() - last_sync >= self.FsyncInterval or stopping:
+                self.sync()
+                last_sync = monotonic()
+            if stopping:
+                return
+
+    def write_batch(self):
+        lines = []
+        for i in range(self.Batch):
+            try:
+                t, cls, ident, channel, value, unit, status = self.Queue.popleft()
+            except IndexError:
+                break
+            lines.append(repr(t) + ',' + cls + ',' + str(ident) + ',' + channel +
+                         ',' + repr(value) + ',' + unit + ',' + str(status) + '\n')
+        self.Space.set()
+        try:
+            self.File.write(''.join(lines))
+            self.File.flush()
+            self.Written += len(lines)
+            self.Batches += 1
+        except Exception as ex:
+            self.Errors += 1
+            self.Dropped += len(lines)
+
+    def sync(self):
+        try:
+            os.fsync(self.File.fileno())
+            self.Fsyncs += 1
+        except Exception as ex:
+            self.Errors += 1
+
+    def stats(self):
+        return {'queued': len(self.Queue),
+                'logged': self.Logged,
+                'written': self.Written,
+                'dropped': self.Dropped,
+                'decimated': self.Decimated,
+                'batches': self.Batches,
+                'fsyncs': self.Fsyncs,
+                'errors': self.Errors}
@@ -0,0 +1,376 @@
+import json
+import os
+import platform
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeout
+from time import monotonic, time
+
+import serial
+
+from CordisDevice import CordisDevice
+from ExternalSensor import ExternalSensor
+from Fluke2700 import Fluke2700
+from Fluke8846 import Fluke8846
+from Pace1000 import Pace1000
+from SureFlow import SureFlow
+from Timeouts import policy as timeout_policy
+from Transport import comports
+
+if platform.system().lower() != 'windows':
+    import fcntl
+else:
+    from fakefcntl import fcntl
+
+
+probe_latency = threading.local()
+
+
+def query(ser, cmd, terminator=b'\r'):
+    ser.reset_input_buffer()
+    ser.reset_output_buffer()
+    start = monotonic()
+    ser.write(cmd)
+    resp = ser.read_until(terminator)
+    if resp[-len(terminator):] == terminator:
+        probe_latency.first = getattr(probe_latency, 'first', None) or monotonic() - start
+    return resp.decode('utf-8', 'replace')
+
+
+def idn_serial(resp):
+    try:
+        return resp.split(',')[2].strip()
+    except Exception as ex:
+        return '----------'
+
+
+def probe_cordis(ser):
+    # the leading CR ends any line left half written by a probe at another
+    # baud rate; a board answers that line first, so allow one more read
+    resp = query(ser, b'\r?ID\r')
+    if resp[:2] != 'ID' and resp[-1:] == '\r':
+        resp = ser.read_until(b'\r').decode('utf-8', 'replace')
+    if resp[:2] != 'ID':
+        return None
+    if 'CS-5090' not in resp:
+        resp = query(ser, b'?STAT\r')
+        if resp[:4] != 'STAT':
+            return None
+    cls = ExternalSensor if 'ADC::' in resp else CordisDevice
+    sn = query(ser, b'?SN\r')
+    if sn[:2] == 'SN' and sn[-1:] == '\r':
+        return cls, sn[4:-1]
+    return cls, ''
+
+
+def probe_fluke8846(ser):
+    resp = query(ser, b'\r*idn?\r')
+    if resp[:11] == 'FLUKE,8846A':
+        return Fluke8846, idn_serial(resp)
+    return None
+
+
+def probe_pace1000(ser):
+    resp = query(ser, b'\r\n*idn?\r\n', b'\r\n')
+    if resp[:22] == '*IDN GE Druck,PACE1000':
+        return Pace1000, idn_serial(resp)
+    return None
+
+
+def probe_fluke2700(ser):
+    resp = query(ser, b'\r*idn?\r')
+    if resp[:11] == 'FLUKE,2700G':
+        return Fluke2700, idn_serial(resp)
+    return None
+
+
+def probe_sureflow(ser):
+    resp = query(ser, b'\r*\r')
+    if resp[:2] != 'A ':
+        return None
+    try:
+        return SureFlow, str(int(query(ser, b'\rA r76\r').split('=')[1]))
+    except Exception as ex:
+        return SureFlow, '-'
+
+
+def serial_cordis(ser):
+    sn = query(ser, b'?SN\r')
+    if sn[:2] == 'SN' and sn[-1:] == '\r':
+        return sn[4:-1]
+    return None
+
+
+def serial_sureflow(ser):
+    try:
+        return str(int(query(ser, b'\rA r76\r').split('=')[1]))
+    except Exception as ex:
+        return None
+
+
+def serial_idn(probe):
+    def read(ser):
+        found = probe(ser)
+        return found[1] if found else None
+    return read
+
+
+# Ordered (baud, timeout, probe) signatures, shortest timeout first so an
+# instrument that answers quickly is never held behind a silent 4 s PACE1000
+# probe. The 57600 entries are already in timeout order, so each baud rate is
+# still set at most once per port.
+SIGNATURES = [
+    (19200, .2, probe_sureflow),
+    (9600, .3, probe_fluke2700),
+    (57600, .4, probe_cordis),
+    (57600, 1, probe_fluke8846),
+    (57600, 4, probe_pace1000),
+]
+
+SIGNATURE_CLASSES = {
+    probe_cordis: (CordisDevice, ExternalSensor),
+    probe_fluke8846: (Fluke8846,),
+    probe_pace1000: (Pace1000,),
+    probe_fluke2700: (Fluke2700,),
+    probe_sureflow: (SureFlow,),
+}
+
+CLASSES = {c.__name__: c for cs in SIGNATURE_CLASSES.values() for c in cs}
+
+# classes that take the serial number discovery read instead of asking again;
+# CordisDevice and ExternalSensor load their whole state when opened anyway
+IDENTIFIED = (Fluke2700, Fluke8846, Pace1000, SureFlow)
+
+# identity query each probe starts with, as recorded by the timeout policy
+SIGNATURE_KEYS = {
+    probe_cordis: 'ID',
+    probe_fluke8846: '*idn?',
+    probe_pace1000: '*idn?',
+    probe_fluke2700: '*idn?',
+    probe_sureflow: '*',
+}
+
+# one query reading the serial number back, to check a cached port without
+# the full signature probe
+SERIAL_QUERIES = {
+    probe_cordis: serial_cordis,
+    probe_fluke8846: serial_idn(probe_fluke8846),
+    probe_pace1000: serial_idn(probe_pace1000),
+    probe_fluke2700: serial_idn(probe_fluke2700),
+    probe_sureflow: serial_sureflow,
+}
+
+CACHE_PATH = os.environ.get('DEVICES_DISCOVERY_CACHE', os.path.join(
+    os.path.expanduser('~'), '.cache', 'Devices', 'discovery.json'))
+
+
+def signatures_for(cls):
+    return [s for s in SIGNATURES if cls in SIGNATURE_CLASSES[s[2]]]
+
+
+def port_infos():
+    return [p for p in comports()
+            if p.device != '/dev/ttyAMA0']
+
+
+def list_ports():
+    return [p.device for p in port_infos()]
+
+
+def hardware_key(info):
+    # stable identity of the adapter rather than of the /dev node, so a
+    # renumbered ttyUSB still hits the cache
+    if info is None:
+        return None
+    if info.vid is None:
+        if not info.hwid or info.hwid == 'n/a':
+            return None
+        return '|'.join([info.hwid, info.device])
+    return '|'.join([info.hwid or '',
+                     '%04X:%04X' % (info.vid, info.pid or 0),
+                     info.serial_number or '',
+                     info.location or ''])
+
+
+class DiscoveryCache:
+    def __init__(self, path=CACHE_PATH):
+        self.Path = path
+        self.Entries = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.Path, 'r') as f:
+                self.Entries = json.load(f)
+        except Exception as ex:
+            self.Entries = {}
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.Path) or '.', exist_ok=True)
+            tmp = self.Path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.Entries, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.Path)
+        except Exception as ex:
+            print('Discovery cache not saved: ' + str(ex))
+        timeout_policy.save()
+
+    def lookup(self, info):
+        entry = self.Entries.get(hardware_key(info))
+        if entry is None or entry.get('class') not in CLASSES:
+            return None
+        return entry
+
+    def store(self, info, cls, sn):
+        key = hardware_key(info)
+        if key is not None:
+            self.Entries[key] = {'class': cls.__name__, 'serial': sn,
+                                 'port': info.device, 'seen': time()}
+
+    def forget(self, info):
+        self.Entries.pop(hardware_key(info), None)
+
+
+def port_available(device):
+    try:
+        with open(device, 'r') as a:
+            if platform.system().lower() != 'windows':
+                fcntl.flock(a.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except Exception as ex:
+        return False
+
+
+def probe_port(device, signatures=SIGNATURES):
+    if not port_available(device):
+        return None
+    try:
+        with serial.Serial(device, signatures[0][0], timeout=signatures[0][1],
+                           write_timeout=signatures[0][1]) as ser:
+            for baud, timeout, probe in signatures:
+                if ser.baudrate != baud:
+                    ser.baudrate = baud
+                kind = SIGNATURE_CLASSES[probe][0].__name__
+                key = SIGNATURE_KEYS[probe]
+                ser.write_timeout = timeout
+                timeout_policy.apply(ser, kind, device, key, timeout)
+                probe_latency.first = None
+                try:
+                    found = probe(ser)
+                except serial.SerialTimeoutException:
+                    continue
+                if found:
+                    # only answers teach the policy; silence on a port
+                    # holding some other instrument says nothing about it
+                    if probe_latency.first is not None:
+                        timeout_policy.record(kind, device, key, probe_latency.first)
+                    return found
+    except Exception as ex:
+        print('No Device: ' + device + ' ' + str(ex))
+    return None
+
+
+def verify_port(device, entry):
+    # one serial number query for the class that answered last time
+    cls = CLASSES[entry['class']]
+    baud, timeout, probe = signatures_for(cls)[0]
+    if not port_available(device):
+        return None
+    try:
+        with serial.Serial(device, baud, timeout=timeout, write_timeout=timeout) as ser:
+            timeout_policy.apply(ser, cls.__name__, device, SIGNATURE_KEYS[probe], timeout)
+            if SERIAL_QUERIES[probe](ser) == entry['serial']:
+                return cls, entry['serial']
+    except Exception as ex:
+        print('No Device: ' + device + ' ' + str(ex))
+    return None
+
+
+def probe_known_port(device, entry):
+    if entry is not None:
+        found = verify_port(device, entry)
+        if found:
+            return found
+    return probe_port(device)
+
+
+def discover(ports=None, max_workers=16, deadline=None, cache=None):
+    # port -> (device class, serial number), probing every port once
+    infos = {p.device: p for p in port_infos()}
+    if ports is None:
+        ports = list(infos)
+    found = {}
+    if not ports:
+        return found
+    pool = ThreadPoolExecutor(max_workers=min(max_workers, len(ports)),
+                              thread_name_prefix='discover')
+    try:
+        futures = {}
+        for d in ports:
+            entry = cache.lookup(infos.get(d)) if cache is not None else None
+            futures[pool.submit(probe_known_port, d, entry)] = d
+        try:
+            for f in as_completed(futures, timeout=deadline):
+                d = futures[f]
+                if f.result():
+                    found[d] = f.result()
+                    if cache is not None and d in infos:
+                        cache.store(infos[d], *f.result())
+                elif cache is not None and d in infos:
+                    cache.forget(infos[d])
+        except FuturesTimeout:
+            print('Discovery deadline reached')
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        if cache is not None:
+            cache.save()
+    return found
+
+
+def find_by_serial(cls, sn, cache=None):
+    # look the instrument up in the cache and verify it without a scan
+    if cache is None:
+        cache = DiscoveryCache()
+    for info in port_infos():
+        entry = cache.lookup(info)
+        if entry and entry['class'] == cls.__name__ and entry['serial'] == sn:
+            if verify_port(info.device, entry):
+                return info.device
+            cache.forget(info)
+            cache.save()
+    return None
+
+
+def open_device(cls, port, sn):
+    if cls in IDENTIFIED:
+        return cls(port, serial_number=sn)
+    return cls(port)
+
+
+def open_devices(found):
+    devices = {}
+    for port, (cls, sn) in found.items():
+        try:
+            devices[port] = open_device(cls, port, sn)
+        except Exception as ex:
+            print('Could not open ' + cls.__name__ + ' on ' + port + ': ' + str(ex))
+    return devices
+
+
+def open_station(ports=None, max_workers=16, deadline=None, cache=None):
+    return open_devices(discover(ports, max_workers, deadline, cache))
+
+
+def open_by_serial(cls, sn, cache=None):
+    port = find_by_serial(cls, sn, cache)
+    if port is None:
+        found = discover(cache=cache if cache is not None else DiscoveryCache())
+        port = next((p for p, (c, s) in found.items()
+                     if c is cls and s == sn), None)
+    return open_device(cls, port, sn) if port is not None else None
+
+
+if __name__ == '__main__':
+    for port, (cls, sn) in sorted(discover(cache=DiscoveryCache()).items()):
+        print(port + ': ' + cls.__name__ + ' ' + sn)
@@ -1,15 +1,38 @@
 import serial
 import serial.tools.list_ports
-from time import time, sleep
+from time import monotonic, time, sleep
 import platform
 
+from AttributeCache import AttributeCache
+from Metrics import metrics
+from Readings import ReadingAttribute, TypedReadings, parse_reading
+from Timeouts import policy as timeout_policy
+from Transport import CordisProtocol, PortLock
+from Transport import query_batch, write_batch
+
 if platform.system().lower() != 'windows':
     import fcntl
 else:
     from fakefcntl import fcntl
 
+# command written by set_* -> attribute it updates
+WRITABLE = {'53455249414C': 'Serial_Number', '4D4F44454C': 'Model_Number',
+            'OUT_LOW': 'Out_Zero', 'OUT_HIGH': 'Out_Fullscale',
+            'SENSOR_LOW': 'Sensor_Zero', 'SENSOR_HIGH': 'Sensor_Fullscale'}
+
+# values get_* may answer from the cache, by command: seconds, or None for
+# until a set_* or get_all_values replaces them
+CACHED = {'ID': None, 'SN': None, 'OUT_LOW': 300.0, 'OUT_HIGH': 300.0,
+          'SENSOR_LOW': 300.0, 'SENSOR_HIGH': 300.0}
+# write command -> the query it changes, where they differ
+READBACK = {'53455249414C': 'SN', '4D4F44454C': 'ID'}
+
+
+class ExternalSensor(CordisProtocol, TypedReadings):
+    Kind = 'ExternalSensor'
+    Readback = READBACK
+    Output = ReadingAttribute()
 
-class ExternalSensor():
     def __init__(self, device):
         self.SerialPort = None
         self.Serial_Number = ''
@@ -20,116 +43,176 @@ class ExternalSensor():
         self.Sensor_Fullscale = ''
         self.Out_Zero = ''
         self.Out_Fullscale = ''
-        self.Waiting = False
+        self.Lock = PortLock()
+        self.AsyncPort = None
+        self.Framer = None
+        self.Worker = None
+        self.Cache = AttributeCache(CACHED)
 
         if device is not None:
             self.SerialPort = serial.Serial(device, 57600, timeout=.4)
             if platform.system().lower() != 'windows':
                 fcntl.flock(self.SerialPort.fileno(),
                             fcntl.LOCK_EX | fcntl.LOCK_NB)
-            self.get_serialnumber()
-            if not 'error' in self.Serial_Number:
-                self.get_all_values()
-                self.Serial_Number = ''
+            self.get_all_values()
         else:
             self.SerialPort = None
             self.Serial_Number = ''
             self.Model_Number = ''
 
+    @property
+    def Waiting(self):
+        return self.Lock.locked()
+
     def reset_serial(self):
-        while self.Waiting:
-            pass
-        self.Waiting = True
-        if self.SerialPort:
-            self.SerialPort.reset_input_buffer()
-            self.SerialPort.reset_output_buffer()
-        self.Waiting = False
+        with self.Lock:
+            if self.SerialPort:
+                self.SerialPort.reset_input_buffer()
+                self.SerialPort.reset_output_buffer()
 
     def get_resp(self, cmd):
         try:
-            while self.Waiting:
-                pass
-            self.reset_serial()
-            self.Waiting = True
             tmpcmd = b'?' + cmd.encode() + b'\r'                        # format command query
-
-            # send command query
-            self.SerialPort.write(tmpcmd)
-            resp = self.SerialPort.read_until(b'\r')
-            self.Waiting = False
-            resp = resp.decode('utf-8')
-            if resp == '' or resp[-1] != '\r':
-                raise Exception('Unexpected Return')
             if 'CUTOFF' in cmd and 'CS-5090' in self.Model_Number:
-                return resp[4:-1]
+                echo = 'CO'
             else:
-                return resp[(len(cmd)+2):-1]
+                echo = cmd
+            with self.Lock:
+                # send command query, skipping any late reply still in the way
+                port = self.SerialPort.port
+                timeout = timeout_policy.timeout('ExternalSensor', port, cmd, .4)
+                start = monotonic()
+                resp = self.framer().query(tmpcmd, echo.encode() + b':', timeout)
+            timeout_policy.observe('ExternalSensor', port, cmd, start, resp is not None, .4)
+            if resp is None:
+                raise Exception('Unexpected Return')
+            return resp.decode('utf-8')[(len(echo)+2):]
         except Exception as ex:
+            metrics.error('ExternalSensor', getattr(self.SerialPort, 'port', None), cmd, ex)
             # self.SerialPort = None
-            self.Waiting = False
             # print('error: ' + type(ex).__name__)
             return 'error: ' + type(ex).__name__
 
+    def get_cached(self, cmd):
+        # slow-changing values are answered from the cache until they expire
+        # or one of our own writes replaces them
+        return self.Cache.fetch(cmd, lambda: self.get_resp(cmd))
+
+    def get_resps(self, cmds, window=8):
+        # pipelined get_resp: all queries go out back-to-back and replies are
+        # matched by their echoed prefix; anything unanswered is retried
+        # one at a time. Each reply is observed and decoded on its own, as
+        # get_resp would, so one bad reply only costs its own retry
+        results = {}
+        answered = False
+        failed = 'error: Exception'
+        port = getattr(self.SerialPort, 'port', None)
+        requests = [(b'?' + cmd.encode() + b'\r', cmd.encode() + b':')
+                    for cmd in cmds]
+        timings = []
+        try:
+            with self.Lock:
+                port = self.SerialPort.port
+                timeout = max(timeout_policy.timeout('ExternalSensor', port, cmd, .4)
+                              for cmd in cmds)
+                replies = query_batch(self.framer(), requests, timeout, window, timings)
+        except Exception as ex:
+            replies = []
+            failed = 'error: ' + type(ex).__name__
+            for cmd in cmds:
+                metrics.error('ExternalSensor', port, cmd, ex)
+        for cmd, reply, (sent, replied) in zip(cmds, replies, timings):
+            timeout_policy.observe('ExternalSensor', port, cmd, sent, reply is not None,
+                                   .4, replied)
+            if reply is None:
+                continue
+            answered = True
+            try:
+                results[cmd] = reply.decode('utf-8')[(len(cmd)+2):]
+            except Exception as ex:
+                metrics.error('ExternalSensor', port, cmd, ex)
+        for cmd in cmds:
+            if cmd not in results:
+                # nothing answered at all: don't wait out every query again
+                results[cmd] = self.get_resp(cmd) if answered else failed
+        return results
+
     def set_value(self, cmd, value):
         try:
-            while self.Waiting:
-                pass
-            self.Waiting = True
-            tmpcmd = b'?' + cmd.encode() + b'\r'                        # format command query
             #  with serial.Serial(self.SerialPort, 57600, timeout=.4) as ser:
             tmpcmd = cmd.encode() + b': ' + str(value).encode() + \
                 b'\r'  # format command query
-            self.SerialPort.write(b'\r')
-            self.SerialPort.read(65535)
-            # send command
-            self.SerialPort.write(tmpcmd)
-            resp = self.SerialPort.read_until(b'\r')
-            self.Waiting = False
-            return resp.decode('utf-8')[(len(cmd)+2):-1]
+            ack = cmd.encode()
+            self.Cache.invalidate(READBACK.get(cmd, cmd))
+            with self.Lock:
+                port = self.SerialPort.port
+                timeout = timeout_policy.timeout('ExternalSensor', port, cmd + ':', .4)
+                start = monotonic()
+                # the leading \r still clears a partial line on the board; its
+                # reply, and a stale 'CMD: value' read reply, are skipped by
+                # the framer: only the 'CMD: CMD' echo acknowledges the write
+                resp = self.framer().query(
+                    b'\r' + tmpcmd, lambda f: f[len(ack) + 2:] == ack, timeout)
+            timeout_policy.observe('ExternalSensor', port, cmd + ':', start, resp is not None, .4)
+            if resp is None:
+                return ''
+            return resp.decode('utf-8')[(len(cmd)+2):]
         except Exception as ex:
+            metrics.error('ExternalSensor', getattr(self.SerialPort, 'port', None), cmd + ':', ex)
             # self.SerialPort = None
-            self.Waiting = False
             return 'error'
 
+    def write_parameters(self, values, retries=2, save=False, window=8):
+        # values: {command: value}, written pipelined and each verified by
+        # its echo; see Transport.write_batch
+        return write_batch(self, 'ExternalSensor', values, READBACK, WRITABLE,
+                           retries, save, window)
+
     def get_id(self):
         r = ''
-        r = self.get_resp('ID')
+        r = self.get_cached('ID')
         self.Model_Number = r
         return r
 
     def get_serialnumber(self):
         r = ''
-        r = self.get_resp('SN')
+        r = self.get_cached('SN')
         self.Serial_Number = r
         return r
 
     def get_outzero(self):
         r = ''
-        r = self.get_resp('OUT_LOW')
+        r = self.get_cached('OUT_LOW')
         self.Out_Zero = r
         return r
 
     def get_outfullscale(self):
         r = ''
-        r = self.get_resp('OUT_HIGH')
+        r = self.get_cached('OUT_HIGH')
         self.Out_Fullscale = r
         return r
 
     def get_sensorzero(self):
         r = ''
-        r = self.get_resp('SENSOR_LOW')
+        r = self.get_cached('SENSOR_LOW')
         self.Sensor_Zero = r
         return r
 
     def get_sensorfullscale(self):
         r = ''
-        r = self.get_resp('SENSOR_HIGH')
+        r = self.get_cached('SENSOR_HIGH')
         self.Sensor_Fullscale = r
         return r
 
-    def get_status(self):
-        r = ':  :  :'
-        r = self.get_resp('STAT')
+    def get_status(self, typed=False):
+        r = self.parse_status(self.get_resp('STAT'))
+        return self.reading('Output') if typed else r
+
+    async def get_status_async(self, typed=False):
+        r = self.parse_status(await self.get_resp_async('STAT'))
+        return self.reading('Output') if typed else r
+
+    def parse_status(self, r):
         s = 'Err'
         sl = 'Err'
         sh = 'Err'
@@ -145,7 +228,7 @@ class ExternalSensor():
                 oh = r.split(' | ')[4].split('::')[1].strip()
             except Exception as ex:
                 pass
-            self.Output = str(s)
+            self.Output = parse_reading(s, '', self.Serial_Number)
             self.Sensor_Zero = str(sl)
             self.Sensor_Fullscale = str(sh)
             self.Out_Zero = str(ol)
@@ -215,15 +298,10 @@ class ExternalSensor():
     def save(self):
         try:
             # with serial.Serial(self.SerialPort, 57600, timeout=.5, write_timeout=.5) as ser:
-            while self.Waiting:
-                pass
-            self.Waiting = True
-            self.SerialPort.write(b'SAVE\r')
-            resp = self.SerialPort.read_until(b'\r')
-            self.Waiting = False
-            return resp.decode('utf-8')
+            with self.Lock:
+                resp = self.framer().query(b'SAVE\r', None, .4)
+            return (resp + b'\r').decode('utf-8') if resp is not None else ''
         except:
-            self.Waiting = False
             return 'error'
 
     def is_connected(self):
@@ -235,13 +313,20 @@ class ExternalSensor():
 
     def get_all_values(self):
         self.empty_values()
-        self.get_serialnumber()
+        r = self.get_resps(['SN', 'ID'])
+        self.Cache.invalidate()
+        for cmd in r:
+            self.Cache.put(cmd, r[cmd])
+        self.Serial_Number = r['SN']
         if not 'error' in self.Serial_Number:
-            self.get_id()
-            self.get_outzero()
-            self.get_outfullscale()
-            self.get_sensorzero()
-            self.get_sensorfullscale()
+            self.Model_Number = r['ID']
+            r = self.get_resps(['OUT_LOW', 'OUT_HIGH', 'SENSOR_LOW', 'SENSOR_HIGH'])
+            for cmd in r:
+                self.Cache.put(cmd, r[cmd])
+            self.Out_Zero = r['OUT_LOW']
+            self.Out_Fullscale = r['OUT_HIGH']
+            self.Sensor_Zero = r['SENSOR_LOW']
+            self.Sensor_Fullscale = r['SENSOR_HIGH']
         else:
             self.Serial_Number = ''
 
@@ -254,8 +339,15 @@ class ExternalSensor():
         self.Out_Zero = ''
         self.Out_Fullscale = ''
 
-    def update_values(self):
+    def update_values(self, typed=False):
         self.get_status()
+        if typed:
+            return self.reading('Output')
+
+    async def update_values_async(self, typed=False):
+        await self.get_status_async()
+        if typed:
+            return self.reading('Output')
 
 
 if __name__ == '__main__':
@@ -1,16 +1,30 @@
 import serial
-import serial.tools.list_ports
-from time import sleep
+from time import monotonic, sleep
 import platform
 
+from AttributeCache import AttributeCache
+from Metrics import metrics
+from Readings import Reading, ReadingAttribute, TypedReadings, parse_reading
+from Timeouts import policy as timeout_policy
+from Transport import CommandProtocol, PortLock, comports
+
 if platform.system().lower() != 'windows':
     import fcntl
 else:
     from fakefcntl import fcntl
 
+# seconds a unit seen in a val? reply is trusted by read_unit
+CACHED = {'unit': 10.0}
+
+
+class Fluke2700(CommandProtocol, TypedReadings):
+    Kind = 'Fluke2700'
+    Fallback = .3
+    ErrorReply = 'Err,Err'
+    Pressure = ReadingAttribute()
+    Value = ReadingAttribute(history=False)     # alias of Pressure for ControlBox
 
-class Fluke2700:
-    def __init__(self, port):
+    def __init__(self, port, serial_number=None):
         self.DevicePort = ''
         self.SerialNumber = '-'
         self.Device_Type = 'Measurement'
@@ -18,121 +32,117 @@ class Fluke2700:
         self.Value = ''
         self.Unit = ''
         self.SerialPort = None
-        self.Waiting = False
+        self.Lock = PortLock()
+        self.AsyncPort = None
+        self.Framer = None
+        self.Worker = None
+        self.Cache = AttributeCache(CACHED)
         resp = b''
-        try:
-            with serial.Serial(port, 9600, timeout=.3) as ser:
-                ser.write(b'\r*idn?\r')
-                resp = ser.read_until(b'\r')
-        except Exception as ex:
-            self.SerialPort = None
-        if resp.decode('utf-8')[:11] == 'FLUKE,2700G':  # check for fluke response
-            self.DevicePort = port
-            # Update class variables if its a fluke
+        if serial_number is None:    # not already identified by Discovery
             try:
-                self.SerialNumber = resp.decode('utf-8').split(',')[2]
-            except:
-                self.SerialNumber = '----------'
+                with serial.Serial(port, 9600, timeout=.3) as ser:
+                    timeout_policy.apply(ser, 'Fluke2700', port, '*idn?', .3)
+                    start = monotonic()
+                    ser.write(b'\r*idn?\r')
+                    resp = ser.read_until(b'\r')
+            except Exception as ex:
+                self.SerialPort = None
+            if resp.decode('utf-8')[:11] == 'FLUKE,2700G':  # check for fluke response
+                timeout_policy.observe('Fluke2700', port, '*idn?', start, True, .3)
+                # Update class variables if its a fluke
+                try:
+                    serial_number = resp.decode('utf-8').split(',')[2]
+                except:
+                    serial_number = '----------'
+        if serial_number is not None:
+            self.DevicePort = port
+            self.SerialNumber = serial_number
             self.SerialPort = serial.Serial(self.DevicePort, 9600, timeout=.3)
             fcntl.flock(self.SerialPort.fileno(),
                         fcntl.LOCK_EX | fcntl.LOCK_NB)
             # print('Fluke2700G: ' + str(p.device))
 
+    @property
+    def Waiting(self):
+        return self.Lock.locked()
+
     def reset_serial(self):
-        while self.Waiting:
-            pass
-        self.Waiting = True
-        if self.SerialPort:
-            self.SerialPort.reset_input_buffer()
-            self.SerialPort.reset_output_buffer()
-            pass
-        self.Waiting = False
+        with self.Lock:
+            if self.SerialPort:
+                self.SerialPort.reset_input_buffer()
+                self.SerialPort.reset_output_buffer()
 
     def read_command(self, cmd):
-        while self.Waiting:
-            pass
-        self.Waiting = True
         try:
-            if self.SerialPort:
-                send_bytes = b'\r' + cmd + b'\r'
-                self.SerialPort.write(send_bytes)
-                resp = self.SerialPort.read_until(b'\r')
-                resp = resp.decode('utf-8')
-                if resp == '' or resp[-1] != '\r':
-                    raise Exception('Unexpected Return')
-                self.Waiting = False
-                return resp
-            else:
-                self.Waiting = False
-                return "Err,Err"
-        except:
+            with self.Lock:
+                if self.SerialPort:
+                    send_bytes = b'\r' + cmd + b'\r'
+                    key = cmd.decode()
+                    timeout = timeout_policy.timeout('Fluke2700', self.DevicePort, key, .3)
+                    start = monotonic()
+                    resp = self.framer().query(send_bytes, None, timeout)
+                    timeout_policy.observe('Fluke2700', self.DevicePort, key, start,
+                                           resp is not None, .3)
+                    if resp is None:
+                        raise Exception('Unexpected Return')
+                    return (resp + b'\r').decode('utf-8')
+                else:
+                    return "Err,Err"
+        except Exception as ex:
+            metrics.error('Fluke2700', getattr(self.SerialPort, 'port', None), cmd.decode(), ex)
             # if self.SerialPort:
             #     self.SerialPort.close()
             # self.SerialPort = None
-            self.Waiting = False
             return 'Err,Err'
 
     def write_command(self, cmd):
-        while self.Waiting:
-            pass
-        self.Waiting = True
         try:
-            if self.SerialPort:
-                self.SerialPort.write(b'\r' + cmd + b'\r')
-            self.Waiting = False
+            with self.Lock:
+                if self.SerialPort:
+                    self.SerialPort.write(b'\r' + cmd + b'\r')
         except:
             # if self.SerialPort:
             #     self.SerialPort.close()
             # self.SerialPort = None
-            self.Waiting = False
             return 'Err,Err'
 
     def find_device(self):
-        while self.Waiting:
-            pass
-        self.Waiting = True
-        for p in serial.tools.list_ports.comports():
-            try:
-                if p.device == '/dev/ttyAMA0':
+        with self.Lock:
+            for p in comports():
+                try:
+                    if p.device == '/dev/ttyAMA0':
+                        continue
+                    with open(p.device, 'r') as a:
+                        fcntl.flock(a.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        a = 1234  # Not sure what is happening here but with only an flock it freezes
+                except:
                     continue
-                with open(p.device, 'r') as a:
-                    fcntl.flock(a.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-                    a = 1234  # Not sure what is happening here but with only an flock it freezes
-            except:
-                continue
-            try:
-                with serial.Serial(p.device, 9600, timeout=.2) as ser:
-                    ser.write(b'\r*idn?\r')
-                    resp = ser.read_until(b'\r')
-            except:                     # to broad of an exception ... but if it fails we should just move on
-                self.SerialPort = None
-                continue
-            if resp.decode('utf-8')[:11] == 'FLUKE,2700G':  # check for fluke response
-                self.DevicePort = p.device
-                # Update class variables if its a fluke
-                self.SerialNumber = resp.decode('utf-8').split(',')[2]
-                self.SerialPort = serial.Serial(
-                    self.DevicePort, 9600, timeout=.2)
-                fcntl.flock(self.SerialPort.fileno(),
-                            fcntl.LOCK_EX | fcntl.LOCK_NB)
-                self.Waiting = False
-                return True
-        self.Waiting = False
-        return False
-
-    def read_pressure(self):
-        r = self.read_command(b'val?')
-        if r != 'Err,Err' and r != '' and ',' in r:
-            try:
-                self.Pressure = str(float(r.split(',')[0]))
-                self.Value = self.Pressure                  # for ControlBox Compatibility
-            except:
-                return 'Err'
-        else:
-            return 'Err'
-        return self.Pressure
+                try:
+                    with serial.Serial(p.device, 9600, timeout=.2) as ser:
+                        timeout_policy.apply(ser, 'Fluke2700', p.device, '*idn?', .2)
+                        start = monotonic()
+                        ser.write(b'\r*idn?\r')
+                        resp = ser.read_until(b'\r')
+                except:                     # to broad of an exception ... but if it fails we should just move on
+                    self.SerialPort = None
+                    continue
+                if resp.decode('utf-8')[:11] == 'FLUKE,2700G':  # check for fluke response
+                    timeout_policy.observe('Fluke2700', p.device, '*idn?', start, True, .2)
+                    self.DevicePort = p.device
+                    # Update class variables if its a fluke
+                    self.SerialNumber = resp.decode('utf-8').split(',')[2]
+                    self.SerialPort = serial.Serial(
+                        self.DevicePort, 9600, timeout=.2)
+                    fcntl.flock(self.SerialPort.fileno(),
+                                fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return True
+            return False
 
     def read_unit(self):
+        unit = self.Cache.get('unit')
+        if unit is not None:
+            self.Unit = unit
+            return unit
         r = self.read_command(b'val?')
         self.Unit = 'Err'
         if r != 'Err,Err' and r != '' and ',' in r:
@@ -144,30 +154,45 @@ class Fluke2700:
             return 'Err'
         return self.Unit
 
-    def read_pressure(self):
-        r = self.read_command(b'val?')
+    def read_pressure(self, typed=False):
+        r = self.parse_pressure(self.read_command(b'val?'))
+        return self.reading('Pressure') if typed else r
+
+    async def read_pressure_async(self, typed=False):
+        r = self.parse_pressure(await self.read_command_async(b'val?'))
+        return self.reading('Pressure') if typed else r
+
+    def parse_pressure(self, r):
         self.Pressure = 'Err'
         self.Value = self.Pressure                  # for ControlBox Compatibility
         if r != 'Err,Err' and r != '' and ',' in r:
             try:
-                self.Pressure = str(float(r.split(',')[0]))
-                self.Value = self.Pressure                  # for ControlBox Compatibility
+                self.Pressure = Reading(float(r.split(',')[0]), self.Unit, self.SerialNumber)
+                self.Value = self.reading('Pressure')       # for ControlBox Compatibility
             except:
                 return 'Err'
         else:
             return 'Err'
         return self.Pressure
 
-    def update_values(self):
-        r = self.read_command(b'val?')
+    def update_values(self, typed=False):
+        r = self.parse_values(self.read_command(b'val?'))
+        return self.reading('Pressure') if typed else r
+
+    async def update_values_async(self, typed=False):
+        r = self.parse_values(await self.read_command_async(b'val?'))
+        return self.reading('Pressure') if typed else r
+
+    def parse_values(self, r):
         self.Pressure = 'Err'
         self.Value = self.Pressure                  # for ControlBox Compatibility
         self.Unit = 'Err'
         if r != 'Err,Err' and r != '' and ',' in r:
             try:
-                self.Pressure = str(float(r.split(',')[0]))
-                self.Value = self.Pressure                  # for ControlBox Compatibility
                 self.Unit = r.split(',')[1].strip()
+                self.Pressure = Reading(float(r.split(',')[0]), self.Unit, self.SerialNumber)
+                self.Value = self.reading('Pressure')       # for ControlBox Compatibility
+                self.Cache.put('unit', self.Unit)
             except:
                 self.Pressure = 'Err'
                 self.Value = self.Pressure                  # for ControlBox Compatibility
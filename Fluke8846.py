@@ -1,140 +1,179 @@
 import serial
-import serial.tools.list_ports
 import platform
+from time import monotonic, sleep
+
+from AttributeCache import AttributeCache
+from Metrics import metrics
+from Readings import Reading, ReadingAttribute, TypedReadings, parse_reading
+from Timeouts import policy as timeout_policy
+from Transport import CommandProtocol, PortLock, comports
 
 if platform.system().lower() != 'windows':
     import fcntl
 else:
     from fakefcntl import fcntl
 
+# seconds the CONF? reply is trusted between polls
+CACHED = {'config': 30.0}
+
+# fastest buffered reading rate of the 8846A, seconds per reading
+MIN_INTERVAL = .001
+
+
+def parse_readings(r):
+    # comma-separated readings, optionally wrapped in a #<n><length> block,
+    # as a float array (numpy is only needed for streaming)
+    import numpy
+    r = r.strip()
+    if r[:1] == '#':
+        r = r[2 + int(r[1]):]
+    if not r:
+        return numpy.empty(0)
+    return numpy.array(r.split(','), dtype=float)
 
-class Fluke8846:
-    def __init__(self, port):
+
+class Fluke8846(CommandProtocol, TypedReadings):
+    Kind = 'Fluke8846'
+    Fallback = 1
+    DropFailedPort = True
+    Value = ReadingAttribute()
+
+    def __init__(self, port, serial_number=None):
         self.DevicePort = ''
         self.SerialNumber = '-'
         self.Device_Type = 'Electrical'
         self.Value = '0'
         self.Unit = 'V'
         self.SerialPort = None
-        self.Waiting = False
+        self.Lock = PortLock()
+        self.AsyncPort = None
+        self.Framer = None
+        self.Worker = None
+        self.Cache = AttributeCache(CACHED)
+        self.Streaming = False
+        self.StreamFunction = 'VOLT:DC'
+        self.StreamSamples = 0
+        self.StreamRead = 0
+        self.StreamStart = 0.0
+        self.StreamInterval = MIN_INTERVAL
+        self.LineFrequency = 60     # Hz, sets the NPLC integration time
         resp = b''
-        try:
-            with serial.Serial(port, 57600, timeout=1, write_timeout=1) as ser:
-                ser.write(b'\r*idn?\r')
-                resp = ser.read_until(terminator=b'\r')
-        except:                     # to broad of an exception ... but if it fails we should just move on
-            self.SerialPort = None
-        if resp.decode('utf-8')[:11] == 'FLUKE,8846A':  # check for fluke response
+        if serial_number is None:    # not already identified by Discovery
+            try:
+                with serial.Serial(port, 57600, timeout=1, write_timeout=1) as ser:
+                    timeout_policy.apply(ser, 'Fluke8846', port, '*idn?', 1)
+                    start = monotonic()
+                    ser.write(b'\r*idn?\r')
+                    resp = ser.read_until(b'\r')
+            except:                     # to broad of an exception ... but if it fails we should just move on
+                self.SerialPort = None
+            if resp.decode('utf-8')[:11] == 'FLUKE,8846A':  # check for fluke response
+                timeout_policy.observe('Fluke8846', port, '*idn?', start, True, 1)
+                # Update class variables if its a fluke
+                serial_number = resp.decode('utf-8').split(',')[2]
+        if serial_number is not None:
             self.DevicePort = port
-            # Update class variables if its a fluke
-            self.SerialNumber = resp.decode('utf-8').split(',')[2]
+            self.SerialNumber = serial_number
             self.SerialPort = serial.Serial(
                 self.DevicePort, 57600, timeout=1, write_timeout=1)
             fcntl.flock(self.SerialPort.fileno(),
                         fcntl.LOCK_EX | fcntl.LOCK_NB)
-            self.Waiting = False
+
+    @property
+    def Waiting(self):
+        return self.Lock.locked()
 
     def reset_serial(self):
-        while self.Waiting:
-            pass
-        self.Waiting = True
-        if self.SerialPort:
-            self.SerialPort.reset_input_buffer()
-            self.SerialPort.reset_output_buffer()
-        self.Waiting = False
+        with self.Lock:
+            if self.SerialPort:
+                self.SerialPort.reset_input_buffer()
+                self.SerialPort.reset_output_buffer()
 
     def read_command(self, cmd):
-        while self.Waiting:
-            pass
-        self.Waiting = True
         try:
-            if self.SerialPort:
-                self.SerialPort.write(b'\r' + cmd + b'\r')
-                resp = self.SerialPort.read_until(terminator=b'\r')
-                resp = resp.decode('utf-8')
-                if resp == '' or resp[-1] != '\r':
-                    raise Exception('Unexpected Return')
-                self.Waiting = False
-                return resp
-            else:
-                self.Waiting = False
-                return "Err"
-        except:
-            if self.SerialPort:
-                self.SerialPort.close()
-            self.SerialPort = None
-            self.Waiting = False
+            with self.Lock:
+                if self.SerialPort:
+                    key = cmd.decode()
+                    port = self.SerialPort.port
+                    timeout = timeout_policy.timeout('Fluke8846', port, key, 1)
+                    start = monotonic()
+                    resp = self.framer().query(b'\r' + cmd + b'\r', None, timeout)
+                    timeout_policy.observe('Fluke8846', port, key, start, resp is not None, 1)
+                    if resp is None:
+                        raise Exception('Unexpected Return')
+                    return (resp + b'\r').decode('utf-8')
+                else:
+                    return "Err"
+        except Exception as ex:
+            metrics.error('Fluke8846', getattr(self.SerialPort, 'port', None), cmd.decode(), ex)
+            # a late reply under a learned deadline is not a lost meter
+            self.drop_port(ex)
             return 'Err'
 
     def write_command(self, cmd):
-        while self.Waiting:
-            pass
-        self.Waiting = True
         try:
-            if self.SerialPort:
-                self.SerialPort.write(b'\r' + cmd + b'\r')
-            self.Waiting = False
-        except:
-            if self.SerialPort:
-                self.SerialPort.close()
-            self.SerialPort = None
-            self.Waiting = False
+            with self.Lock:
+                if self.SerialPort:
+                    self.SerialPort.write(b'\r' + cmd + b'\r')
+        except Exception as ex:
+            self.drop_port(ex)
             return 'Err'
 
     def find_device(self):
-        while self.Waiting:
-            pass
-        self.Waiting = True
-        for p in serial.tools.list_ports.comports():
-            if p.device == '/dev/ttyAMA0':
-                continue
-            try:
-                with open(p.device, 'r') as a:
-                    fcntl.flock(a.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-            except:
-                continue
-            try:
-                with serial.Serial(p.device, 57600, timeout=1, write_timeout=1) as ser:
-                    ser.write(b'\r*idn?\r')
-                    resp = ser.read_until(terminator=b'\r')
-            except:                     # to broad of an exception ... but if it fails we should just move on
-                self.SerialPort = None
-                continue
-            if resp.decode('utf-8')[:11] == 'FLUKE,8846A':  # check for fluke response
-                self.DevicePort = p
-                # Update class variables if its a fluke
+        with self.Lock:
+            for p in comports():
+                if p.device == '/dev/ttyAMA0':
+                    continue
                 try:
-                    self.SerialNumber = resp.decode('utf-8').split(',')[2]
+                    with open(p.device, 'r') as a:
+                        fcntl.flock(a.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
                 except:
-                    self.SerialNumber = '----------'
-                self.SerialPort = serial.Serial(
-                    self.DevicePort.device, 57600, timeout=1, write_timeout=1)
-                fcntl.flock(self.SerialPort.fileno(),
-                            fcntl.LOCK_EX | fcntl.LOCK_NB)
-                self.Waiting = False
-                return True
-        self.Waiting = False
-        return False
-
-    def read_volts_dc(self):
+                    continue
+                try:
+                    with serial.Serial(p.device, 57600, timeout=1, write_timeout=1) as ser:
+                        timeout_policy.apply(ser, 'Fluke8846', p.device, '*idn?', 1)
+                        start = monotonic()
+                        ser.write(b'\r*idn?\r')
+                        resp = ser.read_until(b'\r')
+                except:                     # to broad of an exception ... but if it fails we should just move on
+                    self.SerialPort = None
+                    continue
+                if resp.decode('utf-8')[:11] == 'FLUKE,8846A':  # check for fluke response
+                    timeout_policy.observe('Fluke8846', p.device, '*idn?', start, True, 1)
+                    self.DevicePort = p
+                    # Update class variables if its a fluke
+                    try:
+                        self.SerialNumber = resp.decode('utf-8').split(',')[2]
+                    except:
+                        self.SerialNumber = '----------'
+                    self.SerialPort = serial.Serial(
+                        self.DevicePort.device, 57600, timeout=1, write_timeout=1)
+                    fcntl.flock(self.SerialPort.fileno(),
+                                fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return True
+            return False
+
+    def read_volts_dc(self, typed=False):
         # with serial.Serial(self.device_port.device, 57600, timeout=.4, write_timeout=.2) as ser:
         #     ser.write(b'\rMEAS?\r')
         #     resp = ser.read_until(terminator=b'\r')
         self.set_remote()
+        self.Cache.invalidate('config')             # MEAS? reconfigures the meter
         r = self.read_command(b'MEAS:VOLT:DC?')
         self.set_local()
-        self.Value = r
-        return r
+        self.Value = parse_reading(r, 'V', self.SerialNumber)
+        return self.reading('Value') if typed else r
 
-    def read_current_dc(self):
+    def read_current_dc(self, typed=False):
         # with serial.Serial(self.device_port.device, 57600, timeout=.4, write_timeout=.2) as ser:
         #     ser.write(b'\rMEAS?\r')
         #     resp = ser.read_until(terminator=b'\r')
         self.set_remote()
+        self.Cache.invalidate('config')
         r = self.read_command(b'MEAS:CURR:DC?')
         self.set_local()
-        self.Value = str(float(r)*1000)
-        return r
+        self.Value = parse_reading(r, 'mA', self.SerialNumber, 1000)
+        return self.reading('Value') if typed else r
 
     def set_remote(self):
         # with serial.Serial(self.device_port.device, 57600, timeout=.2, write_timeout=.2) as ser:
@@ -142,8 +181,18 @@ class Fluke8846:
         #     resp = ser.read_until(terminator=b'\r')
         self.write_command(b'SYST:REM')
 
-    def update_values(self):
-        r = self.read_command(b'CONF?')
+    def update_values(self, typed=False):
+        self.parse_unit(self.Cache.fetch('config', lambda: self.read_command(b'CONF?')))
+        r = self.parse_value(self.read_command(b'FETCH3?'))
+        return self.reading('Value') if typed else r
+
+    async def update_values_async(self, typed=False):
+        self.parse_unit(await self.Cache.fetch_async(
+            'config', lambda: self.read_command_async(b'CONF?')))
+        r = self.parse_value(await self.read_command_async(b'FETCH3?'))
+        return self.reading('Value') if typed else r
+
+    def parse_unit(self, r):
         try:
             self.Unit = r.split(' ')[0][1:].strip()
             if self.Unit == 'r':
@@ -154,27 +203,118 @@ class Fluke8846:
         except Exception as ex:
             self.Unit = ''
 
-        r = self.read_command(b'FETCH3?')
-        self.Value = r.strip()
-        if 'mA' in self.Unit:
-            try:
-                self.Value = str(float(self.Value)*1000)
-            except Exception as ex:
-                self.Value = 'Err'
+    def parse_value(self, r):
+        # the meter reports amps; mA readings are scaled once, here
+        scale = 1000 if 'mA' in self.Unit else None
+        self.Value = parse_reading(r.strip(), self.Unit, self.SerialNumber, scale)
         return r
 
     def set_current(self):
         self.set_remote()
+        self.Cache.invalidate('config')
         self.write_command(b'CONF:CURR:DC')
         self.Unit = 'mA'
         self.set_local()
 
     def set_voltage(self):
         self.set_remote()
+        self.Cache.invalidate('config')
         self.write_command(b'CONF:VOLT:DC')
         self.Unit = 'V'
         self.set_local()
 
+    def configure_stream(self, function='VOLT:DC', measure_range=None, nplc=1,
+                         samples=1000, interval=None):
+        # one-time setup for buffered acquisition: the meter takes `samples`
+        # readings into its memory after a single INIT instead of being
+        # reconfigured by MEAS? for every reading. measure_range None = auto.
+        # interval: seconds per reading, if known better than nplc / mains
+        self.Cache.invalidate('config')
+        conf = b'CONF:' + function.encode()
+        if measure_range is not None:
+            conf += b' ' + str(measure_range).encode()
+        for cmd in (b'SYST:REM', b'*CLS', conf,
+                    function.encode() + b':NPLC ' + str(nplc).encode(),
+                    b'TRIG:SOUR IMM', b'TRIG:DEL 0', b'TRIG:COUN 1',
+                    b'SAMP:COUN ' + str(samples).encode()):
+            if self.write_command(cmd) == 'Err':
+                return 1
+        self.StreamFunction = function
+        self.StreamSamples = samples
+        if interval is None:
+            interval = max(float(nplc) / self.LineFrequency, MIN_INTERVAL)
+        self.StreamInterval = interval
+        self.Unit = 'mA' if 'CURR' in function else 'V'
+        return 0
+
+    def start_stream(self):
+        if self.write_command(b'INIT') == 'Err':
+            return 1
+        self.Streaming = True
+        self.StreamRead = 0
+        self.StreamStart = monotonic()     # trigger source is IMM
+        return 0
+
+    def read_stream(self, max_points=None):
+        # pull whatever is in reading memory in one transfer. Returns
+        # (timestamps, values) arrays; reading k is stamped INIT time +
+        # k * sample interval (host monotonic), values are in self.Unit
+        import numpy
+        stamps = values = numpy.empty(0)
+        try:
+            with self.Lock:
+                framer = self.framer()
+                n = int(framer.query(b'\rDATA:POIN?\r', None, 1).decode('utf-8'))
+                if max_points:
+                    n = min(n, max_points)
+                if n:
+                    # ~16 characters per reading on the wire
+                    timeout = 1 + n * 160.0 / self.SerialPort.baudrate
+                    resp = framer.query(b'\rR? ' + str(n).encode() + b'\r', None, timeout)
+                    values = parse_readings(resp.decode('utf-8'))
+            if len(values):
+                if 'CURR' in self.StreamFunction:
+                    values = values * 1000
+                index = numpy.arange(self.StreamRead + 1, self.StreamRead + len(values) + 1)
+                stamps = self.StreamStart + index * self.StreamInterval
+                self.StreamRead += len(values)
+                self.Value = Reading(float(values[-1]), self.Unit, self.SerialNumber)
+        except Exception as ex:
+            stamps = values = numpy.empty(0)
+        if self.StreamRead >= self.StreamSamples:
+            self.Streaming = False
+        return stamps, values
+
+    def stop_stream(self):
+        self.write_command(b'ABOR')
+        self.set_local()
+        self.Streaming = False
+
+    def acquire(self, samples=1000, function='VOLT:DC', measure_range=None,
+                nplc=.02, block=500, timeout=None, interval=None):
+        # configure, trigger and read back a whole buffered capture, e.g. for
+        # ripple or settling of a valve drive output
+        import numpy
+        if timeout is None:
+            timeout = 5 + samples * (nplc / 50.0 + .005) * 2
+        stamps = []
+        values = []
+        if self.configure_stream(function, measure_range, nplc, samples, interval) or \
+                self.start_stream():
+            return numpy.empty(0), numpy.empty(0)
+        deadline = monotonic() + timeout
+        while self.Streaming and monotonic() < deadline:
+            t, v = self.read_stream(block)
+            if not len(v):
+                sleep(.01)
+                continue
+            stamps.append(t)
+            values.append(v)
+        self.stop_stream()
+        if not values:
+            return numpy.empty(0), numpy.empty(0)
+        return numpy.concatenate(stamps), numpy.concatenate(values)
+
     def set_local(self):
         # with serial.Serial(self.device_port.device, 57600, timeout=.2, write_timeout=.2) as ser:
         #     ser.write(b'\rSYST:LOC\r')
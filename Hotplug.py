@@ -0,0 +1,183 @@
+import ctypes
+import ctypes.util
+import os
+import platform
+import select
+import struct
+import threading
+from time import sleep
+
+import Discovery
+
+IN_ATTRIB = 0x004
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def inotify_dev(path='/dev'):
+    # returns a non-blocking inotify fd watching path, or None if inotify is
+    # not available (non-Linux hosts fall back to polling the inventory)
+    if platform.system().lower() != 'linux':
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        mask = IN_CREATE | IN_DELETE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO
+        if libc.inotify_add_watch(fd, path.encode(), mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except Exception as ex:
+        return None
+
+
+def drain_events(fd):
+    names = []
+    while True:
+        try:
+            data = os.read(fd, 4096)
+        except BlockingIOError:
+            return names
+        i = 0
+        while i + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, i)
+            i += EVENT_HEADER.size
+            names.append(data[i:i + length].rstrip(b'\0').decode('utf-8', 'replace'))
+            i += length
+
+
+def inventory():
+    # port -> hardware identity; cheap, never opens a port
+    return {p.device: Discovery.hardware_key(p) or p.device
+            for p in Discovery.port_infos()}
+
+
+def close_device(device):
+    try:
+        if device.SerialPort:
+            device.SerialPort.close()
+    except Exception as ex:
+        pass
+    device.SerialPort = None
+
+
+class HotplugWatcher:
+    def __init__(self, on_added=None, on_removed=None, cache=None,
+                 initial=True, settle=.05, poll_interval=1.0):
+        self.OnAdded = on_added
+        self.OnRemoved = on_removed
+        self.Cache = cache
+        self.Initial = initial
+        self.Settle = settle
+        self.PollInterval = poll_interval
+        self.Devices = {}
+        self.Inventory = {}
+        self.Failed = set()         # ports to probe again on the next event
+        self.Lock = threading.Lock()
+        self.Thread = None
+        self.Stop = threading.Event()
+        self.Fd = None
+
+    def start(self):
+        self.Stop.clear()
+        self.Fd = inotify_dev()
+        self.Failed = set()
+        if self.Initial:
+            self.Inventory = {}
+            self.refresh()
+        else:
+            self.Inventory = inventory()
+        self.Thread = threading.Thread(target=self.run, name='hotplug',
+                                       daemon=True)
+        self.Thread.start()
+        return self
+
+    def stop(self, close=False):
+        self.Stop.set()
+        if self.Thread:
+            self.Thread.join()
+            self.Thread = None
+        if self.Fd is not None:
+            os.close(self.Fd)
+            self.Fd = None
+        if close:
+            with self.Lock:
+                for device in self.Devices.values():
+                    close_device(device)
+                self.Devices = {}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def run(self):
+        while not self.Stop.is_set():
+            if self.Fd is None:
+                self.Stop.wait(self.PollInterval)
+            else:
+                r, w, x = select.select([self.Fd], [], [], .25)
+                if not r:
+                    continue
+                drain_events(self.Fd)
+                # let udev finish creating links and setting permissions
+                sleep(self.Settle)
+                drain_events(self.Fd)
+            try:
+                self.refresh()
+            except Exception as ex:
+                print('Hotplug refresh failed: ' + str(ex))
+
+    def refresh(self):
+        current = inventory()
+        removed = [p for p, k in self.Inventory.items() if current.get(p) != k]
+        added = [p for p, k in current.items() if self.Inventory.get(p) != k]
+        self.Inventory = current
+        # a port whose probe or open failed (still enumerating, busy) is
+        # tried again on the next event; polling without a change is none
+        retry = [p for p in self.Failed if p in current and p not in added]
+        if self.Fd is None and not added and not removed:
+            retry = []
+        self.Failed = set(p for p in self.Failed if p in current)
+        for port in removed:
+            with self.Lock:
+                device = self.Devices.pop(port, None)
+            if device is not None:
+                close_device(device)
+                if self.OnRemoved:
+                    self.OnRemoved(port, device)
+        probe = added + retry
+        if not probe:
+            return
+        self.Failed.update(probe)
+        found = Discovery.discover(probe, cache=self.Cache)
+        opened = Discovery.open_devices(found)
+        self.Failed.difference_update(opened)
+        for port, device in opened.items():
+            with self.Lock:
+                self.Devices[port] = device
+            if self.OnAdded:
+                self.OnAdded(port, device)
+
+    def devices(self):
+        with self.Lock:
+            return dict(self.Devices)
+
+
+if __name__ == '__main__':
+    def added(port, device):
+        print('+ ' + port + ': ' + type(device).__name__)
+
+    def removed(port, device):
+        print('- ' + port + ': ' + type(device).__name__)
+
+    with HotplugWatcher(added, removed, Discovery.DiscoveryCache()):
+        while True:
+            sleep(1)
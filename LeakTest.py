@@ -0,0 +1,129 @@
+from statistics import NormalDist
+from time import monotonic, sleep
+
+from Readings import Reading, timed_value
+
+
+class SlopeFit:
+    # Incremental least-squares line through (t, v) samples. Sums are kept
+    # centred on the first sample so long tests stay well conditioned.
+    def __init__(self):
+        self.N = 0
+        self.T0 = None
+        self.V0 = None
+        self.St = self.Sv = self.Stt = self.Stv = self.Svv = 0.0
+
+    def add(self, t, v):
+        if self.T0 is None:
+            self.T0 = t
+            self.V0 = v
+        t -= self.T0
+        v -= self.V0
+        self.N += 1
+        self.St += t
+        self.Sv += v
+        self.Stt += t * t
+        self.Stv += t * v
+        self.Svv += v * v
+
+    def slope(self):
+        if self.N < 2:
+            return float('nan')
+        den = self.N * self.Stt - self.St * self.St
+        if den <= 0:
+            return float('nan')
+        return (self.N * self.Stv - self.St * self.Sv) / den
+
+    def stderr(self):
+        # standard error of the slope
+        if self.N < 3:
+            return float('inf')
+        n = self.N
+        ctt = self.Stt - self.St * self.St / n
+        ctv = self.Stv - self.St * self.Sv / n
+        cvv = self.Svv - self.Sv * self.Sv / n
+        if ctt <= 0:
+            return float('inf')
+        residual = max(cvv - ctv * ctv / ctt, 0.0) / (n - 2)
+        return (residual / ctt) ** .5
+
+
+def text_resolution(r):
+    # value of the last digit the instrument printed, '-0.0123' -> .0001
+    text = (r.text() if isinstance(r, Reading) else str(r)).strip().lower()
+    mantissa, e, exponent = text.partition('e')
+    try:
+        float(text)
+        return 10.0 ** (int(exponent or 0) - len(mantissa.partition('.')[2]))
+    except Exception as ex:
+        return 0.0
+
+
+def leak_test(read, limit, rate=10.0, max_duration=30.0, min_duration=1.0,
+              confidence=.95, min_samples=8, max_errors=5, resolution=None):
+    # Samples read() at `rate` Hz and fits the decay slope as it goes. The
+    # test passes when the slope is above `limit` (units per second, a
+    # negative number for a decay) and stops as soon as the slope is on one
+    # side of the limit with the requested confidence, or at max_duration.
+    # A quantized reading can sit on one count and fit with zero error, so
+    # the standard error is floored at resolution / elapsed time; resolution
+    # None takes it from the digits the instrument prints.
+    z = NormalDist().inv_cdf(confidence)
+    step = resolution or 0.0
+
+    def floored(se):
+        elapsed = trace[-1][0] - trace[0][0] if trace else 0.0
+        if step and elapsed > 0:
+            return max(se, step / elapsed)
+        return se
+
+    fit = SlopeFit()
+    trace = []
+    errors = 0
+    reason = 'max_duration'
+    interval = 1.0 / rate
+    start = monotonic()
+    due = start
+    while True:
+        r = read()
+        s = timed_value(r)
+        if s is None:
+            errors += 1
+            if errors >= max_errors:
+                reason = 'error'
+                break
+        else:
+            errors = 0
+            if resolution is None:
+                step = max(step, text_resolution(r))
+            fit.add(s[0], s[1])
+            trace.append((s[0] - start, s[1]))
+        now = monotonic()
+        if fit.N >= min_samples and now - start >= min_duration:
+            se = floored(fit.stderr())
+            if se > 0 and abs(fit.slope() - limit) > z * se:
+                reason = 'settled'
+                break
+        if now - start >= max_duration:
+            break
+        # hold the sampling rate; slots missed by a slow read are skipped
+        due += interval
+        if due < now:
+            due += int((now - due) / interval + 1) * interval
+        sleep(min(due - now, start + max_duration - now))
+    slope = fit.slope()
+    se = floored(fit.stderr())
+    if slope != slope or se == 0:
+        achieved = 0.0
+    else:
+        achieved = NormalDist().cdf(abs(slope - limit) / se)
+    return {'passed': slope == slope and slope >= limit,
+            'decided': reason == 'settled',
+            'reason': reason,
+            'slope': slope,
+            'stderr': se,
+            'limit': limit,
+            'confidence': achieved,
+            'samples': fit.N,
+            'duration': monotonic() - start,
+            'trace': trace}
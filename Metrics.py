@@ -0,0 +1,321 @@
+import json
+import os
+import threading
+from bisect import bisect_left
+
+# latency bucket upper bounds, seconds
+BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25,
+           .5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.Buckets = buckets
+        self.Counts = [0] * (len(buckets) + 1)
+        self.Sum = 0.0
+        self.Count = 0
+
+    def observe(self, value):
+        self.Counts[bisect_left(self.Buckets, value)] += 1
+        self.Sum += value
+        self.Count += 1
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th observation
+        if not self.Count:
+            return None
+        rank = q * self.Count
+        seen = 0
+        for bound, n in zip(self.Buckets, self.Counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def cumulative(self):
+        # [(le, count <= le), ...] ending with +Inf, as Prometheus wants
+        out = []
+        seen = 0
+        for bound, n in zip(self.Buckets + (float('inf'),), self.Counts):
+            seen += n
+            out.append((bound, seen))
+        return out
+
+    def stats(self):
+        return {'count': self.Count,
+                'sum': self.Sum,
+                'mean': self.Sum / self.Count if self.Count else None,
+                'p50': self.quantile(.5),
+                'p90': self.quantile(.9),
+                'p99': self.quantile(.99)}
+
+
+class CommandStats:
+    def __init__(self):
+        self.Ok = 0
+        self.Timeouts = 0
+        self.Errors = {}
+        self.Latency = Histogram()
+
+
+class PortStats:
+    def __init__(self):
+        self.BytesIn = 0
+        self.BytesOut = 0
+        self.Discarded = 0
+
+
+class LockStats:
+    def __init__(self):
+        self.Acquisitions = 0
+        self.Contended = 0
+        self.TimedOut = 0
+        self.Wait = Histogram()
+
+
+def error_type(ex):
+    # how a swallowed exception is counted
+    from Transport import PortBusy
+    if isinstance(ex, UnicodeDecodeError):
+        return 'decode_error'
+    if isinstance(ex, PortBusy):
+        return 'lock_timeout'
+    if isinstance(ex, TimeoutError):
+        return 'timeout'
+    if isinstance(ex, (ValueError, IndexError)):
+        return 'parse_error'
+    if isinstance(ex, OSError):
+        return 'io_error'
+    return type(ex).__name__
+
+
+class Metrics:
+    # Process-wide transport instrumentation, fed from the places every
+    # exchange already goes through:
+    #   TimeoutPolicy.observe   per (class, port, command) replies, timeouts
+    #                           and a latency histogram
+    #   device except blocks    errors swallowed into 'error: X' / 'Err'
+    #   LineFramer, AsyncPort   bytes in/out and discarded (unexpected or
+    #                           late) frames per port
+    #   PortLock                acquisitions, contention and wait time
+    # Each update is a dict lookup and a few increments under one lock.
+    # DEVICES_METRICS=0 turns it off.
+    def __init__(self, enabled=True):
+        self.Enabled = enabled
+        self.Lock = threading.Lock()
+        self.Commands = {}
+        self.Ports = {}
+        self.Locks = {}
+        self.Server = None
+
+    def reset(self):
+        with self.Lock:
+            self.Commands = {}
+            self.Ports = {}
+            self.Locks = {}
+
+    def command(self, kind, port, cmd):
+        key = (kind, port, cmd)
+        stats = self.Commands.get(key)
+        if stats is None:
+            stats = self.Commands[key] = CommandStats()
+        return stats
+
+    def port(self, port):
+        stats = self.Ports.get(port)
+        if stats is None:
+            stats = self.Ports[port] = PortStats()
+        return stats
+
+    def lock_stats(self, name):
+        stats = self.Locks.get(name)
+        if stats is None:
+            stats = self.Locks[name] = LockStats()
+        return stats
+
+    def query(self, kind, port, cmd, latency, ok):
+        if not self.Enabled:
+            return
+        with self.Lock:
+            stats = self.command(kind, port, cmd)
+            if ok:
+                stats.Ok += 1
+                stats.Latency.observe(latency)
+            else:
+                stats.Timeouts += 1
+
+    def error(self, kind, port, cmd, ex):
+        # a missing reply was already counted as a timeout by query()
+        if not self.Enabled or str(ex) == 'Unexpected Return':
+            return
+        name = error_type(ex)
+        with self.Lock:
+            errors = self.command(kind, port, cmd).Errors
+            errors[name] = errors.get(name, 0) + 1
+
+    def traffic(self, port, received=0, sent=0):
+        if not self.Enabled:
+            return
+        with self.Lock:
+            stats = self.port(port)
+            stats.BytesIn += received
+            stats.BytesOut += sent
+
+    def discarded(self, port, n=1):
+        if not self.Enabled:
+            return
+        with self.Lock:
+            self.port(port).Discarded += n
+
+    def lock_acquired(self, name, wait, contended):
+        # locks without a name (no port opened yet) are not reported
+        if not self.Enabled or name is None:
+            return
+        with self.Lock:
+            stats = self.lock_stats(name)
+            stats.Acquisitions += 1
+            if contended:
+                stats.Contended += 1
+                stats.Wait.observe(wait)
+
+    def lock_timed_out(self, name):
+        if not self.Enabled or name is None:
+            return
+        with self.Lock:
+            self.lock_stats(name).TimedOut += 1
+
+    def snapshot(self):
+        # plain dicts, safe to json.dumps
+        with self.Lock:
+            commands = []
+            devices = {}
+            for (kind, port, cmd), s in sorted(self.Commands.items(), key=str):
+                commands.append({'kind': kind, 'port': port, 'cmd': cmd,
+                                 'ok': s.Ok, 'timeouts': s.Timeouts,
+                                 'errors': dict(s.Errors),
+                                 'latency': s.Latency.stats()})
+                d = devices.setdefault(kind + ' ' + str(port),
+                                       {'ok': 0, 'timeouts': 0, 'errors': 0,
+                                        'latency_sum': 0.0})
+                d['ok'] += s.Ok
+                d['timeouts'] += s.Timeouts
+                d['errors'] += sum(s.Errors.values())
+                d['latency_sum'] += s.Latency.Sum
+            ports = dict((str(p), {'bytes_in': s.BytesIn, 'bytes_out': s.BytesOut,
+                                   'discarded': s.Discarded})
+                         for p, s in self.Ports.items())
+            locks = dict((str(n), {'acquisitions': s.Acquisitions,
+                                   'contended': s.Contended,
+                                   'timed_out': s.TimedOut,
+                                   'wait': s.Wait.stats()})
+                         for n, s in self.Locks.items())
+        return {'commands': commands, 'devices': devices, 'ports': ports,
+                'locks': locks}
+
+    def prometheus(self):
+        # Prometheus text exposition format, version 0.0.4
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append('# HELP ' + name + ' ' + help_text)
+            lines.append('# TYPE ' + name + ' ' + kind)
+
+        def sample(name, labels, value):
+            lines.append(name + '{' + ','.join(k + '="' + escape(v) + '"'
+                                               for k, v in labels) + '} ' + repr(value))
+
+        def histogram(name, labels, h):
+            for bound, n in h.cumulative():
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                sample(name + '_bucket', labels + [('le', le)], n)
+            sample(name + '_sum', labels, h.Sum)
+            sample(name + '_count', labels, h.Count)
+
+        with self.Lock:
+            commands = sorted(self.Commands.items(), key=str)
+            family('devices_queries_total', 'counter', 'Queries by outcome.')
+            for (kind, port, cmd), s in commands:
+                labels = [('kind', kind), ('port', port), ('cmd', cmd)]
+                sample('devices_queries_total', labels + [('outcome', 'ok')], s.Ok)
+                sample('devices_queries_total', labels + [('outcome', 'timeout')],
+                       s.Timeouts)
+            family('devices_query_errors_total', 'counter',
+                   'Errors swallowed by get_resp/read_command, by type.')
+            for (kind, port, cmd), s in commands:
+                for name, n in sorted(s.Errors.items()):
+                    sample('devices_query_errors_total',
+                           [('kind', kind), ('port', port), ('cmd', cmd),
+                            ('type', name)], n)
+            family('devices_query_latency_seconds', 'histogram',
+                   'Round trip time of answered queries.')
+            for (kind, port, cmd), s in commands:
+                histogram('devices_query_latency_seconds',
+                          [('kind', kind), ('port', port), ('cmd', cmd)], s.Latency)
+            ports = sorted(self.Ports.items(), key=str)
+            for name, attr, help_text in (
+                    ('devices_port_received_bytes_total', 'BytesIn', 'Bytes read.'),
+                    ('devices_port_sent_bytes_total', 'BytesOut', 'Bytes written.'),
+                    ('devices_port_discarded_frames_total', 'Discarded',
+                     'Stray or late frames skipped.')):
+                family(name, 'counter', help_text)
+                for port, s in ports:
+                    sample(name, [('port', port)], getattr(s, attr))
+            locks = sorted(self.Locks.items(), key=str)
+            for name, attr, help_text in (
+                    ('devices_lock_acquisitions_total', 'Acquisitions', 'Port lock acquisitions.'),
+                    ('devices_lock_contended_total', 'Contended', 'Acquisitions that had to wait.'),
+                    ('devices_lock_timeouts_total', 'TimedOut', 'Acquisitions that gave up.')):
+                family(name, 'counter', help_text)
+                for lock, s in locks:
+                    sample(name, [('lock', lock)], getattr(s, attr))
+            family('devices_lock_wait_seconds', 'histogram',
+                   'Time spent waiting for a contended port lock.')
+            for lock, s in locks:
+                histogram('devices_lock_wait_seconds', [('lock', lock)], s.Wait)
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=9464, host='127.0.0.1'):
+        # /metrics (Prometheus text) and /snapshot (JSON) over HTTP from a
+        # daemon thread; local only unless another host is given
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] == '/metrics':
+                    body = metrics.prometheus().encode()
+                    kind = 'text/plain; version=0.0.4; charset=utf-8'
+                elif self.path.split('?')[0] == '/snapshot':
+                    body = json.dumps(metrics.snapshot()).encode()
+                    kind = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', kind)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.stop_server()
+        self.Server = ThreadingHTTPServer((host, port), Handler)
+        self.Server.daemon_threads = True
+        threading.Thread(target=self.Server.serve_forever, name='metrics http',
+                         daemon=True).start()
+        return self.Server.server_address
+
+    def stop_server(self):
+        if self.Server is not None:
+            self.Server.shutdown()
+            self.Server.server_close()
+            self.Server = None
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = Metrics(os.environ.get('DEVICES_METRICS', '1') != '0')
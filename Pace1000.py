@@ -1,17 +1,36 @@
 import serial
-import serial.tools.list_ports
 import platform
+from time import monotonic
+
+from AttributeCache import AttributeCache
+from Metrics import metrics
+from Readings import Reading, ReadingAttribute, TypedReadings, parse_reading
+from Timeouts import policy as timeout_policy
+from Transport import CommandProtocol, PortLock, comports
 
 if platform.system().lower() != 'windows':
     import fcntl
 else:
     from fakefcntl import fcntl
 
+# seconds the :UNIT:PRES? reply is trusted between polls
+CACHED = {'unit': 10.0}
+
 
-class Pace1000:
-    def __init__(self, port):
+class Pace1000(CommandProtocol, TypedReadings):
+    Kind = 'Pace1000'
+    Fallback = 4
+    Terminator = b'\r\n'
+    Pressure = ReadingAttribute()
+    Value = ReadingAttribute(history=False)     # alias of Pressure for ControlBox
+
+    def __init__(self, port, serial_number=None):
         resp = b''
-        self.Waiting = False
+        self.Lock = PortLock()
+        self.AsyncPort = None
+        self.Framer = None
+        self.Worker = None
+        self.Cache = AttributeCache(CACHED)
         self.DevicePort = ''
         self.SerialNumber = '-'
         self.Device_Type = 'Measurement'
@@ -19,20 +38,26 @@ class Pace1000:
         self.Pressure = ''
         self.Value = ''
         self.SerialPort = None
-        try:
-            with serial.Serial(port, 57600, timeout=4, write_timeout=4) as ser:
-                ser.write(b'\r\n*idn?\r\n')
-                resp = ser.read_until(terminator=b'\r\n')
-        except Exception as ex:
-            self.SerialPort = None
-        # check for fluke response
-        if resp.decode('utf-8')[:22] == '*IDN GE Druck,PACE1000':
-            self.DevicePort = port
-            # Update class variables if its a Druck
+        if serial_number is None:    # not already identified by Discovery
             try:
-                self.SerialNumber = resp.decode('utf-8').split(',')[2]
+                with serial.Serial(port, 57600, timeout=4, write_timeout=4) as ser:
+                    timeout_policy.apply(ser, 'Pace1000', port, '*idn?', 4)
+                    start = monotonic()
+                    ser.write(b'\r\n*idn?\r\n')
+                    resp = ser.read_until(b'\r\n')
             except Exception as ex:
-                self.SerialNumber = '----------'
+                self.SerialPort = None
+            # check for fluke response
+            if resp.decode('utf-8')[:22] == '*IDN GE Druck,PACE1000':
+                timeout_policy.observe('Pace1000', port, '*idn?', start, True, 4)
+                # Update class variables if its a Druck
+                try:
+                    serial_number = resp.decode('utf-8').split(',')[2]
+                except Exception as ex:
+                    serial_number = '----------'
+        if serial_number is not None:
+            self.DevicePort = port
+            self.SerialNumber = serial_number
             self.SerialPort = serial.Serial(
                 self.DevicePort, 57600, timeout=4, write_timeout=4)
             fcntl.flock(self.SerialPort.fileno(),
@@ -41,79 +66,79 @@ class Pace1000:
             # return True
 
     def read_command(self, cmd):
-        if self.Waiting:
-            pass
-        self.Waiting = True
         try:
-            if self.SerialPort:
-                self.SerialPort.write(b'\r\n' + cmd + b'\r\n')
-                resp = self.SerialPort.read_until(terminator=b'\r\n')
-                resp = resp.decode('utf-8')
-                if resp == '' or resp[-1] != '\n':
-                    raise Exception('Unexpected Return')
-                self.Waiting = False
-                return resp
-            else:
-                self.Waiting = False
-                return "Err"
+            with self.Lock:
+                if self.SerialPort:
+                    key = cmd.decode()
+                    port = self.SerialPort.port
+                    timeout = timeout_policy.timeout('Pace1000', port, key, 4)
+                    start = monotonic()
+                    resp = self.framer().query(b'\r\n' + cmd + b'\r\n', None, timeout)
+                    timeout_policy.observe('Pace1000', port, key, start, resp is not None, 4)
+                    if resp is None:
+                        raise Exception('Unexpected Return')
+                    return (resp + b'\r\n').decode('utf-8')
+                else:
+                    return "Err"
         except Exception as ex:
+            metrics.error('Pace1000', getattr(self.SerialPort, 'port', None), cmd.decode(), ex)
             # if self.SerialPort:
             #     self.SerialPort.close()
             # self.SerialPort = None
-            self.Waiting = False
             return 'Err'
 
     def write_command(self, cmd):
-        if self.Waiting:
-            pass
-        self.Waiting = True
         try:
-            if self.SerialPort:
-                self.SerialPort.write(b'\r\n' + cmd + b'\r\n')
-            self.Waiting = False
+            with self.Lock:
+                if self.SerialPort:
+                    self.SerialPort.write(b'\r\n' + cmd + b'\r\n')
         except Exception as ex:
             # if self.SerialPort:
             #     self.SerialPort.close()
             # self.SerialPort = None
-            self.Waiting = False
             return 'Err'
 
+    @property
+    def Waiting(self):
+        return self.Lock.locked()
+
     def reset_serial(self):
-        while self.Waiting:
-            pass
-        self.Waiting = True
-        if self.SerialPort:
-            self.SerialPort.reset_input_buffer()
-            self.SerialPort.reset_output_buffer()
-        self.Waiting = False
+        with self.Lock:
+            if self.SerialPort:
+                self.SerialPort.reset_input_buffer()
+                self.SerialPort.reset_output_buffer()
 
     def find_device(self):
-        for p in serial.tools.list_ports.comports():
-            if p.device == '/dev/ttyAMA0':
-                continue
-            try:
-                with open(p.device, 'r') as a:
-                    fcntl.flock(a.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-            except Exception as ex:
-                continue
-            try:
-                with serial.Serial(p.device, 57600, timeout=4, write_timeout=4) as ser:
-                    ser.write(b'\r\n*idn?\r\n')
-                    resp = ser.read_until(terminator=b'\r\n')
-            except Exception as ex:
-                self.SerialPort = None
-                continue
-            # check for fluke response
-            if resp.decode('utf-8')[:22] == '*IDN GE Druck,PACE1000':
-                self.DevicePort = p
-                # Update class variables if its a fluke
-                self.SerialNumber = resp.decode('utf-8').split(',')[2]
-                self.SerialPort = serial.Serial(
-                    self.DevicePort.device, 57600, timeout=4, write_timeout=4)
-                fcntl.flock(self.SerialPort.fileno(),
-                            fcntl.LOCK_EX | fcntl.LOCK_NB)
-                return True
-        return False
+        with self.Lock:
+            for p in comports():
+                if p.device == '/dev/ttyAMA0':
+                    continue
+                try:
+                    with open(p.device, 'r') as a:
+                        fcntl.flock(a.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except Exception as ex:
+                    continue
+                try:
+                    with serial.Serial(p.device, 57600, timeout=4, write_timeout=4) as ser:
+                        timeout_policy.apply(ser, 'Pace1000', p.device, '*idn?', 4)
+                        start = monotonic()
+                        ser.write(b'\r\n*idn?\r\n')
+                        resp = ser.read_until(b'\r\n')
+                except Exception as ex:
+                    self.SerialPort = None
+                    continue
+                # check for fluke response
+                if resp.decode('utf-8')[:22] == '*IDN GE Druck,PACE1000':
+                    timeout_policy.observe('Pace1000', p.device, '*idn?', start, True, 4)
+                    self.DevicePort = p
+                    # Update class variables if its a fluke
+                    self.SerialNumber = resp.decode('utf-8').split(',')[2]
+                    self.SerialPort = serial.Serial(
+                        self.DevicePort.device, 57600, timeout=4, write_timeout=4)
+                    fcntl.flock(self.SerialPort.fileno(),
+                                fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return True
+            return False
 
     def is_connected(self):
         if self.SerialPort:
@@ -121,30 +146,60 @@ class Pace1000:
         else:
             return False
 
-    def read_pressure(self):
+    def read_pressure(self, typed=False):
         # with serial.Serial(self.device_port.device, 57600, timeout=.4, write_timeout=.2) as ser:
         #     ser.write(b'\rMEAS?\r')
         #     resp = ser.read_until(terminator=b'\r')
+        r = self.parse_pressure(self.read_command(b':SENS:PRES?'))
+        return self.reading('Pressure') if typed else r
+
+    async def read_pressure_async(self, typed=False):
+        r = self.parse_pressure(await self.read_command_async(b':SENS:PRES?'))
+        return self.reading('Pressure') if typed else r
+
+    def parse_pressure(self, r):
         try:
-            r = self.read_command(b':SENS:PRES?')
             r = r.split(' ')[1].strip()
         except Exception as ex:
             r = 'Err'
-        self.Pressure = r
-        self.Value = self.Pressure                  # for ControlBox Compatibility
+        self.Pressure = parse_reading(r, self.Unit, self.SerialNumber)
+        self.Value = self.reading('Pressure')       # for ControlBox Compatibility
         return r
 
     def read_unit(self):
         # with serial.Serial(self.device_port.device, 57600, timeout=.2, write_timeout=.2) as ser:
         #     ser.write(b'\rSYST:LOC\r')
+        self.Cache.invalidate('unit')
+        return self.cached_unit()
+
+    async def read_unit_async(self):
+        self.Cache.invalidate('unit')
+        return await self.cached_unit_async()
+
+    def cached_unit(self):
+        return self.parse_unit(self.Cache.fetch('unit', lambda: self.read_command(b':UNIT:PRES?')))
+
+    async def cached_unit_async(self):
+        return self.parse_unit(await self.Cache.fetch_async(
+            'unit', lambda: self.read_command_async(b':UNIT:PRES?')))
+
+    def parse_unit(self, r):
         try:
-            r = self.read_command(b':UNIT:PRES?')
             r = r.split(' ')[1].strip()
         except Exception as ex:
             r = 'Err'
         self.Unit = r
         return r
 
-    def update_values(self):
+    def update_values(self, typed=False):
+        # unit first (normally cached) so the reading carries it
+        self.cached_unit()
         self.read_pressure()
-        self.read_unit()
+        if typed:
+            return self.reading('Pressure')
+
+    async def update_values_async(self, typed=False):
+        await self.cached_unit_async()
+        await self.read_pressure_async()
+        if typed:
+            return self.reading('Pressure')
@@ -0,0 +1,123 @@
+from time import monotonic
+
+# status codes
+OK = 0
+ERROR = 1
+
+
+class Reading:
+    # One sample: float value, unit, monotonic timestamp, device id and
+    # status. Text is the instrument's own rendering where we have it, so the
+    # legacy string attributes stay byte-for-byte what they used to be.
+    __slots__ = ('Value', 'Unit', 'Timestamp', 'DeviceId', 'Status', 'Text')
+
+    def __init__(self, value, unit='', device_id='', status=OK, timestamp=None,
+                 text=None):
+        self.Value = value
+        self.Unit = unit
+        self.Timestamp = monotonic() if timestamp is None else timestamp
+        self.DeviceId = device_id
+        self.Status = status
+        self.Text = text
+
+    def text(self):
+        if self.Text is not None:
+            return self.Text
+        return 'Err' if self.Status else str(self.Value)
+
+    def __float__(self):
+        return self.Value
+
+    def __repr__(self):
+        return 'Reading(' + repr(self.Value) + ', ' + repr(self.Unit) + ', ' + \
+            repr(self.DeviceId) + ', status=' + str(self.Status) + ')'
+
+
+def parse_reading(text, unit='', device_id='', scale=None):
+    # Reading from an instrument's text; keeps the text unless it is scaled
+    try:
+        value = float(text)
+    except Exception as ex:
+        return Reading(float('nan'), unit, device_id, ERROR,
+                       text=text if scale is None else None)
+    if scale is not None:
+        return Reading(value * scale, unit, device_id)
+    return Reading(value, unit, device_id, text=text)
+
+
+def timed_value(r):
+    # (timestamp, value) from a Reading or a plain number; None on error
+    if isinstance(r, Reading):
+        if r.Status:
+            return None
+        return r.Timestamp, r.Value
+    try:
+        return monotonic(), float(r)
+    except Exception as ex:
+        return None
+
+
+class ReadingAttribute:
+    # Legacy string attribute backed by a Reading. Parsers assign Readings
+    # and the string is only rendered when someone reads the attribute;
+    # plain strings assigned by older code are kept as they are. Good
+    # readings are also appended to the channel's history, if enabled.
+    def __init__(self, history=True):
+        # history=False for compatibility aliases of another channel
+        self.Keep = history
+
+    def __set_name__(self, owner, name):
+        self.Name = name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        value = obj.__dict__.get(self.Name, '')
+        if isinstance(value, Reading):
+            return value.text()
+        return value
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.Name] = value
+        if isinstance(value, Reading) and not value.Status:
+            history = obj.__dict__.get('History')
+            if history and self.Name in history:
+                history[self.Name].append(value.Timestamp, value.Value)
+
+
+class TypedReadings:
+    # mixin for the device classes: typed access to ReadingAttribute values
+    def device_id(self):
+        return getattr(self, 'SerialNumber', None) or getattr(self, 'Serial_Number', '')
+
+    def reading(self, name):
+        value = self.__dict__.get(name, '')
+        if isinstance(value, Reading):
+            return value
+        # set as a plain string somewhere; parse it now
+        return parse_reading(value, getattr(self, 'Unit', ''), self.device_id())
+
+    def readings(self, *names):
+        return dict((name, self.reading(name)) for name in names)
+
+    def channels(self):
+        cls = type(self)
+        return [name for name in dir(cls)
+                if isinstance(getattr(cls, name, None), ReadingAttribute) and
+                getattr(cls, name).Keep]
+
+    def enable_history(self, capacity=100000, names=None):
+        # keep a RingBuffer of every good reading per channel
+        from RingBuffer import RingBuffer
+        history = dict(self.__dict__.get('History') or {})
+        for name in names or self.channels():
+            if name not in history:
+                history[name] = RingBuffer(capacity)
+        self.History = history
+        return history
+
+    def disable_history(self):
+        self.History = None
+
+    def history(self, name):
+        return (self.__dict__.get('History') or {}).get(name)
@@ -0,0 +1,107 @@
+class RingBuffer:
+    # Fixed-capacity history of (timestamp, value) for one channel, in
+    # preallocated numpy arrays. Every sample is written twice, at i and
+    # i + capacity, so the most recent n samples are always one contiguous
+    # slice: window queries work on views and append never allocates.
+    # One writer; readers on other threads see whole samples only.
+    def __init__(self, capacity=100000):
+        import numpy
+        self.Capacity = capacity
+        self.Times = numpy.zeros(2 * capacity)
+        self.Values = numpy.zeros(2 * capacity)
+        self.Count = 0
+
+    def append(self, timestamp, value):
+        i = self.Count % self.Capacity
+        self.Times[i] = self.Times[i + self.Capacity] = timestamp
+        self.Values[i] = self.Values[i + self.Capacity] = value
+        self.Count += 1
+
+    def clear(self):
+        self.Count = 0
+
+    def __len__(self):
+        return min(self.Count, self.Capacity)
+
+    def window(self, seconds=None, samples=None):
+        # (times, values) views of the last `samples` samples and/or the
+        # last `seconds` before the newest one; everything if neither
+        import numpy
+        count = self.Count
+        n = min(count, self.Capacity)
+        if samples is not None:
+            n = min(n, samples)
+        end = (count - 1) % self.Capacity + self.Capacity + 1 if count else 0
+        times = self.Times[end - n:end]
+        values = self.Values[end - n:end]
+        if seconds is not None and n:
+            start = numpy.searchsorted(times, times[-1] - seconds)
+            times = times[start:]
+            values = values[start:]
+        return times, values
+
+    def last(self):
+        if not self.Count:
+            return None, None
+        i = (self.Count - 1) % self.Capacity
+        return self.Times[i], self.Values[i]
+
+    def mean(self, seconds=None, samples=None):
+        times, values = self.window(seconds, samples)
+        return values.mean() if len(values) else float('nan')
+
+    def std(self, seconds=None, samples=None):
+        times, values = self.window(seconds, samples)
+        if not len(values):
+            return float('nan')
+        d = values - values.mean()
+        return (d.dot(d) / len(d)) ** .5
+
+    def min(self, seconds=None, samples=None):
+        times, values = self.window(seconds, samples)
+        return values.min() if len(values) else float('nan')
+
+    def max(self, seconds=None, samples=None):
+        times, values = self.window(seconds, samples)
+        return values.max() if len(values) else float('nan')
+
+    def slope(self, seconds=None, samples=None):
+        # least-squares slope in value units per second
+        times, values = self.window(seconds, samples)
+        n = len(values)
+        if n < 2:
+            return float('nan')
+        # shift time to the window start to keep the sums well conditioned
+        t = times - times[0]
+        st = t.sum()
+        sv = values.sum()
+        den = n * t.dot(t) - st * st
+        if den <= 0:
+            return float('nan')
+        return (n * t.dot(values) - st * sv) / den
+
+    def time_since_stable(self, band, seconds=None, samples=None, reference=None):
+        # how long the channel has stayed within +/- band of reference
+        # (default: the newest value), looking back over the window
+        import numpy
+        times, values = self.window(seconds, samples)
+        if not len(values):
+            return 0.0
+        if reference is None:
+            reference = values[-1]
+        outside = numpy.abs(values - reference) > band
+        if not outside.any():
+            return times[-1] - times[0]
+        last = len(outside) - 1 - numpy.argmax(outside[::-1])
+        if last == len(values) - 1:
+            return 0.0
+        return times[-1] - times[last + 1]
+
+    def stats(self, seconds=None, samples=None):
+        times, values = self.window(seconds, samples)
+        return {'samples': len(values),
+                'mean': self.mean(seconds, samples),
+                'std': self.std(seconds, samples),
+                'min': self.min(seconds, samples),
+                'max': self.max(seconds, samples),
+                'slope': self.slope(seconds, samples)}
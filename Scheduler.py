@@ -0,0 +1,154 @@
+import threading
+from time import monotonic
+
+
+class Channel:
+    def __init__(self, device, method, rate, priority=0, name=None,
+                 callback=None):
+        self.Device = device
+        self.Method = getattr(device, method) if isinstance(method, str) else method
+        self.Name = name or type(device).__name__ + '.' + \
+            (method if isinstance(method, str) else method.__name__)
+        self.Rate = rate
+        self.Interval = 1.0 / rate
+        self.Priority = priority
+        self.Callback = callback
+        self.Scale = 1.0
+        self.NextDue = 0.0
+        self.Duration = 0.0
+        self.Runs = 0
+        self.Missed = 0
+        self.Errors = 0
+        self.FirstRun = None
+        self.LastRun = None
+
+    def period(self):
+        return self.Interval * self.Scale
+
+    def stats(self):
+        elapsed = (self.LastRun - self.FirstRun) if self.Runs > 1 else 0
+        return {'name': self.Name,
+                'priority': self.Priority,
+                'target_rate': self.Rate,
+                'effective_rate': 1.0 / self.period(),
+                'achieved_rate': (self.Runs - 1) / elapsed if elapsed else 0.0,
+                'runs': self.Runs,
+                'missed': self.Missed,
+                'errors': self.Errors,
+                'duration': self.Duration,
+                'degraded': self.Scale > 1.0}
+
+
+def port_key(device):
+    ser = getattr(device, 'SerialPort', None)
+    return getattr(ser, 'port', None) or id(device)
+
+
+class PollScheduler:
+    # Drives update_values()/get_status()/... for a whole station. Channels
+    # on the same port share one thread and run earliest-deadline-first;
+    # different ports run concurrently. A run that starts after its own
+    # period has elapsed counts as a missed deadline, and the missed slots
+    # are skipped rather than replayed. When the measured load on a port
+    # exceeds Utilization, the lowest-priority channels on that port are
+    # slowed down first until the rest fit.
+    def __init__(self, utilization=.9, max_scale=100.0, rebalance=1.0):
+        self.Utilization = utilization
+        self.MaxScale = max_scale
+        self.Rebalance = rebalance
+        self.Ports = {}
+        self.Threads = []
+        self.Stop = threading.Event()
+
+    def add(self, device, method, rate, priority=0, name=None, callback=None):
+        channel = Channel(device, method, rate, priority, name, callback)
+        self.Ports.setdefault(port_key(device), []).append(channel)
+        return channel
+
+    def channels(self):
+        return [c for cs in self.Ports.values() for c in cs]
+
+    def start(self):
+        self.Stop.clear()
+        now = monotonic()
+        for key, channels in self.Ports.items():
+            for c in channels:
+                c.NextDue = now
+            t = threading.Thread(target=self.run, args=(channels,),
+                                 name='poll ' + str(key), daemon=True)
+            t.start()
+            self.Threads.append(t)
+        return self
+
+    def stop(self):
+        self.Stop.set()
+        for t in self.Threads:
+            t.join()
+        self.Threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def run(self, channels):
+        last_balance = monotonic()
+        while not self.Stop.is_set():
+            c = min(channels, key=lambda c: (c.NextDue, -c.Priority))
+            now = monotonic()
+            if c.NextDue > now:
+                self.Stop.wait(c.NextDue - now)
+                continue
+            period = c.period()
+            if now > c.NextDue + period:
+                skipped = int((now - c.NextDue) / period)
+                c.Missed += skipped
+                c.NextDue += skipped * period
+            try:
+                result = c.Method()
+                if c.Callback:
+                    c.Callback(c, result)
+            except Exception as ex:
+                c.Errors += 1
+            done = monotonic()
+            c.Duration = done - now if not c.Runs else .8 * c.Duration + .2 * (done - now)
+            c.Runs += 1
+            c.FirstRun = c.FirstRun or now
+            c.LastRun = now
+            c.NextDue += period
+            if done - last_balance >= self.Rebalance:
+                self.balance(channels)
+                last_balance = done
+
+    def balance(self, channels):
+        # give each channel its full rate in priority order while the port's
+        # time budget lasts; whatever does not fit is stretched to the share
+        # that is left
+        budget = self.Utilization
+        for c in sorted(channels, key=lambda c: -c.Priority):
+            need = c.Duration / c.Interval
+            if need <= budget:
+                c.Scale = 1.0
+                budget -= need
+            else:
+                c.Scale = min(need / max(budget, need / self.MaxScale), self.MaxScale)
+                budget = max(budget - need / c.Scale, 0.0)
+
+    def stats(self):
+        return [c.stats() for c in self.channels()]
+
+
+if __name__ == '__main__':
+    from time import sleep
+
+    import Discovery
+
+    scheduler = PollScheduler()
+    for device in Discovery.open_station().values():
+        scheduler.add(device, 'update_values', 5)
+    with scheduler:
+        while True:
+            sleep(5)
+            for s in scheduler.stats():
+                print(s)
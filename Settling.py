@@ -0,0 +1,117 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+
+from Readings import timed_value
+
+
+class SettleChannel:
+    # One live channel and its stability criteria: the last `samples`
+    # consecutive readings all within +/- band of their mean and, if slope
+    # is given, a least-squares slope no steeper than that (units/second).
+    def __init__(self, read, band, slope=None, samples=10, name=None):
+        self.Read = read
+        self.Band = band
+        self.Slope = slope
+        self.Samples = samples
+        self.Name = name or getattr(read, '__name__', 'channel')
+        self.Window = deque(maxlen=samples)
+        self.Errors = 0
+
+    def poll(self):
+        s = timed_value(self.Read())
+        if s is None:
+            # a bad reading breaks the run of consecutive samples
+            self.Errors += 1
+            self.Window.clear()
+        else:
+            self.Window.append(s)
+        return self.stable()
+
+    def mean(self):
+        if not self.Window:
+            return float('nan')
+        return sum(v for t, v in self.Window) / len(self.Window)
+
+    def spread(self):
+        if not self.Window:
+            return float('nan')
+        m = self.mean()
+        return max(abs(v - m) for t, v in self.Window)
+
+    def slope(self):
+        n = len(self.Window)
+        if n < 2:
+            return float('nan')
+        t0 = self.Window[0][0]
+        mt = sum(t - t0 for t, v in self.Window) / n
+        mv = self.mean()
+        stt = sum((t - t0 - mt) ** 2 for t, v in self.Window)
+        if stt <= 0:
+            return float('nan')
+        return sum((t - t0 - mt) * (v - mv) for t, v in self.Window) / stt
+
+    def stable(self):
+        if len(self.Window) < self.Samples:
+            return False
+        if self.spread() > self.Band:
+            return False
+        if self.Slope is not None and not abs(self.slope()) <= self.Slope:
+            return False
+        return True
+
+    def stats(self):
+        return {'stable': self.stable(),
+                'value': self.mean(),
+                'spread': self.spread(),
+                'slope': self.slope(),
+                'samples': len(self.Window),
+                'errors': self.Errors}
+
+
+def device_read(device, attr):
+    # fresh typed reading of one attribute: update_values(), then reading()
+    def read():
+        device.update_values()
+        return device.reading(attr)
+    return read
+
+
+def device_channel(device, attr, band, slope=None, samples=10):
+    # SettleChannel watching one of a device's reading attributes
+    # (Monitor, Pressure, ...)
+    return SettleChannel(device_read(device, attr), band, slope, samples,
+                         type(device).__name__ + '.' + attr)
+
+
+def wait_until_stable(channels, timeout=60.0, rate=10.0, workers=1):
+    # Polls every channel at `rate` Hz until all of them are stable at the
+    # same time, or until timeout. Returns as soon as they settle, instead
+    # of a fixed sleep() after a setpoint change. workers > 1 polls channels
+    # on different ports in parallel.
+    for c in channels:
+        c.Window.clear()
+    pool = ThreadPoolExecutor(workers) if workers > 1 else None
+    interval = 1.0 / rate
+    start = monotonic()
+    due = start
+    stable = False
+    try:
+        while True:
+            if pool:
+                stable = all(list(pool.map(SettleChannel.poll, channels)))
+            else:
+                stable = all([c.poll() for c in channels])
+            now = monotonic()
+            if stable or now - start >= timeout:
+                break
+            due += interval
+            if due < now:
+                due += int((now - due) / interval + 1) * interval
+            sleep(min(due - now, start + timeout - now))
+    finally:
+        if pool:
+            pool.shutdown()
+    return {'stable': stable,
+            'elapsed': monotonic() - start,
+            'channels': dict((c.Name, c.stats()) for c in channels)}
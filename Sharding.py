@@ -0,0 +1,197 @@
+import math
+import multiprocessing
+import os
+import struct
+import threading
+from multiprocessing import shared_memory
+from time import monotonic, sleep
+
+HEADER = struct.Struct('<Q')
+RECORD = struct.Struct('<dIId')      # timestamp, device index, channel index, value
+
+# attributes published after each update_values(), per device class
+CHANNELS = {
+    'CordisDevice': ('Command', 'Monitor'),
+    'ExternalSensor': ('Output',),
+    'Fluke2700': ('Pressure',),
+    'Fluke8846': ('Value',),
+    'Pace1000': ('Pressure',),
+    'SureFlow': ('SCCM', 'CCM', 'Temp', 'Pressure'),
+}
+
+
+def attach(name):
+    # the creating process owns the segment. Workers are started from it and
+    # share its resource tracker, so on Pythons without track= a plain
+    # attach is enough
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+class SharedRing:
+    # Single-producer ring of fixed-size records in shared memory. The
+    # producer writes a record and then bumps the 64-bit write counter in
+    # the header; a reader keeps its own position and detects records that
+    # were overwritten before it got to them. Only one process writes a
+    # ring, but several of its threads may (one poll thread per port), so
+    # write() is serialized by a lock in that process.
+    def __init__(self, capacity=65536, name=None):
+        size = HEADER.size + capacity * RECORD.size
+        if name is None:
+            self.Memory = shared_memory.SharedMemory(create=True, size=size)
+            HEADER.pack_into(self.Memory.buf, 0, 0)
+        else:
+            self.Memory = attach(name)
+        self.Name = self.Memory.name
+        self.Capacity = capacity
+        self.WriteLock = threading.Lock()
+        self.Position = 0
+        self.Lost = 0
+
+    def count(self):
+        return HEADER.unpack_from(self.Memory.buf, 0)[0]
+
+    def write(self, timestamp, device, channel, value):
+        with self.WriteLock:
+            n = self.count()
+            RECORD.pack_into(self.Memory.buf,
+                             HEADER.size + (n % self.Capacity) * RECORD.size,
+                             timestamp, device, channel, value)
+            HEADER.pack_into(self.Memory.buf, 0, n + 1)
+
+    def read(self):
+        n = self.count()
+        start = max(self.Position, n - self.Capacity)
+        self.Lost += start - self.Position
+        records = []
+        for i in range(start, n):
+            records.append(RECORD.unpack_from(
+                self.Memory.buf, HEADER.size + (i % self.Capacity) * RECORD.size))
+        # anything the producer lapped while we were copying may be torn. It
+        # fills slot m % Capacity before publishing m + 1, so while the
+        # count is m the slot of record m - Capacity is already in play
+        overrun = min(self.count() + 1 - self.Capacity - start, len(records))
+        if overrun > 0:
+            records = records[overrun:]
+            self.Lost += overrun
+        self.Position = n
+        return records
+
+    def close(self, unlink=False):
+        self.Memory.close()
+        if unlink:
+            self.Memory.unlink()
+
+
+def reading(device, attr):
+    try:
+        return device.reading(attr).Value
+    except Exception as ex:
+        return math.nan
+
+
+def shard_main(ring_name, capacity, assignments, rate, stop):
+    # runs in a worker process: open this shard's devices and poll them
+    import Discovery
+    from Scheduler import PollScheduler
+
+    ring = SharedRing(capacity, ring_name)
+    scheduler = PollScheduler()
+
+    def publisher(index, names):
+        def publish(channel, result):
+            now = monotonic()
+            for i, attr in enumerate(names):
+                ring.write(now, index, i, reading(channel.Device, attr))
+        return publish
+
+    devices = []
+    for index, cls, port, sn in assignments:
+        try:
+            device = Discovery.open_device(Discovery.CLASSES[cls], port, sn)
+        except Exception as ex:
+            print('Shard could not open ' + cls + ' on ' + port + ': ' + str(ex))
+            continue
+        devices.append(device)
+        scheduler.add(device, 'update_values', rate,
+                      callback=publisher(index, CHANNELS[cls]))
+    with scheduler:
+        stop.wait()
+    for device in devices:
+        if getattr(device, 'SerialPort', None):
+            device.SerialPort.close()
+    ring.close()
+
+
+class ShardedAcquisition:
+    # Spreads device ownership over a pool of worker processes, one port
+    # per device and whole ports per worker, so polling and parsing are not
+    # bound by one interpreter's GIL. Each worker publishes timestamped
+    # readings into its own SharedRing; read() collects them in the parent.
+    def __init__(self, found, workers=None, rate=10, capacity=65536):
+        # found: port -> (class, serial number), as returned by Discovery.discover
+        self.Devices = [(cls.__name__ if isinstance(cls, type) else cls, port)
+                        for port, (cls, sn) in sorted(found.items())]
+        self.Serials = dict((port, sn) for port, (cls, sn) in found.items())
+        self.Workers = max(1, min(workers or os.cpu_count() or 1, len(self.Devices)))
+        self.Rate = rate
+        self.Capacity = capacity
+        self.Context = multiprocessing.get_context('spawn')
+        self.Stop = self.Context.Event()
+        self.Rings = []
+        self.Processes = []
+
+    def start(self):
+        self.Stop.clear()
+        for w in range(self.Workers):
+            assignments = [(i, cls, port, self.Serials[port])
+                           for i, (cls, port) in enumerate(self.Devices)
+                           if i % self.Workers == w]
+            ring = SharedRing(self.Capacity)
+            p = self.Context.Process(target=shard_main, name='shard ' + str(w),
+                                     args=(ring.Name, self.Capacity, assignments,
+                                           self.Rate, self.Stop), daemon=True)
+            p.start()
+            self.Rings.append(ring)
+            self.Processes.append(p)
+        return self
+
+    def stop(self):
+        self.Stop.set()
+        for p in self.Processes:
+            p.join()
+        for ring in self.Rings:
+            ring.close(unlink=True)
+        self.Processes = []
+        self.Rings = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def read(self):
+        # [(timestamp, class, port, channel, value), ...] since the last call
+        out = []
+        for ring in self.Rings:
+            for t, d, c, v in ring.read():
+                cls, port = self.Devices[d]
+                out.append((t, cls, port, CHANNELS[cls][c], v))
+        out.sort()
+        return out
+
+    def lost(self):
+        return sum(ring.Lost for ring in self.Rings)
+
+
+if __name__ == '__main__':
+    import Discovery
+
+    with ShardedAcquisition(Discovery.discover()) as acquisition:
+        while True:
+            sleep(1)
+            for r in acquisition.read():
+                print(r)
@@ -0,0 +1,456 @@
+import math
+import os
+import random
+import select
+import termios
+import threading
+import tty
+from time import monotonic, sleep
+
+from Transport import register_port, unregister_port
+
+
+def fmt(value, digits=2):
+    return format(value, '.' + str(digits) + 'f')
+
+
+def scpi(value):
+    return format(value, '+.8E')
+
+
+class Simulator:
+    # One virtual instrument on a Linux pseudo-terminal. The slave side
+    # (self.Port, /dev/pts/N) is registered with Transport.comports(), so
+    # find_boards, find_device and Discovery see it like a USB adapter and
+    # the device classes open it with serial.Serial unchanged. A thread on
+    # the master side splits incoming bytes into lines and answers each one
+    # through respond(). Faults, applied to every reply:
+    #   latency, jitter  seconds before replying (latency + uniform(0, jitter))
+    #   drop             probability of losing each byte of a reply
+    #   garbage          probability of 1-8 random bytes spliced into a reply
+    # Input is ignored while the port is not set to the instrument's baud
+    # rate (check_baud=False answers at any rate).
+    Baud = 57600
+    Terminator = b'\r'
+
+    def __init__(self, latency=0.0, jitter=0.0, drop=0.0, garbage=0.0,
+                 check_baud=True, seed=None):
+        self.Latency = latency
+        self.Jitter = jitter
+        self.Drop = drop
+        self.Garbage = garbage
+        self.CheckBaud = check_baud
+        self.Random = random.Random(seed)
+        self.Master = None
+        self.Slave = None
+        self.Port = None
+        self.Thread = None
+        self.Stop = threading.Event()
+        self.Buffer = b''
+        self.Lines = 0
+        self.Replies = 0
+        self.Ignored = 0
+        self.DroppedBytes = 0
+        self.Injected = 0
+
+    def start(self):
+        self.Master, self.Slave = os.openpty()
+        # no echo or line editing until a client configures the port; the
+        # slave stays open here so the pty outlives client close/reopen
+        tty.setraw(self.Slave)
+        self.Port = os.ttyname(self.Slave)
+        self.Stop.clear()
+        self.Thread = threading.Thread(target=self.run, daemon=True,
+                                       name=type(self).__name__ + ' ' + self.Port)
+        self.Thread.start()
+        register_port(self.Port, 'Simulated ' + type(self).__name__)
+        return self
+
+    def stop(self):
+        if self.Port:
+            unregister_port(self.Port)
+        self.Stop.set()
+        if self.Thread:
+            self.Thread.join()
+            self.Thread = None
+        for fd in (self.Master, self.Slave):
+            if fd is not None:
+                os.close(fd)
+        self.Master = self.Slave = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def baud_ok(self):
+        if not self.CheckBaud:
+            return True
+        try:
+            speed = termios.tcgetattr(self.Slave)[5]
+        except Exception as ex:
+            return True
+        return speed == getattr(termios, 'B' + str(self.Baud), speed)
+
+    def run(self):
+        while not self.Stop.is_set():
+            try:
+                ready = select.select([self.Master], [], [], .1)[0]
+                if not ready:
+                    continue
+                data = os.read(self.Master, 4096)
+            except OSError:
+                return
+            if not self.baud_ok():
+                self.Ignored += len(data)
+                self.Buffer = b''
+                continue
+            self.Buffer += data
+            while b'\r' in self.Buffer:
+                line, self.Buffer = self.Buffer.split(b'\r', 1)
+                line = line.strip(b'\n').decode('utf-8', 'replace').strip()
+                if not line:
+                    continue
+                self.Lines += 1
+                try:
+                    reply = self.respond(line)
+                except Exception as ex:
+                    reply = None
+                if reply is not None:
+                    self.send(reply.encode() + self.Terminator)
+
+    def send(self, data):
+        delay = self.Latency + (self.Random.uniform(0, self.Jitter) if self.Jitter else 0)
+        if delay > 0:
+            sleep(delay)
+        if self.Drop:
+            kept = bytes(b for b in data if self.Random.random() >= self.Drop)
+            self.DroppedBytes += len(data) - len(kept)
+            data = kept
+        if self.Garbage and self.Random.random() < self.Garbage:
+            i = self.Random.randint(0, len(data))
+            junk = bytes(self.Random.randrange(256)
+                         for k in range(self.Random.randint(1, 8)))
+            data = data[:i] + junk + data[i:]
+            self.Injected += 1
+        try:
+            os.write(self.Master, data)
+            self.Replies += 1
+        except OSError:
+            pass
+
+    def respond(self, line):
+        # reply text without terminator, or None to stay silent
+        return None
+
+    def stats(self):
+        return {'port': self.Port,
+                'lines': self.Lines,
+                'replies': self.Replies,
+                'ignored_bytes': self.Ignored,
+                'dropped_bytes': self.DroppedBytes,
+                'garbage': self.Injected}
+
+
+def constant(value):
+    return lambda: value
+
+
+class CordisSim(Simulator):
+    # Cordis controller: `?CMD` -> `CMD: value`, `CMD: value` -> `CMD: CMD`,
+    # `STAT:  C:x  S:y  E:0`. The pressure follows the command with a first
+    # order lag (tau seconds) through the board's own constants:
+    #   command:  CC -> raw = CZERO + CC / span * (CFS - CZERO),
+    #             pressure target = (raw - command_error[1]) / command_error[0]
+    #   sensor:   raw = sensor_error[0] * pressure + sensor_error[1],
+    #             Monitor = (raw - SZERO) / (SFS - SZERO) * span
+    # so an error other than (1, 0) is something Calibration can correct.
+    # With the inlet closed (DVALVE 2 or 5) the pressure decays at `leak`
+    # units per second instead. A CS-5090 model has no STAT, MON, FW, CT or
+    # CC queries, takes CUTOFF (echoed as CO) and BIAS in place of CO and IBIAS.
+    def __init__(self, model='CS-6000', serial_number='100000', span=100.0,
+                 tau=.2, noise=0.0, leak=0.0, sensor_error=(1.0, 0.0),
+                 command_error=(1.0, 0.0), firmware='1.00', **faults):
+        Simulator.__init__(self, **faults)
+        self.SerialNumber = serial_number
+        self.Span = span
+        self.Tau = tau
+        self.Noise = noise
+        self.Leak = leak
+        self.SensorError = sensor_error
+        self.CommandError = command_error
+        self.Inlet = True
+        self.Exhaust = True
+        self.Level = 0.0
+        self.Updated = monotonic()
+        self.Mutex = threading.Lock()
+        self.Values = {'ID': model, 'SN': serial_number, 'FW': firmware,
+                       'CT': '0', 'CC': '0.00', 'PIDP': '1.00', 'PIDI': '0.10',
+                       'PIDD': '0.00', 'VLO': '0.00', 'CZERO': '0.000000',
+                       'CFS': fmt(span, 6), 'MZERO': '0.000000',
+                       'MFS': fmt(span, 6), 'SZERO': '0.000000',
+                       'SFS': fmt(span, 6), 'EBIAS': '0.00', 'FLOW': '0.00'}
+        if self.is_5090():
+            self.Values.update({'CUTOFF': '0.00', 'BIAS': '0.00'})
+        else:
+            self.Values.update({'CO': '0.00', 'IBIAS': '0.00'})
+
+    def is_5090(self):
+        return 'CS-5090' in self.Values['ID']
+
+    def number(self, cmd):
+        try:
+            return float(self.Values[cmd])
+        except Exception as ex:
+            return 0.0
+
+    def target(self):
+        zero, fullscale = self.number('CZERO'), self.number('CFS')
+        raw = zero + self.number('CC') / self.Span * (fullscale - zero)
+        return (raw - self.CommandError[1]) / self.CommandError[0]
+
+    def pressure(self):
+        # true pressure now; also the source for a reference simulator
+        with self.Mutex:
+            now = monotonic()
+            dt = now - self.Updated
+            self.Updated = now
+            if not self.Inlet:
+                self.Level -= self.Leak * dt
+            elif self.Tau > 0:
+                self.Level += (self.target() - self.Level) * (1 - math.exp(-dt / self.Tau))
+            else:
+                self.Level = self.target()
+            return self.Level
+
+    def monitor(self):
+        raw = self.SensorError[0] * self.pressure() + self.SensorError[1]
+        zero, fullscale = self.number('SZERO'), self.number('SFS')
+        value = (raw - zero) / (fullscale - zero) * self.Span if fullscale != zero else 0.0
+        if self.Noise:
+            value += self.Random.gauss(0, self.Noise)
+        return value
+
+    def status(self):
+        return 'STAT:  C:' + fmt(self.number('CC')) + '  S:' + fmt(self.monitor()) + '  E:0'
+
+    def respond(self, line):
+        if line[0] == '?':
+            cmd = line[1:].strip()
+            if cmd == 'STAT':
+                return None if self.is_5090() else self.status()
+            if cmd == 'MON':
+                return None if self.is_5090() else 'MON: ' + fmt(self.monitor())
+            if self.is_5090() and cmd in ('FW', 'CT', 'CC', 'CO', 'IBIAS'):
+                return None
+            if cmd == 'CUTOFF' and self.is_5090():
+                return 'CO: ' + self.Values['CUTOFF']
+            if cmd in self.Values:
+                return cmd + ': ' + self.Values[cmd]
+            return None
+        if line == 'SAVE':
+            return 'SAVE: SAVE'
+        if line == 'AUTOC':
+            return 'AUTOC: AUTOC'
+        if ':' not in line:
+            return None
+        cmd, value = [s.strip() for s in line.split(':', 1)]
+        if cmd == 'DVALVE':
+            # 0 both on, 1/2 inlet on/off, 3/4 exhaust on/off, 5 both off
+            self.pressure()
+            v = int(float(value))
+            self.Inlet = {0: True, 1: True, 2: False, 5: False}.get(v, self.Inlet)
+            self.Exhaust = {0: True, 3: True, 4: False, 5: False}.get(v, self.Exhaust)
+            return cmd + ': ' + cmd
+        name = {'53455249414C': 'SN', '4D4F44454C': 'ID'}.get(cmd, cmd)
+        if name not in self.Values:
+            return None
+        if name == 'CC':
+            self.pressure()
+        self.Values[name] = value
+        return cmd + ': ' + cmd
+
+
+class ExternalSensorSim(CordisSim):
+    # External sensor board: Cordis grammar, and a STAT line of
+    # `STAT: : ADC:: x | SL:: ... | SH:: ... | OL:: ... | OH:: ...`
+    # where x is source() (default: a constant 0).
+    def __init__(self, model='ES-1000', serial_number='200000', source=None,
+                 **faults):
+        CordisSim.__init__(self, model, serial_number, **faults)
+        self.Source = source or constant(0.0)
+        self.Values.update({'OUT_LOW': '4.000', 'OUT_HIGH': '20.000',
+                            'SENSOR_LOW': '0.000', 'SENSOR_HIGH': '5.000'})
+
+    def status(self):
+        return 'STAT: : ADC:: ' + fmt(self.Source(), 4) + \
+            ' | SL:: ' + self.Values['SENSOR_LOW'] + ' | SH:: ' + self.Values['SENSOR_HIGH'] + \
+            ' | OL:: ' + self.Values['OUT_LOW'] + ' | OH:: ' + self.Values['OUT_HIGH']
+
+
+class Fluke2700Sim(Simulator):
+    # Fluke 2700G pressure gauge at 9600 baud: `*idn?`, `val?` -> `value,unit`
+    Baud = 9600
+
+    def __init__(self, serial_number='3000000', source=None, unit='PSI',
+                 **faults):
+        Simulator.__init__(self, **faults)
+        self.SerialNumber = serial_number
+        self.Source = source or constant(0.0)
+        self.Unit = unit
+
+    def respond(self, line):
+        cmd = line.lower()
+        if cmd == '*idn?':
+            return 'FLUKE,2700G,' + self.SerialNumber + ',1.00'
+        if cmd == 'val?':
+            return fmt(self.Source(), 4) + ',' + self.Unit
+        return None
+
+
+class Fluke8846Sim(Simulator):
+    # Fluke 8846A multimeter, the SCPI subset the driver uses: *idn?, CONF?,
+    # CONF:VOLT:DC / CONF:CURR:DC, MEAS:...?, FETCH3? / READ?, and buffered
+    # acquisition (SAMP:COUN, INIT, DATA:POIN?, R? n, ABOR) taking readings
+    # at `rate` per second (default 60 / NPLC, at most 1000). source() is in
+    # volts or amps.
+    def __init__(self, serial_number='4000000', source=None, rate=None,
+                 **faults):
+        Simulator.__init__(self, **faults)
+        self.SerialNumber = serial_number
+        self.Source = source or constant(0.0)
+        self.Rate = rate
+        self.Function = 'VOLT'
+        self.Range = 10.0
+        self.NPLC = 10.0
+        self.Samples = 1
+        self.Started = None
+        self.Taken = 0
+
+    def rate(self):
+        return self.Rate or min(60.0 / self.NPLC, 1000.0)
+
+    def available(self):
+        if self.Started is None:
+            return 0
+        return min(self.Samples, int((monotonic() - self.Started) * self.rate())) - self.Taken
+
+    def respond(self, line):
+        cmd = line.upper()
+        if cmd == '*IDN?':
+            return 'FLUKE,8846A,' + self.SerialNumber + ',08/02/10-11:53'
+        if cmd == 'CONF?':
+            return '"' + self.Function + ' ' + scpi(self.Range) + ',' + scpi(3e-6) + '"'
+        if cmd.startswith('CONF:') or cmd.startswith('MEAS:'):
+            self.Function = 'CURR' if 'CURR' in cmd else 'VOLT'
+            parts = cmd.rstrip('?').split(' ')
+            try:
+                self.Range = float(parts[1])
+            except Exception as ex:
+                self.Range = 10.0 if self.Function == 'VOLT' else .1
+            self.Started = None
+            if cmd.startswith('MEAS:'):
+                return scpi(self.Source())
+            return None
+        if cmd in ('FETCH3?', 'FETC?', 'FETCH?', 'READ?', 'MEAS?'):
+            return scpi(self.Source())
+        if ':NPLC ' in cmd:
+            self.NPLC = float(cmd.split(' ')[1])
+            return None
+        if cmd.startswith('SAMP:COUN '):
+            self.Samples = int(cmd.split(' ')[1])
+            return None
+        if cmd == 'INIT':
+            self.Started = monotonic()
+            self.Taken = 0
+            return None
+        if cmd == 'ABOR':
+            self.Started = None
+            return None
+        if cmd == 'DATA:POIN?':
+            return str(self.available())
+        if cmd.startswith('R?'):
+            n = self.available()
+            try:
+                n = min(n, int(cmd.split(' ')[1]))
+            except Exception as ex:
+                pass
+            self.Taken += n
+            body = ','.join(scpi(self.Source()) for k in range(n))
+            return '#' + str(len(str(len(body)))) + str(len(body)) + body
+        return None
+
+
+class Pace1000Sim(Simulator):
+    # GE Druck PACE1000, CRLF terminated: *idn?, :SENS:PRES?, :UNIT:PRES?
+    # and :UNIT:PRES <unit>
+    Terminator = b'\r\n'
+
+    def __init__(self, serial_number='5000000', source=None, unit='BAR',
+                 **faults):
+        Simulator.__init__(self, **faults)
+        self.SerialNumber = serial_number
+        self.Source = source or constant(0.0)
+        self.Unit = unit
+
+    def respond(self, line):
+        cmd = line.upper()
+        if cmd == '*IDN?':
+            return '*IDN GE Druck,PACE1000,' + self.SerialNumber + ',02.00.00'
+        if cmd == ':SENS:PRES?':
+            return ':SENS:PRES ' + fmt(self.Source(), 5)
+        if cmd == ':UNIT:PRES?':
+            return ':UNIT:PRES ' + self.Unit
+        if cmd.startswith(':UNIT:PRES '):
+            self.Unit = line.split(' ', 1)[1].strip()
+        return None
+
+
+class SureFlowSim(Simulator):
+    # SureFlow flow meter at 19200 baud: `*` and `A` -> the data frame
+    # `A pressure temp ccm sccm`, `A r76` -> the serial number register.
+    # source() is the flow in sccm.
+    Baud = 19200
+
+    def __init__(self, serial_number='60000', source=None, pressure=14.7,
+                 temperature=25.0, **faults):
+        Simulator.__init__(self, **faults)
+        self.SerialNumber = serial_number
+        self.Source = source or constant(0.0)
+        self.Pressure = pressure
+        self.Temperature = temperature
+
+    def respond(self, line):
+        cmd = line.upper()
+        if cmd in ('*', 'A'):
+            sccm = self.Source()
+            ccm = sccm * 14.696 / self.Pressure * (273.15 + self.Temperature) / 273.15
+            return 'A ' + fmt(self.Pressure) + ' ' + fmt(self.Temperature) + \
+                ' ' + fmt(ccm, 3) + ' ' + fmt(sccm, 3)
+        if cmd == 'A R76':
+            return 'A 076 = ' + self.SerialNumber
+        return None
+
+
+SIMULATORS = {'CordisDevice': CordisSim, 'ExternalSensor': ExternalSensorSim,
+              'Fluke2700': Fluke2700Sim, 'Fluke8846': Fluke8846Sim,
+              'Pace1000': Pace1000Sim, 'SureFlow': SureFlowSim}
+
+
+def start_bench(counts, **faults):
+    # counts: {device class name: how many}. Starts that many simulators,
+    # each with its own serial number, and returns them; stop_bench() when
+    # done. Hundreds of instruments fit in the default 1024 open files.
+    sims = []
+    for name, n in counts.items():
+        cls = SIMULATORS[name]
+        for i in range(n):
+            sn = str((list(SIMULATORS).index(name) + 1) * 100000 + i)
+            sims.append(cls(serial_number=sn, **faults).start())
+    return sims
+
+
+def stop_bench(sims):
+    for sim in sims:
+        sim.stop()
@@ -1,16 +1,28 @@
 import serial
-import serial.tools.list_ports
-from time import sleep
+from time import monotonic, sleep
 import platform
 
+from Metrics import metrics
+from Readings import Reading, ReadingAttribute, TypedReadings, parse_reading
+from Timeouts import policy as timeout_policy
+from Transport import CommandProtocol, PortLock, comports
+
 if platform.system().lower() != 'windows':
     import fcntl
 else:
     from fakefcntl import fcntl
 
 
-class SureFlow:
-    def __init__(self):
+class SureFlow(CommandProtocol, TypedReadings):
+    Kind = 'SureFlow'
+    Fallback = .2
+    DropFailedPort = True
+    SCCM = ReadingAttribute()
+    CCM = ReadingAttribute()
+    Temp = ReadingAttribute()
+    Pressure = ReadingAttribute()
+
+    def __init__(self, port=None, serial_number=None):
         self.DevicePort = ''
         self.SerialNumber = '-'
         self.Device_Type = 'Measurement'
@@ -20,94 +32,118 @@ class SureFlow:
         self.Temp = ''
         self.Pressure = ''
         self.SerialPort = None
-        self.Waiting = False
+        self.Lock = PortLock()
+        self.AsyncPort = None
+        self.Framer = None
+        self.Worker = None
+        if port is not None:
+            try:
+                self.SerialPort = serial.Serial(port, 19200, timeout=.2)
+                fcntl.flock(self.SerialPort.fileno(),
+                            fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.DevicePort = port
+                if serial_number is None:
+                    self.read_serial()
+                else:
+                    self.SerialNumber = serial_number
+            except Exception as ex:
+                if self.SerialPort:
+                    self.SerialPort.close()
+                self.SerialPort = None
+
+    @property
+    def Waiting(self):
+        return self.Lock.locked()
 
     def reset_serial(self):
-        while self.Waiting:
-            pass
-        self.Waiting = True
-        if self.SerialPort:
-            self.SerialPort.reset_input_buffer()
-            self.SerialPort.reset_output_buffer()
-            pass
-        self.Waiting = False
+        with self.Lock:
+            if self.SerialPort:
+                self.SerialPort.reset_input_buffer()
+                self.SerialPort.reset_output_buffer()
 
     def read_command(self, cmd):
-        while self.Waiting:
-            pass
-        self.Waiting = True
         try:
-            if self.SerialPort:
-                send_bytes = b'\r' + cmd + b'\r'
-                self.SerialPort.write(send_bytes)
-                resp = self.SerialPort.read_until(b'\r')
-                resp = resp.decode('utf-8')
-                if resp == '' or resp[-1] != '\r':
-                    raise Exception('Unexpected Return')
-                self.Waiting = False
-                return resp
-            else:
-                self.Waiting = False
-                return 'Err'
+            with self.Lock:
+                if self.SerialPort:
+                    send_bytes = b'\r' + cmd + b'\r'
+                    key = cmd.decode()
+                    timeout = timeout_policy.timeout('SureFlow', self.DevicePort, key, .2)
+                    start = monotonic()
+                    resp = self.framer().query(send_bytes, None, timeout)
+                    timeout_policy.observe('SureFlow', self.DevicePort, key, start,
+                                           resp is not None, .2)
+                    if resp is None:
+                        raise Exception('Unexpected Return')
+                    return (resp + b'\r').decode('utf-8')
+                else:
+                    return 'Err'
         except Exception as e:
-            self.Waiting = False
-            self.SerialPort = None
+            metrics.error('SureFlow', getattr(self.SerialPort, 'port', None), cmd.decode(), e)
+            # a late reply under a learned deadline is not a lost meter
+            self.drop_port(e)
             return 'Err'
 
     def write_command(self, cmd):
-        while self.Waiting:
-            pass
         try:
-            self.Waiting = True
-            if self.SerialPort:
-                self.SerialPort.write(b'\r' + cmd + b'\r')
-            self.Waiting = False
+            with self.Lock:
+                if self.SerialPort:
+                    self.SerialPort.write(b'\r' + cmd + b'\r')
         except Exception as e:
-            self.Waiting = False
-            self.SerialPort = None
+            self.drop_port(e)
             return 'Err'
 
     def find_device(self):
-        while self.Waiting:
-            pass
-        self.Waiting = True
-        for p in serial.tools.list_ports.comports():
-            try:
-                if p.device == '/dev/ttyAMA0':
+        found = None
+        with self.Lock:
+            for p in comports():
+                try:
+                    if p.device == '/dev/ttyAMA0':
+                        continue
+                    with open(p.device, 'r') as a:
+                        fcntl.flock(a.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        a = 1234  # Not sure what is happening here but with only an flock it freezes
+                except:
                     continue
-                with open(p.device, 'r') as a:
-                    fcntl.flock(a.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-                    a = 1234  # Not sure what is happening here but with only an flock it freezes
-            except:
-                continue
-            try:
-                with serial.Serial(p.device, 19200, timeout=.2) as ser:
-                    ser.write(b'\r*\r')
-                    resp = ser.read_until(b'\r')
-            except:                     # to broad of an exception ... but if it fails we should just move on
-                self.SerialPort = None
-                continue
-            if resp.decode('utf-8')[:2] == 'A ':  # check for fluke response
-                self.DevicePort = p.device
-                self.SerialPort = serial.Serial(
-                    self.DevicePort, 19200, timeout=.2)
-                fcntl.flock(self.SerialPort.fileno(),
-                            fcntl.LOCK_EX | fcntl.LOCK_NB)
-                self.Waiting = False
-                self.read_serial()
-                print('SureFlow: ' + str(p.device))
-                return True
-        self.Waiting = False
+                try:
+                    with serial.Serial(p.device, 19200, timeout=.2) as ser:
+                        timeout_policy.apply(ser, 'SureFlow', p.device, '*', .2)
+                        start = monotonic()
+                        ser.write(b'\r*\r')
+                        resp = ser.read_until(b'\r')
+                except:                     # to broad of an exception ... but if it fails we should just move on
+                    self.SerialPort = None
+                    continue
+                if resp.decode('utf-8')[:2] == 'A ':  # check for fluke response
+                    timeout_policy.observe('SureFlow', p.device, '*', start, True, .2)
+                    self.DevicePort = p.device
+                    self.SerialPort = serial.Serial(
+                        self.DevicePort, 19200, timeout=.2)
+                    fcntl.flock(self.SerialPort.fileno(),
+                                fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    found = p.device
+                    break
+        if found:
+            self.read_serial()
+            print('SureFlow: ' + str(found))
+            return True
         return False
 
-    def read_flow(self):
-        r = self.read_command(b'A')
+    def read_flow(self, typed=False):
+        r = self.parse_flow(self.read_command(b'A'))
+        return self.reading('SCCM') if typed else r
+
+    async def read_flow_async(self, typed=False):
+        r = self.parse_flow(await self.read_command_async(b'A'))
+        return self.reading('SCCM') if typed else r
+
+    def parse_flow(self, r):
         if r != 'Err' and r != '':
             try:
-                self.SCCM = str(float(r.split(' ')[4]))
-                self.CCM = str(float(r.split(' ')[3]))
-                self.Temp = str(float(r.split(' ')[2]))
-                self.Pressure = str(float(r.split(' ')[1]))
+                fields = r.split(' ')
+                self.SCCM = Reading(float(fields[4]), 'sccm', self.SerialNumber)
+                self.CCM = Reading(float(fields[3]), 'ccm', self.SerialNumber)
+                self.Temp = Reading(float(fields[2]), '', self.SerialNumber)
+                self.Pressure = Reading(float(fields[1]), '', self.SerialNumber)
             except:
                 return 'Err'
         else:
@@ -132,5 +168,12 @@ class SureFlow:
         else:
             return True
 
-    def update_values(self):
+    def update_values(self, typed=False):
         self.read_flow()
+        if typed:
+            return self.readings('SCCM', 'CCM', 'Temp', 'Pressure')
+
+    async def update_values_async(self, typed=False):
+        await self.read_flow_async()
+        if typed:
+            return self.readings('SCCM', 'CCM', 'Temp', 'Pressure')
@@ -0,0 +1,93 @@
+import json
+import os
+import threading
+from collections import deque
+from time import monotonic
+
+from Metrics import metrics
+
+TIMEOUTS_PATH = os.environ.get('DEVICES_TIMEOUTS', os.path.join(
+    os.path.expanduser('~'), '.cache', 'Devices', 'timeouts.json'))
+
+
+class TimeoutPolicy:
+    # Learns response latency per (device class, port, command) and turns it
+    # into a read deadline: percentile * margin + floor, never above the
+    # class's hard-coded timeout, which is only used until enough samples
+    # exist. A timeout feeds back a penalty sample so a deadline that turns
+    # out too tight widens again.
+    def __init__(self, percentile=.99, margin=2.0, floor=.05, window=256,
+                 min_samples=10, path=TIMEOUTS_PATH):
+        self.Percentile = percentile
+        self.Margin = margin
+        self.Floor = floor
+        self.Window = window
+        self.MinSamples = min_samples
+        self.Path = path
+        self.Samples = {}
+        self.Lock = threading.Lock()
+
+    def add(self, key, latency):
+        samples = self.Samples.get(key)
+        if samples is None:
+            samples = self.Samples[key] = deque(maxlen=self.Window)
+        samples.append(latency)
+
+    def record(self, kind, port, cmd, latency):
+        with self.Lock:
+            self.add((kind, port, cmd), latency)
+            self.add((kind, None, cmd), latency)
+
+    def observe(self, kind, port, cmd, start, ok, fallback, end=None):
+        # end: when the reply arrived, if not just now
+        latency = (monotonic() if end is None else end) - start
+        metrics.query(kind, port, cmd, latency, ok)
+        if ok:
+            self.record(kind, port, cmd, latency)
+        else:
+            self.record(kind, port, cmd,
+                        min(2 * self.timeout(kind, port, cmd, fallback), fallback))
+
+    def timeout(self, kind, port, cmd, fallback):
+        with self.Lock:
+            samples = self.Samples.get((kind, port, cmd))
+            if samples is None or len(samples) < self.MinSamples:
+                samples = self.Samples.get((kind, None, cmd))
+            if samples is None or len(samples) < self.MinSamples:
+                return fallback
+            ordered = sorted(samples)
+        p = ordered[min(len(ordered) - 1, int(self.Percentile * len(ordered)))]
+        return min(max(p * self.Margin + self.Floor, self.Floor), fallback)
+
+    def apply(self, ser, kind, port, cmd, fallback):
+        ser.timeout = self.timeout(kind, port, cmd, fallback)
+        return ser.timeout
+
+    def load(self):
+        # saved latencies never replace ones already learned in this process
+        try:
+            with open(self.Path, 'r') as f:
+                data = json.load(f)
+        except Exception as ex:
+            return
+        with self.Lock:
+            for kind, port, cmd, samples in data:
+                key = (kind, port, cmd)
+                if key not in self.Samples:
+                    self.Samples[key] = deque(samples, maxlen=self.Window)
+
+    def save(self):
+        with self.Lock:
+            data = [[k[0], k[1], k[2], list(v)] for k, v in self.Samples.items()]
+        try:
+            os.makedirs(os.path.dirname(self.Path) or '.', exist_ok=True)
+            tmp = self.Path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.Path)
+        except Exception as ex:
+            print('Timeouts not saved: ' + str(ex))
+
+
+policy = TimeoutPolicy()
+policy.load()
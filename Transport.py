@@ -0,0 +1,694 @@
+import asyncio
+import os
+import queue
+import select
+import threading
+from collections import deque
+from concurrent.futures import Future
+from time import monotonic
+
+from Metrics import metrics
+from Timeouts import policy as timeout_policy
+
+
+class PortBusy(TimeoutError):
+    # a PortLock acquisition timed out; other timeouts stay TimeoutError
+    pass
+
+
+class PortLock:
+    # Blocking, first-come first-served lock guarding one serial port.
+    # Replaces the old `while self.Waiting: pass` spin: waiters sleep on a
+    # condition variable and are served in arrival order. `with lock:` uses
+    # the default acquire timeout and raises PortBusy when it expires;
+    # acquire() can be given its own timeout (0 = try once). Any thread may
+    # release, so the lock can be handed to a worker or an event loop.
+    # Coroutines queue in the same line through acquire_async(): release()
+    # hands the lock straight to a waiting future on its own loop, so no
+    # executor thread is parked and a cancelled waiter never keeps the lock.
+    # Name labels the lock in Metrics (the devices use their port).
+    def __init__(self, timeout=None, name=None):
+        self.Timeout = timeout
+        self.Name = name
+        self.Cond = threading.Condition(threading.Lock())
+        self.Queue = deque()
+        self.Held = False
+        self.Acquisitions = 0
+        self.Contended = 0
+        self.TimedOut = 0
+        self.WaitTime = 0.0
+        self.MaxWait = 0.0
+
+    def acquire(self, timeout=None):
+        start = monotonic()
+        with self.Cond:
+            if not self.Held and not self.Queue:
+                self.Held = True
+                self.Acquisitions += 1
+                metrics.lock_acquired(self.Name, 0.0, False)
+                return True
+            if timeout is not None and timeout <= 0:
+                return False
+            ticket = object()
+            self.Queue.append(ticket)
+            self.Contended += 1
+            while self.Held or self.Queue[0] is not ticket:
+                if timeout is None:
+                    self.Cond.wait()
+                    continue
+                remaining = start + timeout - monotonic()
+                if remaining <= 0:
+                    self.Queue.remove(ticket)
+                    self.TimedOut += 1
+                    self.wake()
+                    metrics.lock_timed_out(self.Name)
+                    return False
+                self.Cond.wait(remaining)
+            self.Queue.popleft()
+            self.Held = True
+            self.waited(start)
+            return True
+
+    async def acquire_async(self, timeout=None):
+        start = monotonic()
+        with self.Cond:
+            if not self.Held and not self.Queue:
+                self.Held = True
+                self.Acquisitions += 1
+                metrics.lock_acquired(self.Name, 0.0, False)
+                return True
+            if timeout is not None and timeout <= 0:
+                return False
+            loop = asyncio.get_running_loop()
+            waiter = (loop, loop.create_future())
+            self.Queue.append(waiter)
+            self.Contended += 1
+        try:
+            if timeout is None:
+                await waiter[1]
+            else:
+                await asyncio.wait_for(waiter[1], timeout)
+        except asyncio.TimeoutError:
+            self.abandon(waiter)
+            with self.Cond:
+                self.TimedOut += 1
+            metrics.lock_timed_out(self.Name)
+            return False
+        except BaseException:
+            self.abandon(waiter)
+            raise
+        with self.Cond:
+            self.waited(start)
+        return True
+
+    def waited(self, start):
+        # bookkeeping for a contended acquisition, with Cond held
+        wait = monotonic() - start
+        self.Acquisitions += 1
+        self.WaitTime += wait
+        self.MaxWait = max(self.MaxWait, wait)
+        metrics.lock_acquired(self.Name, wait, True)
+
+    def abandon(self, waiter):
+        # a coroutine stopped waiting: leave the queue, or pass on the lock
+        # if it was handed over at the same moment
+        with self.Cond:
+            if waiter in self.Queue:
+                self.Queue.remove(waiter)
+                self.wake()
+                return
+        fut = waiter[1]
+        if fut.done() and not fut.cancelled():
+            self.release()
+        # otherwise grant() still runs, sees the cancelled future and releases
+
+    def wake(self):
+        # with Cond held: a free lock goes straight to a coroutine at the head
+        # of the queue; threads check for their own turn
+        while not self.Held and self.Queue and isinstance(self.Queue[0], tuple):
+            loop, fut = self.Queue.popleft()
+            try:
+                loop.call_soon_threadsafe(self.grant, fut)
+                self.Held = True
+            except RuntimeError:
+                pass                        # its loop is closed
+        self.Cond.notify_all()
+
+    def grant(self, fut):
+        # runs on the waiter's loop
+        if fut.done():
+            self.release()
+        else:
+            fut.set_result(True)
+
+    def release(self):
+        with self.Cond:
+            if not self.Held:
+                raise RuntimeError('release of unlocked PortLock')
+            self.Held = False
+            self.wake()
+
+    def locked(self):
+        return self.Held
+
+    def waiting(self):
+        return len(self.Queue)
+
+    def stats(self):
+        with self.Cond:
+            return {'acquisitions': self.Acquisitions,
+                    'contended': self.Contended,
+                    'timed_out': self.TimedOut,
+                    'wait_time': self.WaitTime,
+                    'max_wait': self.MaxWait,
+                    'waiting': len(self.Queue)}
+
+    def __enter__(self):
+        if not self.acquire(self.Timeout):
+            raise PortBusy('serial port busy')
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class AsyncPort:
+    # asyncio view of an open pyserial port. Reads and writes go straight to
+    # the port's non-blocking fd through loop.add_reader/add_writer, so a
+    # single event loop can drive every port on a station. The device's
+    # PortLock is still honoured, keeping sync and async callers apart.
+    def __init__(self, ser, lock):
+        self.Serial = ser
+        self.Lock = lock
+        self.Buffer = bytearray()
+
+    async def acquire(self):
+        if not await self.Lock.acquire_async(self.Lock.Timeout):
+            raise PortBusy('serial port busy')
+
+    async def wait_fd(self, writer, timeout):
+        loop = asyncio.get_running_loop()
+        fd = self.Serial.fileno()
+        fut = loop.create_future()
+
+        def wake():
+            if not fut.done():
+                fut.set_result(None)
+        if writer:
+            loop.add_writer(fd, wake)
+        else:
+            loop.add_reader(fd, wake)
+        timer = loop.call_later(max(timeout, 0), wake)
+        try:
+            await fut
+        finally:
+            timer.cancel()
+            if writer:
+                loop.remove_writer(fd)
+            else:
+                loop.remove_reader(fd)
+
+    def read_available(self):
+        try:
+            data = os.read(self.Serial.fileno(), 4096)
+        except BlockingIOError:
+            return 0
+        self.Buffer += data
+        metrics.traffic(self.Serial.port, len(data))
+        return len(data)
+
+    def discard(self):
+        while self.read_available():
+            pass
+        self.Buffer.clear()
+
+    async def write(self, data, timeout=1.0):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self.Serial.fileno(), view):]
+            except BlockingIOError:
+                if loop.time() >= deadline:
+                    raise TimeoutError('write timeout')
+                await self.wait_fd(True, deadline - loop.time())
+        metrics.traffic(self.Serial.port, 0, len(data))
+
+    async def read_until(self, terminator, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            i = self.Buffer.find(terminator)
+            if i >= 0:
+                frame = bytes(self.Buffer[:i + len(terminator)])
+                del self.Buffer[:i + len(terminator)]
+                return frame
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                # like pyserial, hand back whatever arrived before the timeout
+                frame = bytes(self.Buffer)
+                self.Buffer.clear()
+                return frame
+            if not self.read_available():
+                await self.wait_fd(False, remaining)
+
+    async def drain(self, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while loop.time() < deadline:
+            if not self.read_available():
+                await self.wait_fd(False, deadline - loop.time())
+        self.Buffer.clear()
+
+    async def query(self, data, terminator, kind, key, fallback):
+        await self.acquire()
+        try:
+            port = self.Serial.port
+            timeout = timeout_policy.timeout(kind, port, key, fallback)
+            self.discard()
+            start = monotonic()
+            await self.write(data, fallback)
+            resp = await self.read_until(terminator, timeout)
+        finally:
+            self.Lock.release()
+        timeout_policy.observe(kind, port, key, start,
+                               resp[-len(terminator):] == terminator, fallback)
+        return resp
+
+    async def send(self, data, timeout=1.0):
+        await self.acquire()
+        try:
+            await self.write(data, timeout)
+        finally:
+            self.Lock.release()
+
+
+class PortWorker:
+    # Owns one port on a dedicated thread. Callers submit commands (or any
+    # call on the device) and get a concurrent.futures.Future back; the
+    # worker runs them one at a time in submission order. A command still
+    # queued when its timeout expires fails with TimeoutError instead of
+    # being sent, and a future cancelled before it starts is skipped.
+    def __init__(self, query, name='port-worker'):
+        self.Query = query
+        self.Queue = queue.Queue()
+        self.Completed = 0
+        self.Expired = 0
+        self.Thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.Thread.start()
+
+    def submit(self, cmd, timeout=None):
+        return self.call(self.Query, cmd, timeout=timeout)
+
+    def call(self, fn, *args, timeout=None, **kwargs):
+        if self.Thread is None:
+            raise RuntimeError('port worker stopped')
+        future = Future()
+        deadline = None if timeout is None else monotonic() + timeout
+        self.Queue.put((future, deadline, fn, args, kwargs))
+        return future
+
+    def depth(self):
+        return self.Queue.qsize()
+
+    def stop(self, wait=True):
+        thread = self.Thread
+        if thread is None:
+            return
+        self.Thread = None
+        self.Queue.put(None)
+        if wait and thread is not threading.current_thread():
+            thread.join()
+
+    def run(self):
+        while True:
+            item = self.Queue.get()
+            if item is None:
+                break
+            future, deadline, fn, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            if deadline is not None and monotonic() > deadline:
+                self.Expired += 1
+                future.set_exception(TimeoutError('command expired in queue'))
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as ex:
+                future.set_exception(ex)
+            self.Completed += 1
+        # fail whatever was queued behind the stop request
+        while True:
+            try:
+                item = self.Queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None and item[0].set_running_or_notify_cancel():
+                item[0].set_exception(RuntimeError('port worker stopped'))
+
+
+class LineFramer:
+    # Line framer for one open port. Reads whatever the driver has in bulk
+    # into a reusable bytearray and splits it into frames on \r or \r\n.
+    # query() matches a reply to its request by prefix and drops any stray or
+    # late frame in front of it, so the port never has to be flushed.
+    def __init__(self, ser):
+        self.Serial = ser
+        self.Buffer = bytearray()
+        self.Discarded = 0
+
+    def fill(self, timeout):
+        # wait for input with select() on the fd rather than through
+        # ser.timeout, whose setter reconfigures the port (tcsetattr) every
+        # time, then take everything that has arrived in one read
+        ser = self.Serial
+        n = ser.in_waiting
+        if not n:
+            try:
+                fd = ser.fileno()
+            except Exception as ex:
+                fd = None
+            if fd is not None:
+                if not select.select([fd], [], [], max(timeout, 0))[0]:
+                    return 0
+                n = max(ser.in_waiting, 1)
+            else:
+                if ser.timeout != timeout:
+                    ser.timeout = timeout
+                n = 1
+        data = ser.read(n)
+        self.Buffer += data
+        metrics.traffic(ser.port, len(data))
+        return len(data)
+
+    def pop_frame(self):
+        buf = self.Buffer
+        while buf[:1] == b'\n':
+            del buf[:1]
+        i = buf.find(b'\r')
+        if i < 0:
+            return None
+        frame = bytes(buf[:i])
+        end = i + 2 if buf[i + 1:i + 2] == b'\n' else i + 1
+        del buf[:end]
+        return frame
+
+    def drop_stale(self):
+        # throw away complete frames and partial data from earlier exchanges
+        # without touching the driver's queues
+        if self.Serial.in_waiting:
+            self.fill(0)
+        while self.pop_frame() is not None:
+            self.discard()
+        self.Buffer.clear()
+
+    def write(self, data):
+        self.Serial.write(data)
+        metrics.traffic(self.Serial.port, 0, len(data))
+
+    def discard(self):
+        # a frame nobody asked for: a late reply, or an unexpected return
+        self.Discarded += 1
+        metrics.discarded(self.Serial.port)
+
+    def read_frame(self, deadline):
+        while True:
+            frame = self.pop_frame()
+            if frame is not None:
+                return frame
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return None
+            self.fill(remaining)
+
+    def matches(self, frame, match):
+        if match is None:
+            return frame != b''
+        if callable(match):
+            return match(frame)
+        return frame.startswith(match)
+
+    def query(self, data, match, timeout):
+        # frame (terminator stripped) answering data, or None on timeout.
+        # match: reply prefix, predicate, or None for the first non-empty frame
+        self.drop_stale()
+        deadline = monotonic() + timeout
+        self.write(data)
+        while True:
+            frame = self.read_frame(deadline)
+            if frame is None or self.matches(frame, match):
+                return frame
+            self.discard()
+
+
+def query_batch(framer, requests, timeout, window=8, timings=None):
+    # Pipelined request/response exchange on an already locked port.
+    # requests: [(bytes to send, reply prefix), ...]. Up to `window`
+    # requests are kept in flight; each reply frame is matched to the
+    # oldest outstanding request whose prefix it starts with, so stray
+    # frames are skipped. Returns the reply frames in request order, with
+    # None for requests that got no reply before the link went quiet for
+    # `timeout` seconds. A `timings` list is filled with [sent, replied]
+    # monotonic times per request (replied None when unanswered).
+    replies = [None] * len(requests)
+    if timings is not None:
+        timings[:] = [[None, None] for r in requests]
+    outstanding = []
+    sent = 0
+    framer.drop_stale()
+    while sent < len(requests) or outstanding:
+        while sent < len(requests) and len(outstanding) < window:
+            framer.write(requests[sent][0])
+            if timings is not None:
+                timings[sent][0] = monotonic()
+            outstanding.append(sent)
+            sent += 1
+        frame = framer.read_frame(monotonic() + timeout)
+        if frame is None:
+            # link went quiet: give up on what is in flight
+            outstanding = []
+            continue
+        for k in outstanding:
+            if framer.matches(frame, requests[k][1]):
+                replies[k] = frame
+                if timings is not None:
+                    timings[k][1] = monotonic()
+                outstanding.remove(k)
+                break
+        else:
+            framer.discard()
+    return replies
+
+
+def write_batch(device, kind, values, readback, writable, retries=2, save=False,
+                window=8):
+    # Pipelined writes for the Cordis grammar (`CMD: value` -> `CMD: CMD`).
+    # values: {command: value}. Every write goes out through query_batch and
+    # is verified by its echo; only the unacknowledged ones are sent again.
+    # device needs Lock, SerialPort, framer(), Cache and save(); readback maps
+    # a write to the cached query it changes and writable a write to the
+    # attribute that takes its reply. SAVE is only sent once every write has
+    # been verified. Returns {command: 0 or 1}, plus 'SAVE' if asked.
+    values = dict(values)
+    pending = list(values)
+    acked = {}
+    device.Cache.invalidate(*[readback.get(cmd, cmd) for cmd in pending])
+    port = device.SerialPort.port if device.SerialPort else ''
+    timeout = max([timeout_policy.timeout(kind, port, cmd + ':', .4)
+                   for cmd in pending] or [.4])
+    for attempt in range(retries + 1):
+        if not pending:
+            break
+        requests = [(cmd.encode() + b': ' + str(values[cmd]).encode() + b'\r',
+                     lambda f, c=cmd.encode(): f[len(c) + 2:] == c)
+                    for cmd in pending]
+        try:
+            with device.Lock:
+                framer = device.framer()
+                if attempt == 0:
+                    # clear a partial line on the board; the reply is skipped
+                    device.SerialPort.write(b'\r')
+                replies = query_batch(framer, requests, timeout, window)
+        except Exception as ex:
+            replies = [None] * len(pending)
+        for cmd, reply in zip(pending, replies):
+            if reply is not None:
+                acked[cmd] = reply.decode('utf-8')[(len(cmd)+2):]
+        pending = [cmd for cmd in pending if cmd not in acked]
+    results = {}
+    for cmd in values:
+        retval = acked.get(cmd, '')
+        if cmd in writable:
+            setattr(device, writable[cmd], retval)
+        results[cmd] = 0 if retval == cmd else 1
+    if save:
+        ok = not any(results.values())
+        results['SAVE'] = 0 if ok and device.save() not in ('', 'error') else 1
+    return results
+
+
+def port_failed(ex):
+    # True when an exception means the port itself is gone (unplugged
+    # adapter, dead fd), as opposed to a timeout, a busy lock or a bad reply
+    import serial
+    if isinstance(ex, (TimeoutError, serial.SerialTimeoutException)):
+        return False
+    return isinstance(ex, (OSError, serial.SerialException))
+
+
+class SerialDevice:
+    # Worker thread, framer and async plumbing shared by the device classes.
+    # A device sets Kind (its timeout policy / metrics name) and Fallback
+    # (its default reply timeout) and has SerialPort, Lock, Framer, AsyncPort
+    # and Worker attributes. Worker commands run through the method named by
+    # WorkerQuery.
+    Kind = ''
+    Fallback = .4
+    WorkerQuery = 'read_command'
+
+    def start_worker(self):
+        if self.Worker is None:
+            name = self.Kind + ' ' + (self.SerialPort.port if self.SerialPort else '')
+            self.Worker = PortWorker(getattr(self, self.WorkerQuery), name)
+        return self.Worker
+
+    def stop_worker(self):
+        if self.Worker is not None:
+            self.Worker.stop()
+            self.Worker = None
+
+    def submit(self, cmd, timeout=None):
+        return self.start_worker().submit(cmd, timeout)
+
+    def framer(self):
+        if self.Framer is None or self.Framer.Serial is not self.SerialPort:
+            self.Framer = LineFramer(self.SerialPort)
+            self.Lock.Name = self.SerialPort.port
+        return self.Framer
+
+    def async_port(self):
+        if self.AsyncPort is None or self.AsyncPort.Serial is not self.SerialPort:
+            self.AsyncPort = AsyncPort(self.SerialPort, self.Lock)
+            self.Lock.Name = self.SerialPort.port
+        return self.AsyncPort
+
+
+class CordisProtocol(SerialDevice):
+    # `?CMD` -> `CMD: value` and `CMD: value` -> `CMD: CMD` boards. Readback
+    # maps a write to the cached query it changes; echo() is the name a
+    # reply comes back under.
+    WorkerQuery = 'get_resp'
+    Readback = {}
+
+    def echo(self, cmd):
+        return cmd
+
+    def submit(self, cmd, timeout=None):
+        return self.start_worker().submit(cmd.lstrip('?'), timeout)
+
+    async def get_resp_async(self, cmd):
+        try:
+            tmpcmd = b'?' + cmd.encode() + b'\r'                        # format command query
+            resp = await self.async_port().query(tmpcmd, b'\r', self.Kind, cmd, self.Fallback)
+            resp = resp.decode('utf-8')
+            if resp == '' or resp[-1] != '\r':
+                raise Exception('Unexpected Return')
+            return resp[(len(self.echo(cmd))+2):-1]
+        except Exception as ex:
+            metrics.error(self.Kind, getattr(self.SerialPort, 'port', None), cmd, ex)
+            return 'error: ' + type(ex).__name__
+
+    async def set_value_async(self, cmd, value):
+        try:
+            port = self.async_port()
+            tmpcmd = cmd.encode() + b': ' + str(value).encode() + \
+                b'\r'  # format command query
+            await port.acquire()
+            try:
+                timeout = timeout_policy.timeout(self.Kind, self.SerialPort.port, cmd + ':',
+                                                 self.Fallback)
+                deadline = monotonic() + timeout
+                port.discard()
+                # send command; the reply to the leading \r is skipped
+                await port.write(b'\r' + tmpcmd)
+                while True:
+                    resp = await port.read_until(b'\r', max(deadline - monotonic(), 0))
+                    retval = resp.decode('utf-8')[(len(cmd)+2):-1]
+                    if retval == cmd or resp[-1:] != b'\r':
+                        break
+                if retval == cmd:
+                    self.Cache.invalidate(self.Readback.get(cmd, cmd))
+            finally:
+                self.Lock.release()
+            return retval
+        except Exception as ex:
+            return 'error'
+
+
+class CommandProtocol(SerialDevice):
+    # Instruments driven by read_command(bytes): each command is sent as
+    # Terminator + cmd + Terminator and answered with one Terminator ended
+    # line. Failed calls return ErrorReply; with DropFailedPort a port that
+    # is gone (port_failed) is closed so the device reconnects.
+    Terminator = b'\r'
+    ErrorReply = 'Err'
+    DropFailedPort = False
+
+    def submit(self, cmd, timeout=None):
+        if isinstance(cmd, str):
+            cmd = cmd.encode()
+        return self.start_worker().submit(cmd, timeout)
+
+    def drop_port(self, ex):
+        if self.DropFailedPort and port_failed(ex):
+            if self.SerialPort:
+                self.SerialPort.close()
+            self.SerialPort = None
+
+    async def read_command_async(self, cmd):
+        try:
+            if self.SerialPort:
+                resp = await self.async_port().query(
+                    self.Terminator + cmd + self.Terminator, self.Terminator,
+                    self.Kind, cmd.decode(), self.Fallback)
+                if resp == b'' or not resp.endswith(self.Terminator):
+                    raise Exception('Unexpected Return')
+                return resp.decode('utf-8')
+            else:
+                return self.ErrorReply
+        except Exception as ex:
+            metrics.error(self.Kind, getattr(self.SerialPort, 'port', None), cmd.decode(), ex)
+            # a late reply under a learned deadline is not a lost meter
+            self.drop_port(ex)
+            return self.ErrorReply
+
+    async def write_command_async(self, cmd):
+        try:
+            if self.SerialPort:
+                await self.async_port().send(self.Terminator + cmd + self.Terminator)
+        except Exception as ex:
+            self.drop_port(ex)
+            return self.ErrorReply
+
+
+# ports that exist without a USB adapter behind them (Simulators), listed
+# by comports() next to the real ones
+virtual_ports = {}
+
+
+def register_port(device, description='virtual port'):
+    from serial.tools.list_ports_common import ListPortInfo
+    info = ListPortInfo(device)
+    info.description = description
+    virtual_ports[device] = info
+    return info
+
+
+def unregister_port(device):
+    virtual_ports.pop(device, None)
+
+
+def comports():
+    import serial.tools.list_ports
+    return list(serial.tools.list_ports.comports()) + list(virtual_ports.values())
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# keep learned timeouts and the discovery cache out of the user's home
+scratch = tempfile.mkdtemp(prefix='devices-tests-')
+os.environ.setdefault('DEVICES_TIMEOUTS', os.path.join(scratch, 'timeouts.json'))
+os.environ.setdefault('DEVICES_DISCOVERY_CACHE', os.path.join(scratch, 'discovery.json'))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+from CordisDevice import CordisDevice
+from ExternalSensor import ExternalSensor
+from Hotplug import close_device
+from Simulators import CordisSim, ExternalSensorSim
+
+
+@pytest.fixture
+def board():
+    sim = CordisSim().start()
+    device = CordisDevice(sim.Port)
+    yield device
+    close_device(device)
+    sim.stop()
+
+
+@pytest.fixture
+def sensor():
+    sim = ExternalSensorSim().start()
+    device = ExternalSensor(sim.Port)
+    yield device
+    close_device(device)
+    sim.stop()
+
+
+def test_cordis_async_write_reads_back(board):
+    assert board.get_pidp() == '1.00'        # now cached for 300 s
+    assert asyncio.run(board.set_value_async('PIDP', '2.50')) == 'PIDP'
+    assert board.get_pidp() == '2.50'
+
+
+def test_external_sensor_async_write_reads_back(sensor):
+    assert sensor.get_outzero() == '4.000'
+    assert asyncio.run(sensor.set_value_async('OUT_LOW', '3.500')) == 'OUT_LOW'
+    assert sensor.get_outzero() == '3.500'
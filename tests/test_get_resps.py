@@ -0,0 +1,38 @@
+from CordisDevice import CordisDevice
+from Hotplug import close_device
+from Metrics import metrics
+from Simulators import CordisSim
+from Timeouts import policy as timeout_policy
+
+
+class MangledSim(CordisSim):
+    # once armed, answers the next ?PIDD with bytes that are not utf-8
+    Mangled = True
+
+    def send(self, data):
+        if data.startswith(b'PIDD:') and not self.Mangled:
+            self.Mangled = True
+            data = b'PIDD: \xff\xfe\r'
+        CordisSim.send(self, data)
+
+
+def test_undecodable_reply_is_retried_alone():
+    sim = MangledSim().start()
+    device = CordisDevice(sim.Port)
+    try:
+        metrics.reset()
+        lines = sim.Lines
+        sim.Mangled = False
+        results = device.get_resps(['PIDP', 'PIDI', 'PIDD'])
+        assert results == {'PIDP': '1.00', 'PIDI': '0.10', 'PIDD': '0.00'}
+        # three pipelined queries and one retry of PIDD
+        assert sim.Lines - lines == 4
+        snapshot = metrics.snapshot()['commands']
+        errors = [c['errors'] for c in snapshot if c['cmd'] == 'PIDD']
+        assert errors == [{'decode_error': 1}]
+        oks = dict((c['cmd'], c['ok']) for c in snapshot)
+        assert oks['PIDP'] == 1 and oks['PIDI'] == 1
+        assert timeout_policy.Samples[('CordisDevice', sim.Port, 'PIDP')]
+    finally:
+        close_device(device)
+        sim.stop()
@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+
+import Discovery
+from Hotplug import close_device
+from Simulators import start_bench, stop_bench
+
+NAMES = ['CordisDevice', 'ExternalSensor', 'Fluke2700', 'Fluke8846', 'Pace1000',
+         'SureFlow']
+
+
+@pytest.fixture(scope='module')
+def devices():
+    sims = start_bench(dict((name, 1) for name in NAMES))
+    opened = [Discovery.open_device(Discovery.CLASSES[name], sim.Port, sim.SerialNumber)
+              for name, sim in zip(NAMES, sims)]
+    yield opened
+    for device in opened:
+        close_device(device)
+    stop_bench(sims)
+
+
+@pytest.mark.parametrize('index', range(len(NAMES)))
+def test_sync_and_async_updates_agree(devices, index):
+    device = devices[index]
+    sync = device.update_values(typed=True)
+    result = asyncio.run(device.update_values_async(typed=True))
+    assert type(result) is type(sync)
+    readings = result.values() if isinstance(result, dict) else [result]
+    assert all(r.Status == 0 for r in readings)
+
+
+@pytest.mark.parametrize('index', range(len(NAMES)))
+def test_worker_answers_like_a_direct_query(devices, index):
+    device = devices[index]
+    cmd = {'CordisDevice': '?ID', 'ExternalSensor': '?ID', 'Fluke2700': '*idn?',
+           'Fluke8846': '*idn?', 'Pace1000': ':UNIT:PRES?', 'SureFlow': 'A'}[device.Kind]
+    try:
+        reply = device.submit(cmd).result(5)
+    finally:
+        device.stop_worker()
+    assert reply and 'rr' not in reply and not reply.startswith('error')